@@ -24,6 +24,14 @@ setup(
         , "aiohttp==3.7.0"
         , "alt-pytest-asyncio==0.5.3"
         , "pytest-helpers-namespace==2019.1.8"
+        , "msgpack==1.0.2"
+        , "cbor2==5.2.0"
+        ]
+      , "msgpack":
+        [ "msgpack >= 1.0.0"
+        ]
+      , "cbor":
+        [ "cbor2 >= 5.0.0"
         ]
       , "peer":
         [ "tornado==5.1.1"
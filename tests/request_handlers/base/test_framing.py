@@ -0,0 +1,95 @@
+# coding: spec
+
+from whirlwind.request_handlers.base import (
+    JSONFraming,
+    MsgpackFraming,
+    CBORFraming,
+    AsyncCatcher,
+    reprer,
+)
+
+from unittest import mock
+import msgpack
+import cbor2
+
+
+class Other:
+    def __repr__(s):
+        return "<<<OTHER>>>"
+
+
+describe "JSONFraming":
+    it "dumps to text with escaped closing tags and bytes hexlified":
+        framing = JSONFraming()
+        assert not framing.binary
+        dumped = framing.dumps({"html": "</script>", "raw": b"\x01\x02"}, reprer)
+        assert dumped == '{"html": "<\\/script>", "raw": "0102"}'
+        assert framing.loads(dumped) == {"html": "</script>", "raw": "0102"}
+
+    it "normalises into a json object":
+        framing = JSONFraming()
+        assert framing.normalise({"other": Other(), "t": (1, 2)}, reprer) == {
+            "other": "<<<OTHER>>>",
+            "t": [1, 2],
+        }
+
+describe "MsgpackFraming":
+    it "keeps bytes as bytes":
+        framing = MsgpackFraming()
+        assert framing.binary
+        assert framing.available
+        assert framing.subprotocol == "whirlwind.msgpack"
+
+        dumped = framing.dumps({"raw": b"\x01\x02", "other": Other()}, reprer)
+        assert msgpack.unpackb(dumped, raw=False) == {"raw": b"\x01\x02", "other": "<<<OTHER>>>"}
+        assert framing.loads(dumped) == {"raw": b"\x01\x02", "other": "<<<OTHER>>>"}
+        assert framing.normalise({"raw": b"\x01", "t": (1,)}, reprer) == {"raw": b"\x01", "t": [1]}
+
+    it "recognises maps":
+        framing = MsgpackFraming()
+        assert framing.recognises(msgpack.packb({"a": 1}))
+        assert framing.recognises(msgpack.packb({str(i): i for i in range(20)}))
+        assert not framing.recognises(msgpack.packb([1]))
+        assert not framing.recognises(cbor2.dumps({"a": 1}))
+        assert not framing.recognises(b"")
+
+    it "isn't available without msgpack":
+        with mock.patch.dict("sys.modules", {"msgpack": None}):
+            assert not MsgpackFraming().available
+
+describe "CBORFraming":
+    it "keeps bytes as bytes":
+        framing = CBORFraming()
+        assert framing.binary
+        assert framing.available
+        assert framing.subprotocol == "whirlwind.cbor"
+
+        dumped = framing.dumps({"raw": b"\x01\x02", "other": Other()}, reprer)
+        assert cbor2.loads(dumped) == {"raw": b"\x01\x02", "other": "<<<OTHER>>>"}
+        assert framing.loads(dumped) == {"raw": b"\x01\x02", "other": "<<<OTHER>>>"}
+
+    it "recognises maps":
+        framing = CBORFraming()
+        assert framing.recognises(cbor2.dumps({"a": 1}))
+        assert framing.recognises(b"\xd9\xd9\xf7" + cbor2.dumps({"a": 1}))
+        assert not framing.recognises(cbor2.dumps([1]))
+        assert not framing.recognises(msgpack.packb({"a": 1}))
+
+    it "isn't available without cbor2":
+        with mock.patch.dict("sys.modules", {"cbor2": None}):
+            assert not CBORFraming().available
+
+describe "AsyncCatcher with a framing":
+    it "uses the framing on the request to normalise the result":
+        request = mock.Mock(name="request", spec=["_finished", "send_msg", "reprer", "framing"])
+        request.reprer = reprer
+        request.framing = MsgpackFraming()
+
+        catcher = AsyncCatcher(request, {})
+        send_msg = mock.Mock(name="send_msg")
+        with mock.patch.object(catcher, "send_msg", send_msg):
+            catcher.complete({"raw": b"\x01", "other": Other()}, status=200)
+
+        send_msg.assert_called_once_with(
+            {"raw": b"\x01", "other": "<<<OTHER>>>"}, status=200, exc_info=None
+        )
@@ -3,6 +3,7 @@
 from whirlwind.request_handlers import Simple
 
 from unittest import mock
+import asyncio
 import pytest
 import types
 import uuid
@@ -237,3 +238,35 @@ describe "RequestsMixin":
 
             # Make sure we got all of them
             assert replies == []
+
+    describe "send_stream":
+        async it "stays cancelled after finishing a cancelled stream", server_wrapper:
+            tasks = []
+
+            class Handler(Simple):
+                async def do_put(s):
+                    async def items():
+                        yield 1
+                        tasks.append(asyncio.current_task())
+                        tasks[0].cancel()
+                        await asyncio.sleep(1)
+                        yield 2
+
+                    return items()
+
+            async with server_wrapper(None, lambda s: [("/", Handler)]) as server:
+                await server.assertHTTP(
+                    "PUT",
+                    "/",
+                    {"json": {}},
+                    json_output=[
+                        1,
+                        {
+                            "status": 500,
+                            "error": "Request was cancelled",
+                            "error_code": "RequestCancelled",
+                        },
+                    ],
+                )
+
+            assert tasks[0].cancelled()
@@ -0,0 +1,169 @@
+# coding: spec
+
+from whirlwind.request_handlers.base import SimpleWebSocketBase
+from whirlwind.sessions import Session, Sessions
+
+from unittest import mock
+import asyncio
+import pytest
+import time
+
+
+@pytest.fixture()
+def final_future():
+    fut = asyncio.Future()
+    try:
+        yield fut
+    finally:
+        fut.cancel()
+
+
+@pytest.fixture()
+def make_server(server_wrapper, final_future):
+    def make_server(Handler, sessions):
+        def tornado_routes(server):
+            return [
+                (
+                    "/v1/ws",
+                    Handler,
+                    {
+                        "final_future": final_future,
+                        "server_time": time.time(),
+                        "wsconnections": server.wsconnections,
+                        "sessions": sessions,
+                    },
+                ),
+            ]
+
+        return server_wrapper(None, tornado_routes)
+
+    return make_server
+
+
+describe "Session":
+    it "numbers and remembers replies":
+        session = Session("token", mock.Mock(name="connection_future"), 3)
+        for i in range(5):
+            assert session.add({"reply": i}) == {"reply": i, "seq": i + 1}
+
+        assert session.since(0) == [
+            {"reply": 2, "seq": 3},
+            {"reply": 3, "seq": 4},
+            {"reply": 4, "seq": 5},
+        ]
+        assert session.since(4) == [{"reply": 4, "seq": 5}]
+        assert session.missed(0) == 2
+        assert session.missed(2) == 0
+
+        session.ack(4)
+        assert session.since(0) == [{"reply": 4, "seq": 5}]
+        assert session.missed(4) == 0
+
+        session.ack(20)
+        assert session.acked == 5
+        assert session.since(0) == []
+        assert session.missed(5) == 0
+
+describe "Sessions":
+    async it "cancels the commands of a session after the grace period":
+        sessions = Sessions(grace=0.05)
+        connection_future = asyncio.Future()
+        handler = mock.Mock(name="handler")
+
+        session = sessions.start(handler, connection_future)
+        assert sessions.resume(session.token, handler) is session
+
+        # Detaching a handler that isn't attached does nothing
+        sessions.detach(session, mock.Mock(name="other"))
+        assert session.handler is handler
+
+        sessions.detach(session, handler)
+        assert session.handler is None
+
+        await asyncio.sleep(0.02)
+        handler2 = mock.Mock(name="handler2")
+        assert sessions.resume(session.token, handler2) is session
+        assert session.handler is handler2
+
+        sessions.detach(session, handler2)
+        await asyncio.sleep(0.1)
+        assert connection_future.cancelled()
+        assert sessions.resume(session.token, handler2) is None
+        assert sessions.sessions == {}
+
+describe "SimpleWebSocketBase with sessions":
+    async it "lets the client resume a session", make_server:
+        release = asyncio.Future()
+        cancelled = []
+
+        class Handler(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                progress_cb("started")
+                try:
+                    await asyncio.wait([release, s.connection_future], return_when="FIRST_COMPLETED")
+                    progress_cb("released")
+                    return "done"
+                finally:
+                    cancelled.append(s.connection_future.done())
+
+        sessions = Sessions(grace=5, buffer_size=10)
+
+        async with make_server(Handler, sessions) as server:
+            async with server.ws_stream() as stream:
+                got = await stream.ws.receive_json()
+                assert got["message_id"] == "__session__"
+                assert got["reply"]["resumed"] is False
+                token = got["reply"]["session"]
+
+                message_id = await stream.start("/one", {})
+                assert await stream.ws.receive_json() == {
+                    "reply": {"progress": "started"},
+                    "message_id": message_id,
+                    "seq": 1,
+                }
+
+            await asyncio.sleep(0.05)
+            assert cancelled == []
+            assert sessions.sessions[token].handler is None
+
+            release.set_result(True)
+            await asyncio.sleep(0.05)
+
+            async with server.ws_stream(path=f"/v1/ws?session={token}&ack=1") as stream:
+                assert await stream.ws.receive_json() == {
+                    "reply": {"session": token, "resumed": True, "missed": 0},
+                    "message_id": "__session__",
+                }
+                assert await stream.ws.receive_json() == {
+                    "reply": {"progress": "released"},
+                    "message_id": message_id,
+                    "seq": 2,
+                }
+                assert await stream.ws.receive_json() == {
+                    "reply": "done",
+                    "message_id": message_id,
+                    "seq": 3,
+                }
+
+                await stream.ws.send_json({"path": "__ack__", "seq": 3})
+                await stream.start("/one", {})
+                seqs = [(await stream.ws.receive_json())["seq"] for _ in range(3)]
+                assert seqs == [4, 5, 6]
+                assert [reply["seq"] for reply in sessions.sessions[token].since(0)] == [4, 5, 6]
+
+        assert cancelled == [False, False]
+
+    async it "starts a new session if the old one is gone", make_server:
+
+        class Handler(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                return "done"
+
+        sessions = Sessions()
+
+        async with make_server(Handler, sessions) as server:
+            async with server.ws_stream(path="/v1/ws?session=nope&ack=3") as stream:
+                got = await stream.ws.receive_json()
+                assert got["message_id"] == "__session__"
+                assert got["reply"]["resumed"] is False
+                assert got["reply"]["session"] != "nope"
@@ -1,10 +1,17 @@
 # coding: spec
 
 from whirlwind.request_handlers.base import SimpleWebSocketBase, Finished, MessageFromExc
+from whirlwind.metrics import Metrics
 
 from unittest import mock
+import whirlwind.server
+import contextlib
 import asyncio
+import aiohttp
+import msgpack
 import pytest
+import cbor2
+import json
 import types
 import time
 import uuid
@@ -728,3 +735,214 @@ describe "SimpleWebSocketBase":
                 ({"progress": {"error": "progress"}}, None),
                 ({"error": "Stuff", "status": 400}, (Finished, error2, None)),
             ]
+
+describe "binary framing":
+
+    class Handler(SimpleWebSocketBase):
+        async def process_message(s, path, body, message_id, message_key, progress_cb):
+            progress_cb({"raw": b"\x00\x01"})
+            return {"path": path, "got": body["data"], "framing": s.framing.name}
+
+    async def exchange(self, server, protocols, send, loads):
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(
+                f"ws://127.0.0.1:{server.port}/v1/ws", protocols=protocols
+            ) as ws:
+                got = []
+                await send(ws)
+                while len(got) < 3:
+                    msg = await ws.receive()
+                    got.append((msg.type, loads(msg.data)))
+                return ws.protocol, got
+
+    async it "can negotiate msgpack with a subprotocol", make_server:
+        async with make_server(self.Handler) as server:
+            data = {"path": "/one", "message_id": "1", "body": {"data": b"\xff\xfe"}}
+            protocol, got = await self.exchange(
+                server,
+                ("whirlwind.msgpack",),
+                lambda ws: ws.send_bytes(msgpack.packb(data)),
+                lambda d: msgpack.unpackb(d, raw=False),
+            )
+
+        assert protocol == "whirlwind.msgpack"
+        assert got[0][0] == aiohttp.WSMsgType.BINARY
+        assert got[0][1]["message_id"] == "__server_time__"
+        assert got[1:] == [
+            (
+                aiohttp.WSMsgType.BINARY,
+                {"reply": {"progress": {"raw": b"\x00\x01"}}, "message_id": "1"},
+            ),
+            (
+                aiohttp.WSMsgType.BINARY,
+                {
+                    "reply": {"path": "/one", "got": b"\xff\xfe", "framing": "msgpack"},
+                    "message_id": "1",
+                },
+            ),
+        ]
+
+    async it "can negotiate cbor with a subprotocol", make_server:
+        async with make_server(self.Handler) as server:
+            data = {"path": "/one", "message_id": "1", "body": {"data": b"\xff\xfe"}}
+            protocol, got = await self.exchange(
+                server,
+                ("whirlwind.cbor",),
+                lambda ws: ws.send_bytes(cbor2.dumps(data)),
+                cbor2.loads,
+            )
+
+        assert protocol == "whirlwind.cbor"
+        assert [t for t, _ in got] == [aiohttp.WSMsgType.BINARY] * 3
+        assert got[2][1] == {
+            "reply": {"path": "/one", "got": b"\xff\xfe", "framing": "cbor"},
+            "message_id": "1",
+        }
+
+    async it "chooses the framing from the first binary message", make_server:
+        replies = []
+
+        def loads(d):
+            if isinstance(d, str):
+                return json.loads(d)
+            return msgpack.unpackb(d, raw=False)
+
+        async with make_server(self.Handler) as server:
+            data = {"path": "/one", "message_id": "1", "body": {"data": b"\x01"}}
+            protocol, got = await self.exchange(
+                server, (), lambda ws: ws.send_bytes(msgpack.packb(data)), loads
+            )
+
+        assert protocol is None
+        assert [t for t, _ in got] == [
+            aiohttp.WSMsgType.TEXT,
+            aiohttp.WSMsgType.BINARY,
+            aiohttp.WSMsgType.BINARY,
+        ]
+        assert got[2][1] == {
+            "reply": {"path": "/one", "got": b"\x01", "framing": "msgpack"},
+            "message_id": "1",
+        }
+
+    async it "still uses json for text messages", make_server:
+        async with make_server(self.Handler) as server:
+            async with server.ws_stream() as stream:
+                message_id = await stream.start("/one", {"data": "hello"})
+                await stream.check_reply({"progress": {"raw": "0001"}}, message_id=message_id)
+                await stream.check_reply(
+                    {"path": "/one", "got": "hello", "framing": "json"}, message_id=message_id
+                )
+
+describe "heartbeats":
+
+    @pytest.fixture()
+    def heartbeat_server(self, final_future):
+        class Server(whirlwind.server.Server):
+            def tornado_routes(s):
+                return [
+                    (
+                        "/v1/ws",
+                        s.Handler,
+                        {
+                            "final_future": final_future,
+                            "server_time": None,
+                            "wsconnections": s.wsconnections,
+                            "metrics": s.metrics,
+                        },
+                    ),
+                ]
+
+        @contextlib.asynccontextmanager
+        async def heartbeat_server(Handler):
+            port = pytest.helpers.free_port()
+            server = Server(
+                final_future,
+                metrics=Metrics(),
+                websocket_ping_interval=0.05,
+                websocket_ping_timeout=0.05,
+            )
+            server.Handler = Handler
+            server.wsconnections = {}
+
+            task = asyncio.get_event_loop().create_task(server.serve("127.0.0.1", port))
+            await pytest.helpers.wait_for_port(port)
+            try:
+                yield server, port
+            finally:
+                final_future.cancel()
+                await asyncio.wait([task])
+                if server.wsconnections:
+                    await asyncio.wait(list(server.wsconnections.values()))
+
+        return heartbeat_server
+
+    async it "evicts clients that don't answer pings", heartbeat_server:
+        cancelled = asyncio.Future()
+
+        class Handler(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                try:
+                    await s.connection_future
+                except asyncio.CancelledError:
+                    cancelled.set_result(True)
+
+        async with heartbeat_server(Handler) as (server, port):
+            async with aiohttp.ClientSession() as session:
+                ws = await session.ws_connect(f"ws://127.0.0.1:{port}/v1/ws", autoping=False)
+                await ws.send_json({"path": "/one", "body": {}, "message_id": "one"})
+
+                # Ignore the pings until tornado closes the connection
+                got = []
+                async for msg in ws:
+                    got.append(msg.type)
+                assert got and set(got) == {aiohttp.WSMsgType.PING}
+                assert ws.closed
+
+                assert await asyncio.wait_for(cancelled, timeout=1) is True
+                evictions = server.metrics.counter("whirlwind_websocket_evictions_total", "")
+                assert evictions.get() == 1
+
+    async it "keeps clients that answer pings", heartbeat_server:
+
+        class Handler(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                await asyncio.sleep(0.3)
+                return {"connected": not s.connection_future.done()}
+
+        async with heartbeat_server(Handler) as (server, port):
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(f"ws://127.0.0.1:{port}/v1/ws") as ws:
+                    await ws.send_json({"path": "/one", "body": {}, "message_id": "one"})
+                    assert await ws.receive_json() == {
+                        "reply": {"connected": True},
+                        "message_id": "one",
+                    }
+
+            evictions = server.metrics.counter("whirlwind_websocket_evictions_total", "")
+            assert evictions.get() == 0
+
+    async it "doesn't evict clients that close the connection", heartbeat_server:
+        closed = asyncio.Future()
+
+        class Handler(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                if path == "/sleep":
+                    await asyncio.sleep(0.2)
+                    return {"slept": True}
+
+                try:
+                    await s.connection_future
+                except asyncio.CancelledError:
+                    closed.set_result(True)
+
+        async with heartbeat_server(Handler) as (server, port):
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(f"ws://127.0.0.1:{port}/v1/ws") as ws:
+                    await ws.send_json({"path": "/one", "body": {}, "message_id": "one"})
+                    await ws.send_json({"path": "/sleep", "body": {}, "message_id": "two"})
+                    reply = await ws.receive_json()
+                    assert reply == {"reply": {"slept": True}, "message_id": "two"}
+
+            assert await asyncio.wait_for(closed, timeout=1) is True
+            evictions = server.metrics.counter("whirlwind_websocket_evictions_total", "")
+            assert evictions.get() == 0
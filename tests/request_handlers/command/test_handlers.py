@@ -1,12 +1,20 @@
 # coding: spec
 
-from whirlwind.request_handlers.command import WSHandler, CommandHandler
-from whirlwind.request_handlers.base import reprer
-from whirlwind.store import NoSuchPath
+from whirlwind.request_handlers.command import WSHandler, CommandHandler, LimitedCommandHandler
+from whirlwind.request_handlers.base import reprer, MetricsHandler
+from whirlwind.store import NoSuchPath, Store
+from whirlwind.commander import Commander, Executor
+from whirlwind.progress import Coalesce, Batch
+from whirlwind.metrics import Metrics
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.norms import dictobj, sb
 
 from unittest import mock
 import asyncio
+import aiohttp
 import pytest
+import json
 import time
 
 
@@ -68,6 +76,7 @@ describe "WSHandler and CommandHandler":
 
     def make_commander(self, handlerKls, *, do_allow_ws_only):
         commander = mock.Mock(name="commander")
+        commander.tracer = None
 
         class Executor:
             def __init__(s, progress_cb, request_handler, **extra):
@@ -75,6 +84,9 @@ describe "WSHandler and CommandHandler":
                 s.progress_cb = progress_cb
                 s.request_handler = request_handler
 
+            def for_message(s, progress_cb, **extra):
+                return Executor(progress_cb, s.request_handler, **extra)
+
             async def execute(
                 s, path, body, extra_options=None, allow_ws_only=False, request_future=None
             ):
@@ -117,6 +129,20 @@ describe "WSHandler and CommandHandler":
                     }
                 )
 
+    async it "WSHandler uses one executor for each connection", make_wrapper:
+        commander = self.make_commander(WSHandler, do_allow_ws_only=True)
+
+        async with make_wrapper(commander) as server:
+            async with server.ws_stream() as stream:
+                for _ in range(3):
+                    message_id = await stream.start("/v1/somewhere", {"command": "one"})
+                    for _ in range(2):
+                        await stream.check_reply(mock.ANY, message_id=message_id)
+                    reply = await stream.check_reply(mock.ANY, message_id=message_id)
+                    assert reply["message_id"] == message_id
+
+        assert len(commander.executor.mock_calls) == 1
+
     async it "CommandHandler calls out to commander.execute", make_wrapper:
         commander = self.make_commander(CommandHandler, do_allow_ws_only=False)
 
@@ -133,6 +159,7 @@ describe "WSHandler and CommandHandler":
         executor = mock.Mock(name="executor")
         executor.execute = pytest.helpers.AsyncMock(name="execute")
         executor.execute.side_effect = NoSuchPath(wanted="/v1/other", available=["/v1/somewhere"])
+        executor.for_message.return_value = executor
         commander.executor = mock.Mock(name="executor()", return_value=executor)
 
         async with make_wrapper(commander) as server:
@@ -159,3 +186,532 @@ describe "WSHandler and CommandHandler":
                         "available": ["/v1/somewhere"],
                     }
                 )
+
+    async it "uses the executor of a custom commander for websocket messages", make_wrapper:
+        store = Store(default_path="/v1/somewhere", formatter=MergedOptionStringFormatter)
+
+        @store.command("one")
+        class One(store.Command):
+            async def execute(self):
+                return {"done": True}
+
+        called = []
+
+        class CustomExecutor(Executor):
+            async def execute(self, path, body, *args, **kwargs):
+                called.append((self.progress_cb, body))
+                result = await super().execute(path, body, *args, **kwargs)
+                return {**result, "custom": True}
+
+        class CustomCommander(Commander):
+            def executor(self, progress_cb, request_handler, **extra_options):
+                return CustomExecutor(self, progress_cb, request_handler, extra_options)
+
+        commander = CustomCommander(store)
+
+        async with make_wrapper(commander) as server:
+            async with server.ws_stream() as stream:
+                for _ in range(2):
+                    message_id = await stream.start("/v1/somewhere", {"command": "one"})
+                    reply = await stream.check_reply(mock.ANY, message_id=message_id)
+                    assert reply == {"done": True, "custom": True}
+
+        assert [body for _, body in called] == [{"command": "one"}, {"command": "one"}]
+        assert all(progress_cb is not None for progress_cb, _ in called)
+        assert called[0][0] is not called[1][0]
+
+
+describe "metrics":
+    async it "records metrics for commands and replies", server_wrapper, final_future:
+        metrics = Metrics()
+        store = Store(default_path="/v1/somewhere", formatter=MergedOptionStringFormatter)
+
+        @store.command("one")
+        class One(store.Command):
+            progress_cb = store.injected("progress_cb")
+
+            async def execute(self):
+                self.progress_cb("hello")
+                return {"one": True}
+
+        @store.command("two")
+        class Two(store.Command):
+            async def execute(self):
+                raise ValueError("NOPE")
+
+        commander = Commander(store, whirlwind_metrics=metrics)
+
+        def tornado_routes(server):
+            return [
+                (
+                    "/v1/ws",
+                    WSHandler,
+                    {
+                        "commander": commander,
+                        "server_time": None,
+                        "final_future": final_future,
+                        "wsconnections": server.wsconnections,
+                    },
+                ),
+                ("/v1/somewhere", CommandHandler, {"commander": commander}),
+                ("/metrics", MetricsHandler, {"metrics": metrics}),
+            ]
+
+        async with server_wrapper(None, tornado_routes) as server:
+            await server.assertHTTP(
+                "PUT", "/v1/somewhere", {"json": {"command": "one"}}, json_output={"one": True}
+            )
+            await server.assertHTTP("PUT", "/v1/somewhere", {"json": {"command": "two"}}, status=500)
+
+            async with server.ws_stream(gives_server_time=False) as stream:
+                assert metrics.gauge("whirlwind_websocket_connections", "").get() == 1
+                message_id = await stream.start("/v1/somewhere", {"command": "one"})
+                await stream.check_reply({"progress": {"info": "hello"}}, message_id=message_id)
+                await stream.check_reply({"one": True}, message_id=message_id)
+
+                message_id = await stream.start("/v1/somewhere", {"command": "nope"})
+                await stream.check_reply(mock.ANY, message_id=message_id)
+
+            exposition = await server.assertHTTP("GET", "/metrics", {})
+
+        exposition = exposition.decode()
+        for line in [
+            'whirlwind_commands_total{path="/v1/somewhere",command="one",outcome="success"} 2',
+            'whirlwind_commands_total{path="/v1/somewhere",command="two",outcome="error"} 1',
+            'whirlwind_command_duration_seconds_count{path="/v1/somewhere",command="one"} 2',
+            'whirlwind_commands_in_flight{path="/v1/somewhere",command="one"} 0',
+            'whirlwind_errors_total{error_code="InternalServerError",status="500"} 2',
+            'whirlwind_progress_messages_total{transport="http"} 1',
+            'whirlwind_progress_messages_total{transport="websocket"} 1',
+            "whirlwind_invalid_requests_total 1",
+            "whirlwind_websocket_connections 0",
+            "whirlwind_websocket_messages_in_flight 0",
+        ]:
+            assert line in exposition.split("\n")
+
+        assert metrics.counter("whirlwind_reply_bytes_total", "").get(transport="http") > 0
+        assert metrics.counter("whirlwind_reply_bytes_total", "").get(transport="websocket") > 0
+
+describe "deadlines":
+    async it "can be given a timeout by the request", server_wrapper, final_future:
+        store = Store(default_path="/v1/somewhere", formatter=MergedOptionStringFormatter)
+
+        @store.command("sleep")
+        class Sleep(store.Command):
+            async def execute(self):
+                await asyncio.sleep(1)
+                return {"slept": True}
+
+        commander = Commander(store)
+
+        def tornado_routes(server):
+            return [
+                (
+                    "/v1/ws",
+                    WSHandler,
+                    {
+                        "commander": commander,
+                        "server_time": None,
+                        "final_future": final_future,
+                        "wsconnections": server.wsconnections,
+                    },
+                ),
+                ("/v1/somewhere", CommandHandler, {"commander": commander}),
+            ]
+
+        cancelled = {
+            "status": 500,
+            "error": "Request took longer than 0.05 seconds",
+            "error_code": "RequestCancelled",
+        }
+
+        async with server_wrapper(None, tornado_routes) as server:
+            await server.assertHTTP(
+                "PUT",
+                "/v1/somewhere",
+                {"json": {"command": "sleep"}, "headers": {"X-Whirlwind-Timeout": "0.05"}},
+                status=500,
+                json_output=cancelled,
+            )
+
+            for bad in ("soon", "nan", "inf", "0", "-1"):
+                await server.assertHTTP(
+                    "PUT",
+                    "/v1/somewhere",
+                    {"json": {"command": "sleep"}, "headers": {"X-Whirlwind-Timeout": bad}},
+                    status=400,
+                    json_output={
+                        "status": 400,
+                        "error": (
+                            "X-Whirlwind-Timeout must be a finite number of seconds more than zero"
+                        ),
+                    },
+                )
+
+            async with server.ws_stream(gives_server_time=False) as stream:
+                await stream.ws.send_json(
+                    {
+                        "path": "/v1/somewhere",
+                        "message_id": "one",
+                        "body": {"command": "sleep"},
+                        "timeout": 0.05,
+                    }
+                )
+                await stream.check_reply(cancelled, message_id="one")
+
+                for bad in ("nan", float("inf"), 0, -1, "soon"):
+                    await stream.ws.send_str(
+                        json.dumps(
+                            {
+                                "path": "/v1/somewhere",
+                                "message_id": "two",
+                                "body": {"command": "sleep"},
+                                "timeout": bad,
+                            }
+                        )
+                    )
+                    res = await stream.ws.receive_json()
+                    assert res["message_id"] is None
+                    assert res["reply"]["error_code"] == "InvalidMessage"
+
+describe "progress policies":
+    async it "can throttle progress for a command or a connection", server_wrapper, final_future:
+        store = Store(default_path="/v1/somewhere", formatter=MergedOptionStringFormatter)
+
+        @store.command("chatty", progress=Coalesce(10))
+        class Chatty(store.Command):
+            progress_cb = store.injected("progress_cb")
+
+            async def execute(self):
+                for i in range(100):
+                    self.progress_cb({"i": i})
+                return {"done": "talking"}
+
+        @store.command("normal")
+        class Normal(store.Command):
+            progress_cb = store.injected("progress_cb")
+
+            async def execute(self):
+                for i in range(3):
+                    self.progress_cb({"i": i})
+                return {"done": "normal"}
+
+        commander = Commander(store)
+
+        def tornado_routes(server):
+            options = {
+                "commander": commander,
+                "server_time": None,
+                "final_future": final_future,
+                "wsconnections": server.wsconnections,
+            }
+            return [
+                ("/v1/ws", WSHandler, options),
+                ("/v1/batched", WSHandler, {**options, "progress_policy": Batch(size=2)}),
+            ]
+
+        async with server_wrapper(None, tornado_routes) as server:
+            async with server.ws_stream(gives_server_time=False) as stream:
+                await stream.start("/v1/somewhere", {"command": "chatty"})
+                await stream.check_reply({"progress": {"i": 0}})
+                await stream.check_reply({"progress": {"i": 99}})
+                await stream.check_reply({"done": "talking"})
+
+                await stream.start("/v1/somewhere", {"command": "normal"})
+                for i in range(3):
+                    await stream.check_reply({"progress": {"i": i}})
+                await stream.check_reply({"done": "normal"})
+
+            async with server.ws_stream(path="/v1/batched", gives_server_time=False) as stream:
+                await stream.start("/v1/somewhere", {"command": "normal"})
+                await stream.check_reply(
+                    {"batch": [{"progress": {"i": 0}}, {"progress": {"i": 1}}]}
+                )
+                await stream.check_reply({"batch": [{"progress": {"i": 2}}]})
+                await stream.check_reply({"done": "normal"})
+
+describe "streaming results":
+
+    @pytest.fixture()
+    def streaming(self, server_wrapper, final_future):
+        store = Store(default_path="/v1/somewhere", formatter=MergedOptionStringFormatter)
+        closed = []
+
+        @store.command("rows")
+        class Rows(store.Command):
+            progress_cb = store.injected("progress_cb")
+
+            async def execute(self):
+                self.progress_cb("starting")
+                try:
+                    for i in range(3):
+                        await asyncio.sleep(0)
+                        yield {"row": i}
+                finally:
+                    closed.append("rows")
+
+        @store.command("plain")
+        class Plain(store.Command):
+            async def execute(self):
+                return (i * 2 for i in range(3))
+
+        @store.command("breaks")
+        class Breaks(store.Command):
+            async def execute(self):
+                yield {"row": 0}
+                raise ValueError("NOPE")
+
+        @store.command("stalls")
+        class Stalls(store.Command):
+            async def execute(self):
+                yield {"row": 0}
+                await asyncio.sleep(10)
+                yield {"row": 1}
+
+        commander = Commander(store)
+
+        def tornado_routes(server):
+            return [
+                (
+                    "/v1/ws",
+                    WSHandler,
+                    {
+                        "commander": commander,
+                        "server_time": None,
+                        "final_future": final_future,
+                        "wsconnections": server.wsconnections,
+                    },
+                ),
+                ("/v1/somewhere", CommandHandler, {"commander": commander}),
+            ]
+
+        return server_wrapper(None, tornado_routes), closed
+
+    @pytest.fixture()
+    def error(self):
+        return {
+            "status": 500,
+            "error": "Internal Server Error",
+            "error_code": "InternalServerError",
+        }
+
+    async it "streams over http as a json list or lines of json", streaming, error:
+        wrapper, closed = streaming
+
+        async with wrapper as server:
+            await server.assertHTTP(
+                "PUT",
+                "/v1/somewhere",
+                {"json": {"command": "rows"}},
+                json_output=[{"row": 0}, {"row": 1}, {"row": 2}],
+            )
+            assert closed == ["rows"]
+
+            await server.assertHTTP(
+                "PUT", "/v1/somewhere", {"json": {"command": "plain"}}, json_output=[0, 2, 4]
+            )
+
+            await server.assertHTTP(
+                "PUT",
+                "/v1/somewhere",
+                {"json": {"command": "breaks"}},
+                json_output=[{"row": 0}, error],
+            )
+
+            async with aiohttp.ClientSession() as session:
+                async with session.put(
+                    f"http://127.0.0.1:{server.port}/v1/somewhere",
+                    json={"command": "rows"},
+                    headers={"Accept": "application/x-ndjson"},
+                ) as res:
+                    assert res.status == 200
+                    assert res.headers["Content-Type"].startswith("application/x-ndjson")
+                    lines = [json.loads(line) async for line in res.content]
+
+            assert lines == [{"row": 0}, {"row": 1}, {"row": 2}]
+
+    async it "cuts off a stream that takes longer than the timeout", streaming:
+        wrapper, closed = streaming
+
+        async with wrapper as server:
+            start = time.time()
+            await server.assertHTTP(
+                "PUT",
+                "/v1/somewhere",
+                {"json": {"command": "stalls"}, "headers": {"X-Whirlwind-Timeout": "0.1"}},
+                json_output=[
+                    {"row": 0},
+                    {
+                        "status": 500,
+                        "error": "Request took longer than 0.1 seconds",
+                        "error_code": "RequestCancelled",
+                    },
+                ],
+            )
+            assert time.time() - start < 5
+
+    async it "streams over a websocket as replies followed by done", streaming, error:
+        wrapper, closed = streaming
+
+        async with wrapper as server:
+            async with server.ws_stream(gives_server_time=False) as stream:
+                await stream.start("/v1/somewhere", {"command": "rows"})
+                await stream.check_reply({"progress": {"info": "starting"}})
+                for i in range(3):
+                    await stream.check_reply({"row": i})
+                await stream.check_reply({"done": True})
+                assert closed == ["rows"]
+
+                await stream.start("/v1/somewhere", {"command": "breaks"})
+                await stream.check_reply({"row": 0})
+                await stream.check_reply(error)
+
+describe "request bodies":
+
+    @pytest.fixture()
+    def bodies(self, server_wrapper):
+        store = Store(default_path="/v1/somewhere", formatter=MergedOptionStringFormatter)
+
+        @store.command("echo")
+        class Echo(store.Command):
+            data = dictobj.Field(sb.string_spec, default="")
+
+            async def execute(self):
+                return {"length": len(self.data)}
+
+        @store.command("echo", path="/v1/unlimited")
+        class Echo2(Echo):
+            pass
+
+        @store.command("files")
+        class Files(store.Command):
+            request_handler = store.injected("request_handler")
+
+            async def execute(self):
+                request = self.request_handler.request
+                return {"files": sorted(request.files), "body": len(request.body) > 0}
+
+        class Posting(LimitedCommandHandler):
+            def prepare(s):
+                pass
+
+            async def do_post(s):
+                return {"posted": s.body_as_json()}
+
+        commander = Commander(store)
+
+        def tornado_routes(server):
+            return [
+                (
+                    "/v1/somewhere",
+                    LimitedCommandHandler,
+                    {"commander": commander, "max_body_size": 1000},
+                ),
+                ("/v1/unlimited", LimitedCommandHandler, {"commander": commander}),
+                ("/v1/posting", Posting, {"commander": commander, "max_body_size": 100}),
+            ]
+
+        return server_wrapper(None, tornado_routes)
+
+    async it "parses the body it streamed in", bodies:
+        async with bodies as server:
+            await server.assertHTTP(
+                "PUT",
+                "/v1/somewhere",
+                {"json": {"command": "echo", "args": {"data": "a" * 500}}},
+                json_output={"length": 500},
+            )
+
+            form = aiohttp.FormData()
+            form.add_field(
+                "__body__",
+                json.dumps({"command": "echo", "args": {"data": "bb"}}),
+                filename="blob",
+                content_type="application/json",
+            )
+            await server.assertHTTP(
+                "PUT", "/v1/somewhere", {"data": form}, json_output={"length": 2}
+            )
+
+            form = aiohttp.FormData()
+            form.add_field("__body__", json.dumps({"command": "files"}), filename="blob")
+            form.add_field("attachment", b"stuff", filename="stuff.txt")
+            await server.assertHTTP(
+                "PUT",
+                "/v1/somewhere",
+                {"data": form},
+                json_output={"files": ["__body__", "attachment"], "body": True},
+            )
+
+            await server.assertHTTP(
+                "PUT",
+                "/v1/unlimited",
+                {"json": {"command": "echo", "args": {"data": "a" * 5000}}},
+                json_output={"length": 5000},
+            )
+
+            await server.assertHTTP(
+                "POST", "/v1/posting", {"json": {"one": 1}}, json_output={"posted": {"one": 1}}
+            )
+
+    async it "refuses bodies that are too large", bodies:
+        async with bodies as server:
+            await server.assertHTTP(
+                "PUT",
+                "/v1/somewhere",
+                {"json": {"command": "echo", "args": {"data": "a" * 5000}}},
+                status=413,
+                json_output={"status": 413, "error": "Body is too large", "max_body_size": 1000},
+            )
+
+            async def chunks():
+                yield b'{"command": "echo", "args": {"data": "'
+                for _ in range(10):
+                    yield b"a" * 200
+                yield b'"}}'
+
+            # Tornado stops reading a body without a Content-Length once it is too big
+            async with aiohttp.ClientSession() as session:
+                try:
+                    async with session.put(
+                        f"http://127.0.0.1:{server.port}/v1/somewhere", data=chunks()
+                    ) as res:
+                        status = res.status
+                except aiohttp.ClientError:
+                    status = None
+            assert status in (400, None)
+
+    async it "limits bodies when prepare is overridden", bodies:
+        async with bodies as server:
+            await server.assertHTTP(
+                "POST",
+                "/v1/posting",
+                {"json": {"data": "a" * 500}},
+                status=413,
+                json_output={"status": 413, "error": "Body is too large", "max_body_size": 100},
+            )
+
+            sent = []
+
+            async def chunks():
+                for _ in range(50):
+                    sent.append(True)
+                    yield b"a" * 50
+                    await asyncio.sleep(0.01)
+
+            # The handler replies as soon as the body is too large
+            async with aiohttp.ClientSession() as session:
+                try:
+                    async with session.post(
+                        f"http://127.0.0.1:{server.port}/v1/posting", data=chunks()
+                    ) as res:
+                        status = res.status
+                        assert await res.json() == {
+                            "status": 413,
+                            "error": "Body is too large",
+                            "max_body_size": 100,
+                        }
+                except aiohttp.ClientError:
+                    status = None
+            assert status in (413, None)
+            assert len(sent) < 50
@@ -11,6 +11,7 @@ from delfick_project.norms import dictobj, sb
 from unittest import mock
 import asyncio
 import pytest
+import json
 import time
 import uuid
 
@@ -163,6 +164,22 @@ class Echo3(Echo):
     pass
 
 
+@store.command("timed", timeout=0.2)
+class Timed(store.Command):
+    progress_cb = store.injected("progress_cb")
+
+    async def execute(self, messages):
+        self.progress_cb("started")
+        async for message in messages:
+            await message.process()
+
+
+@store.command("slow", parent=Timed)
+class Slow(store.Command):
+    async def execute(self):
+        await asyncio.sleep(1)
+
+
 class MessageFromExc(MessageFromExc):
     def process(self, exc_type, exc, tb):
         if hasattr(exc, "as_dict"):
@@ -407,3 +424,26 @@ describe "Interactive commands":
                 message_id=[message_id, child_message_id],
             )
             await stream.check_reply({"error_code": "Exception", "error": "SAD"})
+
+    async it "gives children the deadline of their parent", server:
+        async with server.ws_stream() as stream:
+            start = time.time()
+            await stream.start("/v1", {"command": "timed"})
+            message_id = stream.message_id
+            await stream.check_reply({"progress": {"info": "started"}})
+
+            child_message_id = str(uuid.uuid1())
+            await stream.start(
+                "/v1", {"command": "slow"}, message_id=[message_id, child_message_id]
+            )
+
+            got = {}
+            for _ in range(2):
+                reply = await stream.ws.receive_json()
+                got[json.dumps(reply["message_id"])] = reply["reply"]["error_code"]
+
+            assert time.time() - start < 0.5
+            assert got == {
+                json.dumps(message_id): "DeadlineExceeded",
+                json.dumps([message_id, child_message_id]): "DeadlineExceeded",
+            }
@@ -0,0 +1,152 @@
+# coding: spec
+
+from whirlwind.request_handlers.base import SimpleWebSocketBase, json_framing, MsgpackFraming
+from whirlwind.broadcast import Topics
+from whirlwind.metrics import Metrics
+
+from tornado.websocket import WebSocketClosedError
+from unittest import mock
+import asyncio
+import msgpack
+import time
+
+
+class FakeHandler:
+    def __init__(self, framing=json_framing):
+        self.framing = framing
+        self.written = []
+        self.futures = []
+        self.closed = False
+        self.connection_future = asyncio.Future()
+
+    def write_message(self, frame, binary=False):
+        if self.closed:
+            raise WebSocketClosedError()
+        fut = asyncio.Future()
+        self.futures.append(fut)
+        self.written.append((frame, binary))
+        return fut
+
+    def flush(self):
+        for fut in self.futures:
+            if not fut.done():
+                fut.set_result(None)
+
+
+describe "Topics":
+    async it "serialises once for each framing":
+        topics = Topics()
+
+        one = FakeHandler()
+        two = FakeHandler()
+        three = FakeHandler(MsgpackFraming())
+
+        for handler in (one, two, three):
+            topics.subscribe(handler, "dashboard")
+        topics.subscribe(one, "other")
+
+        with mock.patch.object(json_framing, "dumps", wraps=json_framing.dumps) as dumps:
+            assert topics.publish("dashboard", {"cpu": 0.5}) == 3
+
+        assert len(dumps.mock_calls) == 1
+
+        expected = {"reply": {"cpu": 0.5}, "message_id": "__topic__", "topic": "dashboard"}
+        frame = b'{"reply": {"cpu": 0.5}, "message_id": "__topic__", "topic": "dashboard"}'
+        assert one.written == [(frame, False)]
+        assert one.written[0][0] is two.written[0][0]
+        assert msgpack.unpackb(three.written[0][0]) == expected
+        assert three.written[0][1] is True
+
+        assert topics.publish("nobody", {"cpu": 0.5}) == 0
+        assert topics.publish("other", "hi") == 1
+        assert len(one.written) == 2
+        assert len(two.written) == 1
+
+    async it "drops messages for subscribers that are too far behind":
+        metrics = Metrics()
+        topics = Topics(max_pending=2, metrics=metrics)
+
+        slow = FakeHandler()
+        fast = FakeHandler()
+        topics.subscribe(slow, "t")
+        topics.subscribe(fast, "t")
+
+        for i in range(4):
+            fast.flush()
+            await asyncio.sleep(0)
+            topics.publish("t", i)
+
+        assert len(fast.written) == 4
+        assert len(slow.written) == 2
+        assert topics.topics["t"][slow].dropped == 2
+        assert metrics.counter("whirlwind_broadcast_dropped_total", "").get() == 2
+
+        slow.flush()
+        await asyncio.sleep(0)
+        topics.publish("t", 5)
+        assert len(slow.written) == 3
+
+    async it "forgets connections that unsubscribe or finish":
+        topics = Topics()
+
+        one = FakeHandler()
+        two = FakeHandler()
+        topics.subscribe(one, "a")
+        topics.subscribe(one, "b")
+        topics.subscribe(two, "a")
+
+        topics.unsubscribe(one, "a")
+        assert list(topics.topics["a"]) == [two]
+        assert one in topics.subscribers
+
+        one.connection_future.cancel()
+        await asyncio.sleep(0)
+        assert "b" not in topics.topics
+        assert one not in topics.subscribers
+
+        two.closed = True
+        assert topics.publish("a", "hi") == 0
+        assert topics.topics == {}
+        assert topics.subscribers == {}
+
+    async it "sends to real websocket connections", server_wrapper:
+        topics = Topics()
+        final_future = asyncio.Future()
+
+        class Handler(SimpleWebSocketBase):
+            async def process_message(s, path, body, message_id, message_key, progress_cb):
+                topics.subscribe(s, body["topic"])
+                return {"subscribed": body["topic"]}
+
+        def tornado_routes(server):
+            return [
+                (
+                    "/v1/ws",
+                    Handler,
+                    {
+                        "final_future": final_future,
+                        "server_time": time.time(),
+                        "wsconnections": server.wsconnections,
+                    },
+                )
+            ]
+
+        try:
+            async with server_wrapper(None, tornado_routes) as server:
+                async with server.ws_stream() as one, server.ws_stream() as two:
+                    for stream in (one, two):
+                        await stream.start("/v1", {"topic": "news"})
+                        await stream.check_reply({"subscribed": "news"})
+
+                    assert topics.publish("news", {"headline": "</script>"}) == 2
+                    for stream in (one, two):
+                        assert await stream.ws.receive_json() == {
+                            "reply": {"headline": "</script>"},
+                            "message_id": "__topic__",
+                            "topic": "news",
+                        }
+
+            await asyncio.sleep(0.05)
+            assert topics.subscribers == {}
+        finally:
+            final_future.cancel()
@@ -1,6 +1,13 @@
 # coding: spec
 
-from whirlwind.commander import Commander
+from whirlwind.commander import (
+    Commander,
+    SlotsCommand,
+    Streaming,
+    DeadlineExceeded,
+    current_deadline,
+)
+from whirlwind.metrics import Metrics
 from whirlwind.store import Store
 
 from delfick_project.option_merge import MergedOptionStringFormatter, BadOptionFormat, MergedOptions
@@ -8,6 +15,7 @@ from delfick_project.norms import dictobj, sb, BadSpecValue
 from delfick_project.errors_pytest import assertRaises
 from unittest import mock
 import asyncio
+import pytest
 import uuid
 
 store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
@@ -176,6 +184,34 @@ describe "Commander":
 
         assert thing.request_future.done()
 
+    async it "can make an executor for each message":
+        other = mock.Mock(name="other")
+        progress_cb = mock.Mock(name="progress_cb")
+        request_handler = mock.Mock(name="request_handler")
+        commander = Commander(store, other=other)
+
+        executor = commander.executor(None, request_handler)
+        other2 = mock.Mock(name="other2")
+        message_executor = executor.for_message(progress_cb, other=other2)
+
+        assert message_executor.commander is commander
+        assert message_executor.request_handler is request_handler
+        assert message_executor.progress_cb is progress_cb
+        assert executor.progress_cb is None
+
+        value = str(uuid.uuid1())
+        thing, val = await message_executor.execute(
+            "/v1", {"command": "thing_caller", "args": {"passon": value}}
+        )
+
+        assert val == f"called! {value}"
+
+        # thing_caller uses the injected executor, which is the one for the message
+        assert thing.other is other2
+        assert thing.progress_cb is progress_cb
+        assert thing.request_handler is request_handler
+        assert thing.store is store
+
     async it "injected fields complain if they don't exist":
         store2 = store.clone()
         progress_cb = mock.Mock(name="progress_cb")
@@ -277,6 +313,272 @@ describe "Commander":
         assert val == value
         assert thing.other is other
 
+    async it "leaves options with the same names as its own arguments to commands":
+        store2 = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+        @store2.command("names")
+        class Names(store2.Command):
+            router = store2.injected("router")
+            tracer = store2.injected("tracer")
+            metrics = store2.injected("metrics")
+            default_timeout = store2.injected("default_timeout")
+
+            async def execute(self):
+                return self.router, self.tracer, self.metrics, self.default_timeout
+
+        options = {
+            "router": mock.Mock(name="router"),
+            "tracer": mock.Mock(name="tracer"),
+            "metrics": mock.Mock(name="metrics"),
+            "default_timeout": mock.Mock(name="default_timeout"),
+        }
+        metrics = Metrics()
+        commander = Commander(store2, whirlwind_metrics=metrics, **options)
+
+        assert commander.router is None
+        assert commander.tracer is None
+        assert commander.metrics is metrics
+        assert commander.default_timeout is None
+
+        got = await commander.executor(None, None).execute("/v1", {"command": "names"})
+        assert got == (
+            options["router"],
+            options["tracer"],
+            options["metrics"],
+            options["default_timeout"],
+        )
+
+        extra = {"router": options["router"], "tracer": options["tracer"]}
+        got = await Commander(store2, whirlwind_metrics=metrics).executor(None, None).execute(
+            "/v1", {"command": "names"}, {**extra, "default_timeout": options["default_timeout"]}
+        )
+        assert got == (options["router"], options["tracer"], metrics, options["default_timeout"])
+
     async it "allows commands to be retrieved from a MergedOptions":
         options = MergedOptions.using({"command": FieldsRequired}, dont_prefix=[dictobj])
         assert options["command"] is FieldsRequired
+
+describe "SlotsCommand":
+    it "keeps fields in slots instead of a dictionary":
+
+        class Thing(SlotsCommand):
+            one = dictobj.Field(sb.integer_spec)
+            two = dictobj.Field(sb.string_spec, default="two")
+
+        class Other(Thing):
+            three = dictobj.NullableField(sb.boolean)
+
+        assert Thing.__slots__ == ("one", "two")
+        assert Other.__slots__ == ("three",)
+        assert sorted(Other.fields) == ["one", "three", "two"]
+
+        other = Other.FieldSpec().empty_normalise(one=1)
+        assert isinstance(other, Other)
+        assert not hasattr(other, "__dict__")
+        assert other == {"one": 1, "two": "two", "three": None}
+        assert other.as_dict() == {"one": 1, "two": "two", "three": None}
+
+        with assertRaises(AttributeError):
+            other.four = 4
+
+    it "complains about missing or unexpected arguments":
+
+        class Thing(SlotsCommand):
+            one = dictobj.Field(sb.integer_spec)
+
+        with assertRaises(TypeError, "Thing missing keyword argument: one"):
+            Thing()
+
+        with assertRaises(TypeError, "Thing got unexpected keyword arguments: \\['two'\\]"):
+            Thing(one=1, two=2)
+
+    async it "can be used as a store command":
+        store2 = store.clone()
+
+        @store2.command("slotted")
+        class Slotted(store2.SlotsCommand):
+            path = store2.injected("path")
+            other = store2.injected("other")
+            value = dictobj.Field(sb.string_spec, wrapper=sb.required)
+
+            async def execute(self):
+                return self
+
+        other = mock.Mock(name="other")
+        progress_cb = mock.Mock(name="progress_cb")
+        request_handler = mock.Mock(name="request_handler")
+        commander = Commander(store2, other=other)
+
+        slotted = await commander.executor(progress_cb, request_handler).execute(
+            "/v1", {"command": "slotted", "args": {"value": "hello"}}
+        )
+
+        assert isinstance(slotted, Slotted)
+        assert slotted == {"path": "/v1", "other": other, "value": "hello"}
+        assert Slotted.__whirlwind_command__
+        assert not Slotted.__whirlwind_ws_only__
+
+describe "deadlines":
+
+    @pytest.fixture()
+    def V(self):
+        class V:
+            store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+            cancelled = []
+
+            @store.command("sleep")
+            class Sleep(store.Command):
+                request_future = store.injected("request_future")
+                duration = dictobj.Field(sb.float_spec, default=0.05)
+
+                async def execute(self):
+                    try:
+                        await asyncio.sleep(self.duration)
+                    except asyncio.CancelledError:
+                        V.cancelled.append(self.request_future)
+                        raise
+                    return {"slept": self.duration}
+
+            @store.command("limited", timeout=0.05)
+            class Limited(store.Command):
+                async def execute(self):
+                    await asyncio.sleep(1)
+
+            @store.command("deadline")
+            class Deadline(store.Command):
+                async def execute(self):
+                    return {"deadline": current_deadline.get()}
+
+            @store.command("calls")
+            class Calls(store.Command):
+                executor = store.injected("executor")
+
+                async def execute(self):
+                    return await self.executor.execute(
+                        "/v1", {"command": "sleep", "args": {"duration": 1}}
+                    )
+
+        return V
+
+    async it "has no deadline by default", V:
+        executor = Commander(V.store).executor(None, None)
+        assert await executor.execute("/v1", {"command": "deadline"}) == {"deadline": None}
+        assert await executor.execute("/v1", {"command": "sleep"}) == {"slept": 0.05}
+
+    async it "cancels commands that take longer than their timeout", V:
+        executor = Commander(V.store).executor(None, None)
+        with assertRaises(DeadlineExceeded, "Request took longer than 0.05 seconds"):
+            await executor.execute("/v1", {"command": "limited"})
+
+    async it "cancels commands that take longer than the request timeout", V:
+        executor = Commander(V.store).executor(None, None)
+        with assertRaises(DeadlineExceeded):
+            await executor.execute(
+                "/v1", {"command": "sleep", "args": {"duration": 1}}, timeout=0.05
+            )
+
+        assert len(V.cancelled) == 1
+        assert V.cancelled[0].done()
+
+    async it "uses the default timeout of the commander", V:
+        executor = Commander(V.store, whirlwind_default_timeout=0.05).executor(None, None)
+        with assertRaises(DeadlineExceeded):
+            await executor.execute("/v1", {"command": "sleep", "args": {"duration": 1}})
+
+        assert await executor.execute("/v1", {"command": "sleep", "args": {"duration": 0.01}}) == {
+            "slept": 0.01
+        }
+
+    async it "uses the smallest timeout", V:
+        executor = Commander(V.store, whirlwind_default_timeout=10).executor(None, None)
+
+        start = asyncio.get_event_loop().time()
+        result = await executor.execute("/v1", {"command": "deadline"}, timeout=5)
+        assert 5 <= result["deadline"] - start < 5.1
+
+        start = asyncio.get_event_loop().time()
+        result = await executor.execute("/v1", {"command": "deadline"}, timeout=20)
+        assert 10 <= result["deadline"] - start < 10.1
+
+    async it "gives nested commands the deadline of the outer command", V:
+        executor = Commander(V.store).executor(None, None)
+
+        start = asyncio.get_event_loop().time()
+        with assertRaises(DeadlineExceeded):
+            await executor.execute("/v1", {"command": "calls"}, timeout=0.05)
+        assert asyncio.get_event_loop().time() - start < 0.5
+
+    async it "doesn't turn other cancellations into a timeout", V:
+        executor = Commander(V.store).executor(None, None)
+
+        task = asyncio.get_event_loop().create_task(
+            executor.execute("/v1", {"command": "sleep", "args": {"duration": 1}}, timeout=5)
+        )
+        await asyncio.sleep(0.01)
+        task.cancel()
+
+        with assertRaises(asyncio.CancelledError):
+            await task
+
+describe "streaming":
+
+    @pytest.fixture()
+    def V(self):
+        class V:
+            store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+            @store.command("rows", timeout=0.1)
+            class Rows(store.Command):
+                request_future = store.injected("request_future")
+                stall = dictobj.Field(sb.boolean, default=False)
+
+                async def execute(self):
+                    for i in range(3):
+                        assert not self.request_future.done()
+                        yield {"row": i, "deadline": current_deadline.get()}
+                    if self.stall:
+                        await asyncio.sleep(1)
+
+        return V
+
+    async it "makes the items within the scope the command was executed in", V:
+        metrics = Metrics()
+        executor = Commander(V.store, whirlwind_metrics=metrics).executor(None, None)
+        in_flight = metrics.gauge("whirlwind_commands_in_flight", "")
+        labels = {"path": "/v1", "command": "rows"}
+
+        stream = await executor.execute("/v1", {"command": "rows"})
+        assert isinstance(stream, Streaming)
+        assert in_flight.get(**labels) == 1
+
+        rows = [row async for row in stream]
+        assert [row["row"] for row in rows] == [0, 1, 2]
+        assert all(row["deadline"] is not None for row in rows)
+        assert in_flight.get(**labels) == 0
+        assert "whirlwind_commands_total" in metrics.exposition()
+
+    async it "cuts off a stream that takes longer than the deadline", V:
+        metrics = Metrics()
+        executor = Commander(V.store, whirlwind_metrics=metrics).executor(None, None)
+
+        stream = await executor.execute("/v1", {"command": "rows", "args": {"stall": True}})
+
+        rows = []
+        with assertRaises(DeadlineExceeded):
+            async for row in stream:
+                rows.append(row["row"])
+
+        assert rows == [0, 1, 2]
+        assert 'outcome="timeout"' in metrics.exposition()
+
+    async it "finishes the scope when the stream is closed early", V:
+        metrics = Metrics()
+        executor = Commander(V.store, whirlwind_metrics=metrics).executor(None, None)
+
+        stream = await executor.execute("/v1", {"command": "rows"})
+        await stream.__anext__()
+        await stream.aclose()
+
+        in_flight = metrics.gauge("whirlwind_commands_in_flight", "")
+        assert in_flight.get(path="/v1", command="rows") == 0
+        assert 'outcome="success"' in metrics.exposition()
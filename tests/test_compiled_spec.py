@@ -0,0 +1,138 @@
+# coding: spec
+
+from whirlwind.compiled_spec import CompiledFieldSpec, is_passed_through
+from whirlwind.store import Store
+
+from delfick_project.option_merge import MergedOptionStringFormatter, MergedOptions
+from delfick_project.option_merge.formatter import BadOptionFormat
+from delfick_project.norms import dictobj, sb, Meta, BadSpecValue
+from unittest import mock
+import pytest
+
+
+class Thing:
+    _merged_options_formattable = True
+
+
+@pytest.fixture()
+def store():
+    return Store(formatter=MergedOptionStringFormatter)
+
+
+@pytest.fixture()
+def Command(store):
+    class Command(store.Command):
+        one = dictobj.Field(sb.string_spec, wrapper=sb.required)
+        two = dictobj.Field(sb.integer_spec, default=3)
+        three = dictobj.NullableField(sb.boolean)
+        four = dictobj.Field(sb.listof(sb.string_spec()))
+        five = dictobj.Field(sb.float_spec, help="a float")
+        six = dictobj.Field(sb.any_spec)
+        seven = dictobj.Field(sb.string_spec)
+
+        thing = store.injected("thing")
+        cb = store.injected("progress_cb", nullable=True)
+        options = store.injected("options", nullable=True)
+
+    return Command
+
+
+def normalise(spec, meta, args):
+    try:
+        return spec.normalise(meta, args).as_dict()
+    except BadSpecValue as error:
+        return error.as_dict()
+    except BadOptionFormat as error:
+        return str(error)
+
+
+describe "CompiledFieldSpec":
+    it "only compiles what it knows about", Command:
+        spec = CompiledFieldSpec(Command, formatter=MergedOptionStringFormatter)
+        assert "normalise(meta.at('four'), v)" in spec.source
+        assert "meta.at('one')" not in spec.source
+        assert "everything['thing']" in spec.source
+
+    it "normalises the same as the FieldSpec", Command:
+        compiled = CompiledFieldSpec(Command, formatter=MergedOptionStringFormatter)
+        field_spec = Command.FieldSpec(formatter=MergedOptionStringFormatter)
+
+        thing = Thing()
+        progress_cb = lambda msg, **kwargs: None
+        metas = [
+            Meta(MergedOptions.using({"thing": thing, "progress_cb": progress_cb}), []),
+            Meta({"thing": thing, "options": {"a": 1}}, []),
+            Meta({"thing": object()}, []),
+            Meta({}, []),
+        ]
+
+        argss = [
+            sb.NotSpecified,
+            {},
+            {"one": "a"},
+            {"one": "a", "two": 4, "three": True, "four": "b", "five": 1, "six": [1]},
+            {"one": "a", "two": "12", "three": None, "five": 1.5, "seven": "s"},
+            {"one": 1, "two": True, "three": "no", "five": "2.5", "seven": 3},
+            {"one": "a", "two": None, "five": True},
+            {"one": "a", "four": [1]},
+            [],
+        ]
+
+        for meta in metas:
+            for args in argss:
+                m = meta.at("args")
+                assert normalise(compiled, m, args) == normalise(field_spec, m, args), args
+
+    it "only passes through objects that are marked for it":
+        assert is_passed_through(None)
+        assert is_passed_through(Thing())
+        assert is_passed_through(lambda: 1)
+        assert is_passed_through("a".upper)
+
+        assert not is_passed_through(object())
+        assert not is_passed_through("{other}")
+        assert not is_passed_through(mock.Mock(name="thing", spec=[]))
+
+    it "doesn't inject objects that would be formatted further", Command:
+        compiled = CompiledFieldSpec(Command, formatter=MergedOptionStringFormatter)
+        compiled.field_spec = mock.Mock(name="field_spec")
+
+        meta = Meta({"thing": "{other}", "other": Thing()}, [])
+        assert compiled.normalise(meta, {"one": "a"}) is compiled.field_spec.normalise.return_value
+
+    it "doesn't inject with a formatter that might behave differently", Command:
+
+        class Formatter(MergedOptionStringFormatter):
+            def get_string(s, key):
+                return Thing()
+
+        compiled = CompiledFieldSpec(Command, formatter=Formatter)
+        assert "everything['thing']" not in compiled.source
+
+    it "falls back to the FieldSpec if it can't make the spec":
+
+        class Command(dictobj.Spec):
+            thing = dictobj.Field(sb.string_spec, formatted=True)
+
+        compiled = CompiledFieldSpec(Command)
+        assert compiled.fast is None
+        with pytest.raises(Exception):
+            compiled.normalise(Meta.empty(), {"thing": "a"})
+
+describe "store.command(compiled=True)":
+    async it "uses the compiled spec", store:
+        thing = Thing()
+
+        @store.command("compiled", compiled=True)
+        class Compiled(store.Command):
+            number = dictobj.Field(sb.integer_spec, wrapper=sb.required)
+            thing = store.injected("thing")
+
+            async def execute(self):
+                return self.number, self.thing
+
+        assert isinstance(store.paths["/v1"]["compiled"]["spec"], CompiledFieldSpec)
+
+        meta = Meta({"thing": thing}, [])
+        val = {"path": "/v1", "body": {"command": "compiled", "args": {"number": 2}}}
+        assert await store.command_spec.normalise(meta, val)() == (2, thing)
@@ -0,0 +1,42 @@
+# coding: spec
+
+from whirlwind.connections import Connections
+from whirlwind.server import Server
+
+import asyncio
+
+describe "Connections":
+    async it "is shared by everything with the same final_future":
+        final_future = asyncio.Future()
+        connections = Connections.of(final_future)
+        assert Connections.of(final_future) is connections
+        assert Connections.of(asyncio.Future()) is not connections
+        assert Server(final_future).connections is connections
+        assert len(final_future._callbacks) == 1
+
+    async it "forgets connections that are finished":
+        final_future = asyncio.Future()
+        connections = Connections.of(final_future)
+
+        futs = [asyncio.Future() for _ in range(3)]
+        for fut in futs:
+            connections.add(fut)
+        assert len(connections) == 3
+
+        futs[1].set_result(None)
+        await asyncio.sleep(0)
+        assert len(connections) == 2
+        assert futs[1] not in connections
+        assert len(final_future._callbacks) == 1
+
+        final_future.cancel()
+        await asyncio.sleep(0)
+        assert len(connections) == 0
+        assert futs[0].cancelled()
+        assert futs[2].cancelled()
+        assert not futs[1].cancelled()
+
+        late = asyncio.Future()
+        connections.add(late)
+        assert late.cancelled()
+        assert len(connections) == 0
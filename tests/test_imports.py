@@ -0,0 +1,53 @@
+# coding: spec
+
+import subprocess
+import whirlwind
+import pytest
+import json
+import sys
+
+
+def modules_after(code):
+    check = f"{code}\nimport sys, json\nprint(json.dumps(sorted(sys.modules)))"
+    res = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True)
+    return json.loads(res.stdout)
+
+
+describe "importing whirlwind":
+    it "does not import tornado for the store":
+        modules = modules_after("import whirlwind\nfrom whirlwind import Store, Commander")
+        assert "whirlwind.store" in modules
+        assert "whirlwind.commander" in modules
+        assert not [m for m in modules if m.startswith("tornado")]
+        assert "whirlwind.server" not in modules
+        assert "whirlwind.request_handlers" not in modules
+
+    it "imports the server when it is asked for":
+        modules = modules_after("from whirlwind import Server")
+        assert "whirlwind.server" in modules
+        assert "tornado.web" in modules
+
+    it "provides the public names":
+        from whirlwind.commander import Commander, Command, SlotsCommand
+        from whirlwind.server import Server
+        from whirlwind.store import Store
+        from whirlwind import request_handlers
+
+        assert whirlwind.Commander is Commander
+        assert whirlwind.Command is Command
+        assert whirlwind.SlotsCommand is SlotsCommand
+        assert whirlwind.Server is Server
+        assert whirlwind.Store is Store
+        assert whirlwind.request_handlers is request_handlers
+
+        for name in whirlwind.__all__:
+            assert name in dir(whirlwind)
+
+    it "complains about unknown names":
+        with pytest.raises(AttributeError):
+            whirlwind.Nope
+
+    it "keeps the helpers for lazy imports private":
+        public = [name for name in dir(whirlwind) if not name.startswith("_")]
+        assert "lazy" not in public
+        assert "importlib" not in public
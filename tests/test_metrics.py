@@ -0,0 +1,113 @@
+# coding: spec
+
+from whirlwind.metrics import Metrics, MetricMismatch, no_metrics, command_metrics
+
+from delfick_project.errors_pytest import assertRaises
+import asyncio
+
+describe "Metrics":
+    it "returns the same metric for the same name":
+        metrics = Metrics()
+        counter = metrics.counter("things_total", "Things", ("path",))
+        assert metrics.counter("things_total", "Things", ("path",)) is counter
+        assert metrics.metrics == {"things_total": counter}
+
+    it "complains if a name is used for a different kind of metric":
+        metrics = Metrics()
+        metrics.counter("things", "Things")
+        with assertRaises(MetricMismatch, "Metric things is a counter, not a gauge"):
+            metrics.gauge("things", "Things")
+
+    it "can count":
+        metrics = Metrics()
+        counter = metrics.counter("things_total", "Things", ("path",))
+        counter.inc(path="/one")
+        counter.inc(2, path="/one")
+        counter.inc(path="/two")
+
+        assert counter.get(path="/one") == 3
+        assert counter.get(path="/two") == 1
+        assert counter.get(path="/three") == 0
+
+    it "can have gauges":
+        metrics = Metrics()
+        gauge = metrics.gauge("running", "Running")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        assert gauge.get() == 1
+        gauge.set(20)
+        assert gauge.get() == 20
+        assert metrics.exposition() == (
+            "# HELP running Running\n"
+            "# TYPE running gauge\n"
+            "running 20\n"
+        )
+
+    it "can have histograms":
+        metrics = Metrics()
+        histogram = metrics.histogram("took", "Took", ("path",), buckets=(0.1, 1))
+        histogram.observe(0.05, path="/one")
+        histogram.observe(0.1, path="/one")
+        histogram.observe(0.5, path="/one")
+        histogram.observe(3, path="/one")
+
+        got = histogram.get(path="/one")
+        assert got.buckets == [2, 1, 1]
+        assert got.count == 4
+        assert got.sum == 3.65
+
+        assert metrics.exposition() == (
+            "# HELP took Took\n"
+            "# TYPE took histogram\n"
+            'took_bucket{path="/one",le="0.1"} 2\n'
+            'took_bucket{path="/one",le="1"} 3\n'
+            'took_bucket{path="/one",le="+Inf"} 4\n'
+            'took_sum{path="/one"} 3.65\n'
+            'took_count{path="/one"} 4\n'
+        )
+
+    it "escapes label values":
+        metrics = Metrics()
+        metrics.counter("things_total", "Things", ("name",)).inc(name='a"b\\c\nd')
+        assert metrics.exposition() == (
+            "# HELP things_total Things\n"
+            "# TYPE things_total counter\n"
+            'things_total{name="a\\"b\\\\c\\nd"} 1\n'
+        )
+
+    it "has a registry that records nothing":
+        counter = no_metrics.counter("things_total", "Things", ("path",))
+        counter.inc(path="/one")
+        no_metrics.gauge("g", "G").set(1)
+        no_metrics.histogram("h", "H").observe(1)
+        assert counter.get(path="/one") is None
+        assert no_metrics.exposition() == ""
+
+describe "command_metrics":
+    it "records what happens to the command":
+        metrics = Metrics()
+        labels = {"path": "/v1", "command": "thing"}
+
+        with command_metrics(metrics, "/v1", "thing"):
+            assert metrics.gauge("whirlwind_commands_in_flight", "").get(**labels) == 1
+            assert "whirlwind_interactive_children" not in metrics.metrics
+
+        assert metrics.gauge("whirlwind_commands_in_flight", "").get(**labels) == 0
+
+        with assertRaises(ValueError):
+            with command_metrics(metrics, "/v1", "thing", child=True):
+                assert metrics.gauge("whirlwind_interactive_children", "").get(**labels) == 1
+                raise ValueError("nope")
+
+        assert metrics.gauge("whirlwind_interactive_children", "").get(**labels) == 0
+
+        with assertRaises(asyncio.CancelledError):
+            with command_metrics(metrics, "/v1", "thing"):
+                raise asyncio.CancelledError()
+
+        total = metrics.counter("whirlwind_commands_total", "")
+        for outcome in ("success", "error", "cancelled"):
+            assert total.get(outcome=outcome, **labels) == 1
+
+        assert metrics.histogram("whirlwind_command_duration_seconds", "").get(**labels).count == 3
@@ -0,0 +1,129 @@
+# coding: spec
+
+from whirlwind.monitor import LoopMonitor, Culprit, find_culprit, nobody
+from whirlwind.commander import Commander
+from whirlwind.metrics import Metrics
+from whirlwind.store import Store
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+import asyncio
+import time
+import sys
+
+store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+
+@store.command("slow")
+class Slow(store.Command):
+    async def execute(self):
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)
+        return {"done": True}
+
+
+class RecordingMonitor(LoopMonitor):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.reports = []
+
+    def report(self, lag, culprit):
+        self.reports.append((lag, culprit))
+
+
+describe "find_culprit":
+    it "says nobody if there is no frame":
+        assert find_culprit(None) is nobody
+
+    it "says where we are if no command is running":
+        culprit = find_culprit(sys._getframe())
+        assert culprit.path is None
+        assert culprit.command is None
+        assert culprit.where.startswith(__file__)
+
+    async it "finds the command and path from the executor":
+        found = []
+
+        @store.command("look")
+        class Look(store.Command):
+            async def execute(self):
+                found.append(find_culprit(sys._getframe()))
+
+        commander = Commander(store)
+        await commander.executor(None, None).execute("/v1", {"command": "look"})
+        assert found == [Culprit("/v1", "Look", found[0].where)]
+
+    it "finds the command outside an executor":
+
+        class Thing(store.Command):
+            def execute(self):
+                return find_culprit(sys._getframe())
+
+        Thing.__whirlwind_command__ = True
+
+        culprit = Thing.FieldSpec().empty_normalise().execute()
+        assert culprit.path is None
+        assert culprit.command == "Thing"
+
+describe "LoopMonitor":
+    async it "records the lag of the loop":
+        metrics = Metrics()
+        monitor = RecordingMonitor(interval=0.01, threshold=1, metrics=metrics)
+        monitor.start()
+        try:
+            await asyncio.sleep(0.1)
+        finally:
+            await monitor.stop()
+
+        assert monitor.reports == []
+        assert monitor.thread is None
+        assert monitor.task is None
+        assert metrics.metrics["whirlwind_loop_lag_distribution_seconds"].get().count > 0
+        assert metrics.metrics["whirlwind_loop_lag_seconds"].get() < 1
+
+    async it "reports the command that blocked the loop":
+        metrics = Metrics()
+        monitor = RecordingMonitor(interval=0.01, threshold=0.1, metrics=metrics)
+        monitor.start()
+        try:
+            commander = Commander(store)
+            assert await commander.executor(None, None).execute("/v1", {"command": "slow"}) == {
+                "done": True
+            }
+            await asyncio.sleep(0.05)
+        finally:
+            await monitor.stop()
+
+        assert len(monitor.reports) == 1
+        lag, culprit = monitor.reports[0]
+        assert lag >= 0.2
+        assert culprit.path == "/v1"
+        assert culprit.command == "Slow"
+        assert metrics.metrics["whirlwind_loop_blocked_total"].get(path="/v1", command="Slow") == 1
+
+    async it "reports blocking outside of commands":
+        monitor = RecordingMonitor(interval=0.01, threshold=0.1)
+        monitor.start()
+        try:
+            await asyncio.sleep(0.05)
+            time.sleep(0.3)
+            await asyncio.sleep(0.05)
+        finally:
+            await monitor.stop()
+
+        assert len(monitor.reports) == 1
+        lag, culprit = monitor.reports[0]
+        assert culprit.command is None
+        assert culprit.where.startswith(__file__)
+
+    async it "can report without looking for culprits":
+        monitor = RecordingMonitor(interval=0.01, threshold=0.1, find_culprits=False)
+        monitor.start()
+        try:
+            assert monitor.thread is None
+            await asyncio.sleep(0.05)
+            time.sleep(0.3)
+            await asyncio.sleep(0.05)
+        finally:
+            await monitor.stop()
+
+        assert [culprit for _, culprit in monitor.reports] == [nobody]
@@ -0,0 +1,160 @@
+# coding: spec
+
+from whirlwind.profiler import CommandProfiler, add_profiles_command
+from whirlwind.commander import Commander
+from whirlwind.store import Store
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.errors_pytest import assertRaises
+from delfick_project.norms import BadSpecValue
+from unittest import mock
+import pytest
+import asyncio
+
+
+def busy(amount):
+    return sum(range(amount))
+
+
+def waiting():
+    return "waited"
+
+
+store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+
+@store.command("marked", profile=True)
+class Marked(store.Command):
+    async def execute(self):
+        busy(1000)
+        await asyncio.sleep(0)
+        return {"marked": True}
+
+
+@store.command("unmarked")
+class Unmarked(store.Command):
+    async def execute(self):
+        busy(1000)
+        return {"marked": False}
+
+
+@store.command("calls_marked", profile=True)
+class CallsMarked(store.Command):
+    executor = store.injected("executor")
+
+    async def execute(self):
+        return await self.executor.execute("/v1", {"command": "marked"})
+
+
+@store.command("fails", profile=True)
+class Fails(store.Command):
+    async def execute(self):
+        raise ValueError("NOPE")
+
+
+add_profiles_command(store)
+
+
+def functions(profiler, path, command):
+    return {func[2] for func in profiler.profiles[(path, command)].stats.stats}
+
+
+describe "CommandProfiler":
+    it "wants marked commands":
+        profiler = CommandProfiler()
+        assert profiler.wants("/v1", Marked.FieldSpec().empty_normalise())
+        assert not profiler.wants("/v1", Unmarked.FieldSpec().empty_normalise())
+
+    it "wants a sample of other commands":
+        rand = mock.Mock(name="random", side_effect=[0.2, 0.05])
+        profiler = CommandProfiler(sample_rate=0.1, random=rand)
+        command = Unmarked.FieldSpec().empty_normalise()
+        assert not profiler.wants("/v1", command)
+        assert profiler.wants("/v1", command)
+
+    async it "only profiles the coroutine and not other tasks":
+        profiler = CommandProfiler()
+
+        async def other():
+            waiting()
+
+        async def profiled():
+            task = asyncio.get_event_loop().create_task(other())
+            busy(10)
+            await task
+            busy(10)
+            return 42
+
+        assert await profiler.profile(profiled(), "/v1", "thing") == 42
+        found = functions(profiler, "/v1", "thing")
+        assert "busy" in found
+        assert "waiting" not in found
+        assert not profiler.profiling
+
+    async it "passes on exceptions":
+        profiler = CommandProfiler()
+
+        async def fails():
+            await asyncio.sleep(0)
+            raise ValueError("NOPE")
+
+        with assertRaises(ValueError, "NOPE"):
+            await profiler.profile(fails(), "/v1", "thing")
+
+        assert profiler.profiles[("/v1", "thing")].count == 1
+        assert not profiler.profiling
+
+describe "profiling commands":
+
+    @pytest.fixture()
+    def profiler(self):
+        return CommandProfiler()
+
+    @pytest.fixture()
+    def executor(self, profiler):
+        return Commander(store, whirlwind_profiler=profiler).executor(None, None)
+
+    async it "profiles marked commands", profiler, executor:
+        assert await executor.execute("/v1", {"command": "marked"}) == {"marked": True}
+        assert await executor.execute("/v1", {"command": "marked"}) == {"marked": True}
+        assert await executor.execute("/v1", {"command": "unmarked"}) == {"marked": False}
+
+        assert list(profiler.profiles) == [("/v1", "marked")]
+        assert profiler.profiles[("/v1", "marked")].count == 2
+        assert "busy" in functions(profiler, "/v1", "marked")
+
+    async it "profiles failing commands", profiler, executor:
+        with assertRaises(ValueError, "NOPE"):
+            await executor.execute("/v1", {"command": "fails"})
+        assert profiler.profiles[("/v1", "fails")].count == 1
+
+    async it "includes nested commands in the outer profile", profiler, executor:
+        assert await executor.execute("/v1", {"command": "calls_marked"}) == {"marked": True}
+        assert list(profiler.profiles) == [("/v1", "calls_marked")]
+        assert "busy" in functions(profiler, "/v1", "calls_marked")
+
+    async it "can return profiles over a websocket", profiler, executor:
+        with assertRaises(BadSpecValue, "Command is for websockets only"):
+            await executor.execute("/v1", {"command": "profiles"})
+
+        assert await executor.execute(
+            "/v1", {"command": "profiles"}, allow_ws_only=True
+        ) == {"profiles": {}}
+
+        await executor.execute("/v1", {"command": "marked"})
+
+        result = await executor.execute(
+            "/v1", {"command": "profiles", "args": {"limit": 5, "reset": True}}, allow_ws_only=True
+        )
+        profile = result["profiles"]["/v1 marked"]
+        assert profile["count"] == 1
+        assert profile["seconds"] > 0
+        assert "busy" in profile["stats"]
+
+        assert profiler.profiles == {}
+
+    async it "returns no profiles without a profiler":
+        executor = Commander(store).executor(None, None)
+        assert await executor.execute(
+            "/v1", {"command": "profiles"}, allow_ws_only=True
+        ) == {"profiles": {}}
@@ -0,0 +1,74 @@
+# coding: spec
+
+from whirlwind.progress import Immediate, Coalesce, Batch
+
+import asyncio
+
+describe "Immediate":
+    it "sends every message":
+        sent = []
+        sender = Immediate().sender(sent.append)
+        sender.add(1)
+        sender.add(2)
+        sender.close()
+        sender.add(3)
+        assert sent == [1, 2, 3]
+
+describe "Coalesce":
+    async it "sends the first message and then only the latest each interval":
+        sent = []
+        sender = Coalesce(0.05).sender(sent.append)
+
+        sender.add(1)
+        sender.add(2)
+        sender.add(3)
+        assert sent == [1]
+
+        await asyncio.sleep(0.07)
+        assert sent == [1, 3]
+
+        sender.add(4)
+        sender.add(5)
+        assert sent == [1, 3]
+
+        await asyncio.sleep(0.07)
+        assert sent == [1, 3, 5]
+
+        await asyncio.sleep(0.07)
+        sender.add(6)
+        assert sent == [1, 3, 5, 6]
+
+    async it "sends what is left when it is closed":
+        sent = []
+        sender = Coalesce(10).sender(sent.append)
+        sender.add(1)
+        sender.add(2)
+        sender.add(3)
+        sender.close()
+        assert sent == [1, 3]
+        assert sender.handle is None
+
+        sender.add(4)
+        assert sent == [1, 3, 4]
+
+describe "Batch":
+    async it "sends groups of messages":
+        sent = []
+        sender = Batch(size=2, interval=0.05).sender(sent.append)
+
+        sender.add(1)
+        assert sent == []
+        sender.add(2)
+        assert sent == [{"batch": [1, 2]}]
+
+        sender.add(3)
+        await asyncio.sleep(0.07)
+        assert sent == [{"batch": [1, 2]}, {"batch": [3]}]
+
+        sender.add(4)
+        sender.close()
+        assert sent == [{"batch": [1, 2]}, {"batch": [3]}, {"batch": [4]}]
+        assert sender.handle is None
+
+        sender.add(5)
+        assert sent[-1] == {"batch": [5]}
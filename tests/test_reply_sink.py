@@ -0,0 +1,67 @@
+# coding: spec
+
+from whirlwind.reply_sink import ReplySink
+from whirlwind.commander import Commander
+from whirlwind.metrics import Metrics
+from whirlwind.store import Store
+
+import asyncio
+
+
+class Collect(ReplySink):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    async def deliver(self, batch):
+        self.batches.append([msg for msg, _ in batch])
+        if "bad" in self.batches[-1]:
+            raise ValueError("nope")
+
+
+describe "ReplySink":
+    async it "delivers full batches straight away and the rest after the interval":
+        sink = Collect(batch_size=3, interval=0.05)
+
+        for i in range(7):
+            assert sink.add(i)
+        await asyncio.sleep(0.01)
+        assert sink.batches == [[0, 1, 2], [3, 4, 5]]
+
+        await asyncio.sleep(0.06)
+        assert sink.batches == [[0, 1, 2], [3, 4, 5], [6]]
+
+        sink.add(7)
+        await sink.finish()
+        assert sink.batches == [[0, 1, 2], [3, 4, 5], [6], [7]]
+        assert sink.task.done()
+
+        assert not sink.add(8)
+        assert sink.dropped == 1
+
+    async it "drops messages when the buffer is full and counts what happened":
+        metrics = Metrics()
+        sink = Collect(batch_size=10, interval=5, max_buffer=3)
+        Commander(Store(), whirlwind_metrics=metrics, whirlwind_reply_sink=sink)
+        assert sink.metrics is metrics
+
+        assert [sink.add(m) for m in ("one", "bad", "three", "four")] == [True, True, True, False]
+        assert sink.dropped == 1
+
+        await sink.finish()
+        assert sink.batches == [["one", "bad", "three"]]
+
+        exposition = metrics.exposition()
+        assert "whirlwind_reply_sink_dropped_total 1" in exposition
+        assert "whirlwind_reply_sink_failed_total 3" in exposition
+        assert "whirlwind_reply_sink_batches_total 1" in exposition
+
+    async it "is given every reply the commander processes":
+        sink = Collect(batch_size=2)
+        commander = Commander(Store(), whirlwind_reply_sink=sink)
+
+        commander.process_reply({"progress": 1}, None)
+        commander.process_reply({"reply": 2}, None)
+        await asyncio.sleep(0.01)
+        assert sink.batches == [[{"progress": 1}, {"reply": 2}]]
+        await sink.finish()
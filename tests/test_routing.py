@@ -0,0 +1,241 @@
+# coding: spec
+
+from whirlwind.routing import Router, MemoryRoutes, FileRoutes
+from whirlwind.request_handlers.base import Finished
+from whirlwind.commander import Commander
+from whirlwind.store import Store, NoSuchParent
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.errors_pytest import assertRaises
+from delfick_project.norms import dictobj, sb
+from unittest import mock
+import tempfile
+import asyncio
+import pytest
+import os
+
+
+def make_store():
+    store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+    @store.command("counter")
+    class Counter(store.Command):
+        progress_cb = store.injected("progress_cb")
+
+        async def execute(self, messages):
+            total = 0
+            async for message in messages:
+                if isinstance(message.command, Stop):
+                    message.no_process()
+                    break
+                try:
+                    total += await message.process()
+                except Finished:
+                    pass
+            return {"total": total}
+
+    @store.command("add", parent=Counter)
+    class Add(store.Command):
+        progress_cb = store.injected("progress_cb")
+        amount = dictobj.Field(sb.integer_spec, wrapper=sb.required)
+
+        async def execute(self):
+            if self.amount < 0:
+                raise Finished(status=400, error="Can only add positive amounts")
+            self.progress_cb({"adding": self.amount})
+            return self.amount
+
+    @store.command("stop", parent=Counter)
+    class Stop(store.Command):
+        pass
+
+    return store
+
+
+@pytest.fixture()
+def directory():
+    with tempfile.TemporaryDirectory() as directory:
+        yield directory
+
+
+describe "Routes":
+
+    def assertRoutes(self, routes):
+        assert routes.owner(("one",)) is None
+
+        routes.claim(("one",), "/worker1")
+        routes.claim(("one", "two"), "/worker2")
+        assert routes.owner(("one",)) == "/worker1"
+        assert routes.owner(("one", "two")) == "/worker2"
+
+        routes.release(("one",), "/worker2")
+        assert routes.owner(("one",)) == "/worker1"
+
+        routes.release(("one",), "/worker1")
+        assert routes.owner(("one",)) is None
+        assert routes.owner(("one", "two")) == "/worker2"
+
+    it "can be kept in memory":
+        self.assertRoutes(MemoryRoutes())
+
+    async it "can be kept in files", directory:
+        routes = FileRoutes(os.path.join(directory, "routes"))
+        self.assertRoutes(routes)
+        await routes.finish()
+
+        # And other processes can see them after they refresh
+        other = FileRoutes(directory)
+        other.claim(("three",), "/worker3")
+        await other.finish()
+
+        routes = FileRoutes(directory, refresh_every=0.01)
+        assert routes.owner(("three",)) is None
+        await routes.start()
+        try:
+            assert routes.owner(("three",)) == "/worker3"
+
+            # Lookups only use what was read from the directory
+            for name in os.listdir(directory):
+                if os.path.isfile(os.path.join(directory, name)):
+                    os.remove(os.path.join(directory, name))
+            assert routes.owner(("three",)) == "/worker3"
+
+            await asyncio.sleep(0.05)
+            assert routes.owner(("three",)) is None
+        finally:
+            await routes.finish()
+        assert routes.refresher is None
+
+describe "Router":
+    it "doesn't route messages that aren't children or have a local parent":
+        store = make_store()
+        routes = MemoryRoutes()
+        routes.claim(("one",), "/other")
+        router = Router(routes, "/me")
+
+        assert router.remote_owner(store, None) is None
+        assert router.remote_owner(store, "one") is None
+        assert router.remote_owner(store, ("one",)) is None
+        assert router.remote_owner(store, ("two", "child")) is None
+
+        routes.claim(("two",), "/me")
+        assert router.remote_owner(store, ("two", "child")) is None
+
+        assert router.remote_owner(store, ("one", "child")) == "/other"
+
+        store.command_spec.existing_commands[("one",)] = {}
+        assert router.remote_owner(store, ("one", "child")) is None
+
+    async it "forwards children to the worker that owns the parent", directory:
+        routes = FileRoutes(os.path.join(directory, "routes"))
+        routes2 = FileRoutes(os.path.join(directory, "routes"))
+
+        store1 = make_store()
+        router1 = Router(routes, os.path.join(directory, "worker1.sock"))
+        commander1 = Commander(store1, whirlwind_router=router1)
+
+        store2 = make_store()
+        router2 = Router(routes2, os.path.join(directory, "worker2.sock"))
+        commander2 = Commander(store2, whirlwind_router=router2)
+
+        await router1.start(commander1)
+        await router2.start(commander2)
+
+        try:
+            parent = asyncio.get_event_loop().create_task(
+                commander1.executor(None, None, message_id="counter").execute(
+                    "/v1", {"command": "counter"}, allow_ws_only=True
+                )
+            )
+            await asyncio.sleep(0.05)
+            assert routes.owner(("counter",)) == router1.address
+
+            await routes.refresh()
+            await routes2.refresh()
+            assert routes2.owner(("counter",)) == router1.address
+
+            progress = []
+
+            def progress_cb(message, **kwargs):
+                progress.append((message, kwargs))
+
+            async def send(child, command, args=None):
+                executor = commander2.executor(progress_cb, None, message_id=("counter", child))
+                body = {"command": command, "args": args or {}}
+                return await executor.execute("/v1", body, allow_ws_only=True)
+
+            assert await send("c1", "add", {"amount": 2}) == 2
+            assert await send("c2", "add", {"amount": 3}) == 3
+            assert progress == [({"adding": 2}, {}), ({"adding": 3}, {})]
+
+            with assertRaises(Finished, status=400, error="Can only add positive amounts"):
+                await send("c3", "add", {"amount": -1})
+
+            assert await send("c4", "stop") == {"received": True}
+            assert await parent == {"total": 5}
+
+            assert routes.owner(("counter",)) is None
+            await routes.refresh()
+            await routes2.refresh()
+            assert routes2.owner(("counter",)) is None
+
+            with assertRaises(NoSuchParent):
+                await send("c5", "stop")
+        finally:
+            await router1.finish()
+            await router2.finish()
+
+        assert not os.path.exists(router1.address)
+        assert not os.path.exists(router2.address)
+
+    async it "complains if the owner goes away", directory:
+        routes = MemoryRoutes()
+        address = os.path.join(directory, "worker.sock")
+        router = Router(routes, address)
+
+        async def handle(reader, writer):
+            await reader.readline()
+            writer.close()
+
+        server = await asyncio.start_unix_server(handle, path=address)
+        try:
+            with assertRaises(Finished, status=502):
+                await router.forward(address, "/v1", {}, ("one", "two"), mock.Mock(name="cb"))
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async it "cancels a forwarded child when the worker that sent it goes away", directory:
+        store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        @store.command("wait")
+        class Wait(store.Command):
+            async def execute(self):
+                started.set()
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+
+        router = Router(MemoryRoutes(), os.path.join(directory, "worker.sock"))
+        await router.start(Commander(store, whirlwind_router=router))
+
+        try:
+            request = {
+                "path": "/v1",
+                "body": {"command": "wait"},
+                "message_id": ["one"],
+                "allow_ws_only": False,
+            }
+            reader, writer = await asyncio.open_unix_connection(router.address)
+            writer.write(router.dumps(request))
+            await writer.drain()
+            await asyncio.wait_for(started.wait(), timeout=1)
+
+            writer.close()
+            await asyncio.wait_for(cancelled.wait(), timeout=1)
+        finally:
+            await router.finish()
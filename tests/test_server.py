@@ -1,10 +1,21 @@
 # coding: spec
 
-from whirlwind.server import Server
+from whirlwind.request_handlers.base import MetricsHandler
+from whirlwind.metrics import Metrics, default_metrics, no_metrics
+from whirlwind.log_pipeline import LogPipeline, DroppingQueueHandler, RepeatFilter
+from whirlwind.server import Server, ConnectionPolicy, LimitedHTTPServer
+from whirlwind.commander import Commander
+from whirlwind.store import Store
 
 from unittest import mock
+import tornado.web
+import threading
+import logging
 import asyncio
 import pytest
+import queue
+import time
+import sys
 
 describe "setup":
 
@@ -95,3 +106,308 @@ describe "setup":
         async with self.assertSetupWorks(self, None, c, d=d) as (routes, setup, FakeApplication):
             setup.assert_called_once_with(c, d=d)
             FakeApplication.assert_called_once_with(routes)
+
+describe "metrics":
+    it "has a metrics registry":
+        server = Server(asyncio.Future())
+        assert server.metrics is default_metrics
+
+        metrics = Metrics()
+        server = Server(asyncio.Future(), metrics=metrics)
+        assert server.metrics is metrics
+
+    async it "shares the default registry with a commander that isn't given one":
+        server = Server(asyncio.Future())
+        commander = Commander(Store())
+        assert commander.metrics is server.metrics
+
+        commander = Commander(Store(), whirlwind_metrics=no_metrics)
+        assert commander.metrics is no_metrics
+
+    it "can make a route for the metrics":
+        server = Server(asyncio.Future())
+        assert server.metrics_route() == ("/metrics", MetricsHandler, {"metrics": server.metrics})
+        assert server.metrics_route("/stats")[0] == "/stats"
+
+describe "loop monitor":
+    async it "starts and stops the loop monitor around serving":
+        final_future = asyncio.Future()
+        monitor = mock.Mock(name="monitor", stop=pytest.helpers.AsyncMock(name="stop"))
+
+        called = []
+
+        class S(Server):
+            def tornado_routes(s):
+                return []
+
+            def make_loop_monitor(s):
+                return monitor
+
+            async def cleanup(s):
+                called.append(("cleanup", len(monitor.stop.mock_calls)))
+
+        server = S(final_future)
+        http_server = mock.Mock(name="http_server")
+
+        with mock.patch.object(S, "make_http_server", mock.Mock(return_value=http_server)):
+            task = asyncio.get_event_loop().create_task(server.serve("127.0.0.1", 0))
+            await asyncio.sleep(0.05)
+
+            monitor.start.assert_called_once_with()
+            assert len(monitor.stop.mock_calls) == 0
+
+            final_future.cancel()
+            await asyncio.wait([task])
+
+        assert called == [("cleanup", 0)]
+        monitor.stop.assert_called_once_with()
+
+    it "doesn't monitor the loop by default":
+        assert Server(asyncio.Future()).make_loop_monitor() is None
+
+describe "connection policy":
+    it "uses tornado defaults without a policy":
+        server = Server(asyncio.Future())
+        http_server = server.make_http_server([], {})
+        assert not isinstance(http_server, LimitedHTTPServer)
+
+    it "gives the policy to the http server":
+        policy = ConnectionPolicy(
+            idle_connection_timeout=5,
+            header_timeout=2,
+            body_timeout=10,
+            max_buffer_size=2000,
+            max_body_size=1000,
+            chunk_size=100,
+        )
+        server = Server(asyncio.Future(), connection_policy=policy)
+        http_server = server.make_http_server([], {})
+
+        assert isinstance(http_server, LimitedHTTPServer)
+        assert http_server.max_connections is None
+        assert http_server.max_buffer_size == 2000
+        assert http_server.conn_params.header_timeout == 2
+        assert http_server.conn_params.body_timeout == 10
+        assert http_server.conn_params.max_body_size == 1000
+        assert http_server.conn_params.chunk_size == 100
+
+        assert ConnectionPolicy().http_server_kwargs() == {}
+
+    async it "refuses connections past the maximum":
+        final_future = asyncio.Future()
+        port = pytest.helpers.free_port()
+        metrics = Metrics()
+
+        class Handler(tornado.web.RequestHandler):
+            def get(s):
+                s.write("hello")
+
+        class S(Server):
+            def tornado_routes(s):
+                return [("/", Handler)]
+
+        policy = ConnectionPolicy(max_connections=1, idle_connection_timeout=0.5)
+        server = S(final_future, metrics=metrics, connection_policy=policy)
+        task = asyncio.get_event_loop().create_task(server.serve("127.0.0.1", port))
+
+        async def request():
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            status = await reader.readline()
+            return status, writer
+
+        try:
+            await pytest.helpers.wait_for_port(port)
+            await asyncio.sleep(0.05)
+
+            # Kept alive connection holds the only slot
+            status, first = await request()
+            assert status.startswith(b"HTTP/1.1 200")
+
+            status, second = await request()
+            assert status.startswith(b"HTTP/1.1 503")
+            second.close()
+
+            refused = metrics.counter("whirlwind_http_connections_refused_total", "")
+            assert refused.get() >= 1
+
+            first.close()
+            await asyncio.sleep(0.1)
+
+            status, third = await request()
+            assert status.startswith(b"HTTP/1.1 200")
+            third.close()
+        finally:
+            final_future.cancel()
+            await asyncio.wait([task])
+
+describe "websocket pings":
+    it "gives the ping settings to the application":
+        server = Server(asyncio.Future(), websocket_ping_interval=10, websocket_ping_timeout=5)
+        app = server.make_application([], {"cookie_secret": "s3cr3t"})
+        assert app.settings["websocket_ping_interval"] == 10
+        assert app.settings["websocket_ping_timeout"] == 5
+        assert app.settings["cookie_secret"] == "s3cr3t"
+
+        app = Server(asyncio.Future()).make_application([], {})
+        assert "websocket_ping_interval" not in app.settings
+
+describe "tracer":
+    async it "closes the tracer after cleanup":
+        final_future = asyncio.Future()
+        tracer = mock.Mock(name="tracer", spec=["close"])
+
+        called = []
+        tracer.close.side_effect = lambda: called.append(("close", threading.current_thread()))
+
+        class S(Server):
+            def tornado_routes(s):
+                return []
+
+            async def cleanup(s):
+                called.append(("cleanup", len(tracer.close.mock_calls)))
+
+        server = S(final_future, tracer=tracer)
+        assert server.tracer is tracer
+
+        with mock.patch.object(S, "make_http_server", mock.Mock(name="make_http_server")):
+            task = asyncio.get_event_loop().create_task(server.serve("127.0.0.1", 0))
+            await asyncio.sleep(0.05)
+            final_future.cancel()
+            await asyncio.wait([task])
+
+        assert called == [("cleanup", 0), ("close", mock.ANY)]
+        assert called[1][1] is not threading.current_thread()
+
+describe "log pipeline":
+    async it "writes logs from a thread while serving":
+        final_future = asyncio.Future()
+        records = []
+
+        class Collect(logging.Handler):
+            def emit(s, record):
+                records.append((threading.current_thread(), s.format(record)))
+
+        logger = logging.getLogger("whirlwind.test_log_pipeline")
+        logger.propagate = False
+        handler = Collect()
+        logger.addHandler(handler)
+
+        pipeline = LogPipeline(logger_name="whirlwind.test_log_pipeline")
+        metrics = Metrics()
+
+        class S(Server):
+            def tornado_routes(s):
+                return []
+
+            async def cleanup(s):
+                assert logger.handlers == [pipeline.queue_handler]
+
+                for _ in range(3):
+                    try:
+                        raise ValueError("nope")
+                    except ValueError as error:
+                        logger.exception(error)
+                logger.warning("hello")
+
+        server = S(final_future, metrics=metrics, log_pipeline=pipeline)
+        assert pipeline.metrics is metrics
+
+        with mock.patch.object(S, "make_http_server", mock.Mock(name="make_http_server")):
+            task = asyncio.get_event_loop().create_task(server.serve("127.0.0.1", 0))
+            await asyncio.sleep(0.05)
+            final_future.cancel()
+            await asyncio.wait([task])
+
+        assert logger.handlers == [handler]
+        assert [msg.split("\n")[0] for _, msg in records] == ["nope", "hello"]
+        assert "Traceback" in records[0][1]
+        assert all(thread is not threading.current_thread() for thread, _ in records)
+        assert "whirlwind_log_records_suppressed_total 2" in metrics.exposition()
+
+    it "gives records to lastResort when the logger has no handlers":
+        records = []
+
+        class Collect(logging.Handler):
+            def emit(s, record):
+                records.append(record.getMessage())
+
+        logger = logging.getLogger("whirlwind.test_log_pipeline_no_handlers")
+        logger.propagate = False
+        assert logger.handlers == []
+
+        last_resort = Collect(logging.WARNING)
+        pipeline = LogPipeline(logger_name="whirlwind.test_log_pipeline_no_handlers")
+
+        with mock.patch.object(logging, "lastResort", last_resort):
+            pipeline.start()
+            try:
+                logger.error("bad things")
+                logger.info("quiet things")
+            finally:
+                pipeline.stop()
+
+        assert logger.handlers == []
+        assert records == ["bad things"]
+
+    it "drops records when the queue is full":
+        handler = DroppingQueueHandler(queue.Queue(1))
+        record = logging.LogRecord("one", logging.INFO, __file__, 1, "hello %s", ("there",), None)
+
+        handler.handle(record)
+        handler.handle(record)
+        assert handler.dropped == 1
+        assert handler.queue.get_nowait().msg == "hello there"
+
+    it "says how many repeated errors were left out":
+        rf = RepeatFilter(max_repeats=2, window=0.05)
+
+        try:
+            raise ValueError("nope")
+        except ValueError:
+            exc_info = sys.exc_info()
+
+        def make():
+            return logging.LogRecord("one", logging.ERROR, __file__, 1, "bad", (), exc_info)
+
+        assert [rf.filter(make()) for _ in range(4)] == [True, True, False, False]
+        time.sleep(0.06)
+
+        record = make()
+        left_out = rf.filter(record)
+        assert left_out is not record
+        assert not hasattr(record, "whirlwind_left_out")
+        assert left_out.whirlwind_left_out == 2
+
+        prepared = DroppingQueueHandler(queue.Queue()).prepare(left_out)
+        assert prepared.msg.startswith("bad (the same error was left out 2 times)\nTraceback")
+        assert "ValueError: nope" in prepared.msg
+        assert prepared.args is None
+        assert prepared.exc_info is None
+        assert prepared.exc_text is None
+        assert record.exc_info == exc_info
+
+    it "gives the queue the record from the repeat filter":
+        handler = DroppingQueueHandler(queue.Queue())
+        handler.addFilter(RepeatFilter(max_repeats=1, window=0.05))
+
+        try:
+            raise ValueError("nope")
+        except ValueError:
+            exc_info = sys.exc_info()
+
+        records = [
+            logging.LogRecord("one", logging.ERROR, __file__, 1, "bad", (), exc_info)
+            for _ in range(3)
+        ]
+        assert handler.handle(records[0])
+        assert not handler.handle(records[1])
+        time.sleep(0.06)
+        assert handler.handle(records[2])
+
+        first = handler.queue.get_nowait()
+        second = handler.queue.get_nowait()
+        assert first.msg.split("\n")[0] == "bad"
+        assert second.msg.split("\n")[0] == "bad (the same error was left out 1 times)"
+        assert all(r.exc_info is None for r in (first, second))
+        assert all(not hasattr(r, "whirlwind_left_out") for r in records)
@@ -5,15 +5,20 @@ from whirlwind.store import (
     NoSuchPath,
     NoSuchParent,
     NonInteractiveParent,
+    NonInteractiveShareable,
+    ShareableWithRequestValues,
     command_spec,
     create_task,
     CantReuseCommands,
+    is_interactive,
 )
 
 from delfick_project.option_merge import MergedOptionStringFormatter
 from delfick_project.norms import dictobj, sb, Meta, BadSpecValue
 from delfick_project.errors_pytest import assertRaises
+from delfick_project.errors import ProgrammerError
 from unittest import mock
+import threading
 import asyncio
 import uuid
 
@@ -70,6 +75,26 @@ describe "Store":
             assert dict(store2.paths) == {"/v2": {"stuff": three}, "/v1": {"blah": one, "meh": two}}
             assert dict(store.paths) == {"/v1": {"blah": one}}
 
+        it "finds registered classes in the clone":
+            store = Store()
+
+            @store.command("interactive")
+            class Interactive(store.Command):
+                async def execute(self, messages):
+                    pass
+
+            store2 = store.clone()
+            assert dict(store2.kls_names) == {}
+            assert store2.find_name("/v1", Interactive) == "interactive"
+
+            @store2.command("child", parent=Interactive)
+            class Child(store2.Command):
+                pass
+
+            assert "interactive:child" in store2.paths["/v1"]
+            assert dict(store.kls_names) == {"/v1": {Interactive: "interactive"}}
+            assert list(store.paths["/v1"]) == ["interactive"]
+
     describe "normalise_prefix":
         it "says None is an empty string":
             store = Store()
@@ -161,6 +186,59 @@ describe "Store":
                 "/v3": {"hello/five": five},
             }
 
+        it "can find parents from the merged store":
+            store1 = Store()
+            store2 = Store()
+
+            @store2.command("interactive")
+            class Interactive(store2.Command):
+                async def execute(self, messages):
+                    pass
+
+            store1.merge(store2, prefix="hello")
+            assert store1.find_name("/v1", Interactive) == "hello/interactive"
+
+            @store1.command("child", parent=Interactive)
+            class Child(store1.Command):
+                pass
+
+            assert sorted(store1.paths["/v1"]) == ["hello/interactive", "hello/interactive:child"]
+
+    describe "find_name":
+        it "finds the name of a registered class":
+            store = Store()
+
+            @store.command("one")
+            class One(store.Command):
+                pass
+
+            @store.command("two", path="/v2")
+            class Two(store.Command):
+                pass
+
+            assert store.find_name("/v1", One) == "one"
+            assert store.find_name("/v2", Two) == "two"
+            assert store.find_name("/v1", Two) is None
+            assert store.find_name("/v3", One) is None
+            assert "/v3" not in store.paths
+
+        it "doesn't trust the index if paths was changed directly":
+            store = Store()
+
+            @store.command("one")
+            class One(store.Command):
+                pass
+
+            class Other(store.Command):
+                pass
+
+            store.paths["/v1"]["one"] = {"kls": Other, "spec": Other.FieldSpec()}
+            store.paths["/v1"]["other_one"] = {"kls": One, "spec": One.FieldSpec()}
+
+            assert store.find_name("/v1", Other) == "one"
+            assert store.find_name("/v1", One) == "other_one"
+            assert store.kls_names["/v1"] == {One: "other_one", Other: "one"}
+
     describe "command decorator":
         it "uses the formatter given to the store":
             store = Store(formatter=MergedOptionStringFormatter)
@@ -303,6 +381,53 @@ describe "Store":
                 assert kls.__whirlwind_command__
                 assert kls.__whirlwind_ws_only__
 
+        it "can mark commands as websocket only and to be profiled":
+            store = Store()
+
+            @store.command("normal")
+            class Normal(store.Command):
+                pass
+
+            @store.command("admin", ws_only=True, profile=True)
+            class Admin(store.Command):
+                pass
+
+            assert not Normal.__whirlwind_ws_only__
+            assert not Normal.__whirlwind_profile__
+
+            assert Admin.__whirlwind_ws_only__
+            assert Admin.__whirlwind_profile__
+
+        it "remembers whether the command is interactive":
+            store = Store()
+
+            @store.command("interactive")
+            class Interactive(store.Command):
+                async def execute(self, messages):
+                    pass
+
+            @store.command("child", parent=Interactive)
+            class Child(store.Command):
+                async def execute(self):
+                    pass
+
+            class Subclass(Interactive):
+                async def execute(self):
+                    pass
+
+            assert Interactive.__whirlwind_interactive__ is True
+            assert Child.__whirlwind_interactive__ is False
+            assert "__whirlwind_interactive__" not in Subclass.__dict__
+
+            with mock.patch("inspect.signature", mock.NonCallableMock(name="signature")):
+                assert is_interactive(Interactive)
+                assert is_interactive(Interactive.FieldSpec().empty_normalise())
+                assert not is_interactive(Child)
+                assert not is_interactive(Child.FieldSpec().empty_normalise())
+
+            assert not is_interactive(Subclass)
+            assert not is_interactive(None)
+
         it "complains if can't find the parent":
             store = Store()
 
@@ -342,6 +467,59 @@ describe "Store":
                 class Command2(store.Command):
                     pass
 
+        it "complains about timeouts that aren't a finite number of seconds":
+            store = Store()
+
+            for bad in (0, -1, float("inf"), float("nan"), "soon", True):
+                with assertRaises(ProgrammerError, "The timeout for the command command must be"):
+                    store.command("command", timeout=bad)
+
+            @store.command("command", timeout="1.5")
+            class Command(store.Command):
+                pass
+
+            assert Command.__whirlwind_timeout__ == 1.5
+
+        it "complains if a shareable command is not interactive":
+            store = Store()
+
+            class Command(store.Command):
+                async def execute(self):
+                    pass
+
+            with assertRaises(
+                NonInteractiveShareable, "Only interactive commands can be shareable: Command"
+            ):
+                store.command("command", shareable=True)(Command)
+
+            assert "command" not in store.paths["/v1"]
+            assert "__whirlwind_command__" not in Command.__dict__
+
+        it "complains if a shareable command injects values from one request":
+            store = Store()
+
+            class Command(store.Command):
+                progress_cb = store.injected("progress_cb")
+                request_handler = store.injected("request_handler")
+                executor = store.injected("executor")
+
+                async def execute(self, messages):
+                    pass
+
+            with assertRaises(
+                ShareableWithRequestValues,
+                "Shareable commands can't inject values from one request:"
+                r" Command \(executor, request_handler\)",
+            ):
+                store.command("command", shareable=True)(Command)
+
+            assert "command" not in store.paths["/v1"]
+            assert "__whirlwind_command__" not in Command.__dict__
+
+            # They can be registered when they aren't shareable
+            store.command("command")(Command)
+            assert store.paths["/v1"]["command"]["kls"] is Command
+
 describe "command_spec":
     async it "normalises args into a function that makes the command and provides a function for execution":
         store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
@@ -705,3 +883,216 @@ describe "command_spec":
                 "available": ["other", "thing"],
                 "meta": meta.at("body").at("command").delfick_error_format("command"),
             }
+
+    async it "shares interactive commands that are started with the same args":
+        store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+        started = []
+        finished = []
+        release = asyncio.Future()
+
+        @store.command("watch", shareable=True)
+        class Watch(store.Command):
+            name = dictobj.Field(sb.string_spec, wrapper=sb.required)
+            progress_cb = store.injected("progress_cb")
+
+            async def execute(self, messages):
+                started.append(self.name)
+                try:
+                    self.progress_cb({"watching": self.name})
+                    await release
+                    return self.name
+                finally:
+                    finished.append(self.name)
+
+        assert Watch.__whirlwind_shareable__
+
+        def start(message_id, name, request_future, progress):
+            meta = Meta(
+                {
+                    "message_id": message_id,
+                    "request_future": request_future,
+                    "progress_cb": lambda msg, **kwargs: progress.append(msg),
+                },
+                [],
+            )
+            val = {
+                "path": "/v1",
+                "body": {"command": "watch", "args": {"name": name}},
+                "allow_ws_only": True,
+            }
+            return create_task(store.command_spec.normalise(meta, val)())
+
+        p1, p2, p3 = [], [], []
+        r1, r2, r3 = asyncio.Future(), asyncio.Future(), asyncio.Future()
+
+        t1 = start("one", "a", r1, p1)
+        t2 = start("two", "a", r2, p2)
+        t3 = start("three", "b", r3, p3)
+        await asyncio.sleep(0.01)
+
+        assert sorted(started) == ["a", "b"]
+        assert len(store.command_spec.shared) == 2
+        assert p1 == [{"watching": "a"}]
+        assert p2 == [{"watching": "a"}]
+        assert p3 == [{"watching": "b"}]
+
+        # Children of a shared command may come from any of its requests
+        assert (
+            store.command_spec.existing_commands[("one",)]
+            is store.command_spec.existing_commands[("two",)]
+        )
+
+        # The command keeps going while one request is still watching it
+        r1.cancel()
+        await asyncio.sleep(0.01)
+        assert t1.cancelled()
+        assert finished == []
+
+        release.set_result(True)
+        assert await t2 == "a"
+        assert await t3 == "b"
+        assert sorted(finished) == ["a", "b"]
+        assert store.command_spec.shared == {}
+        assert store.command_spec.existing_commands == {}
+
+    async it "cancels a shared command when the last request is finished":
+        store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+        cancelled = asyncio.Future()
+
+        @store.command("watch", shareable=True)
+        class Watch(store.Command):
+            async def execute(self, messages):
+                try:
+                    await asyncio.Future()
+                except asyncio.CancelledError:
+                    cancelled.set_result(True)
+                    raise
+
+        requests = [asyncio.Future(), asyncio.Future()]
+        tasks = []
+        for i, request_future in enumerate(requests):
+            meta = Meta({"message_id": str(i), "request_future": request_future}, [])
+            val = {"path": "/v1", "body": {"command": "watch"}, "allow_ws_only": True}
+            tasks.append(create_task(store.command_spec.normalise(meta, val)()))
+
+        await asyncio.sleep(0.01)
+        assert len(store.command_spec.shared) == 1
+
+        requests[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled.done()
+
+        requests[1].cancel()
+        await asyncio.wait_for(cancelled, timeout=1)
+        assert store.command_spec.shared == {}
+        await asyncio.wait(tasks)
+        assert all(task.cancelled() for task in tasks)
+
+    async it "can reuse the args it normalised before":
+        store = Store(formatter=MergedOptionStringFormatter, validation_cache_size=2)
+        assert store.clone().command_spec.validation_cache.size == 2
+
+        normalised = []
+
+        class counted(sb.Spec):
+            def normalise_filled(s, meta, val):
+                normalised.append(val)
+                return list(val)
+
+        @store.command("plain")
+        class Plain(store.Command):
+            names = dictobj.Field(counted)
+
+            async def execute(self):
+                self.names.append("changed")
+                return self
+
+        @store.command("injected")
+        class Injected(store.Command):
+            names = dictobj.Field(counted)
+            wat = store.injected("wat")
+
+            async def execute(self):
+                return self
+
+        assert Plain.__whirlwind_cacheable__
+        assert not Injected.__whirlwind_cacheable__
+
+        meta = Meta({"wat": mock.Mock(name="wat")}, [])
+
+        async def run(command, names):
+            val = {"path": "/v1", "body": {"command": command, "args": {"names": names}}}
+            return await store.command_spec.normalise(meta, val)()
+
+        first = await run("plain", ["a"])
+        assert first == {"names": ["a", "changed"]}
+        assert normalised == [["a"]]
+
+        # The command gets its own copy of the args
+        second = await run("plain", ["a"])
+        assert isinstance(second, Plain)
+        assert second == {"names": ["a", "changed"]}
+        assert normalised == [["a"]]
+
+        await run("injected", ["a"])
+        await run("injected", ["a"])
+        assert normalised == [["a"], ["a"], ["a"]]
+
+        await run("plain", ["b"])
+        await run("plain", ["c"])
+        await run("plain", ["a"])
+        assert normalised == [["a"], ["a"], ["a"], ["b"], ["c"], ["a"]]
+
+        cache = store.command_spec.validation_cache
+        assert cache.hits == 1
+        assert len(cache.snapshots) == 2
+
+    async it "only copies cached args that can be changed":
+        store = Store(formatter=MergedOptionStringFormatter, validation_cache_size=4)
+
+        normalised = []
+
+        class locked(sb.Spec):
+            def normalise_filled(s, meta, val):
+                normalised.append(val)
+                return threading.Lock()
+
+        @store.command("locked")
+        class Locked(store.Command):
+            lock = dictobj.Field(locked)
+
+            async def execute(self):
+                return self.lock
+
+        @store.command("plain")
+        class Plain(store.Command):
+            name = dictobj.Field(sb.string_spec)
+            pair = dictobj.Field(sb.tupleof(sb.integer_spec()))
+
+            async def execute(self):
+                return self.name, self.pair
+
+        async def run(command, args):
+            val = {"path": "/v1", "body": {"command": command, "args": args}}
+            return await store.command_spec.normalise(Meta.empty(), val)()
+
+        # Args that can't be deep copied aren't cached
+        first = await run("locked", {"lock": "a"})
+        second = await run("locked", {"lock": "a"})
+        assert first is not second
+        assert normalised == ["a", "a"]
+
+        cache = store.command_spec.validation_cache
+        assert cache.snapshots == {}
+
+        with mock.patch("whirlwind.store.copy.deepcopy") as deepcopy:
+            assert await run("plain", {"name": "a", "pair": [1, 2]}) == ("a", (1, 2))
+            assert await run("plain", {"name": "a", "pair": [1, 2]}) == ("a", (1, 2))
+        assert cache.hits == 1
+        assert len(deepcopy.mock_calls) == 0
+
+    async it "doesn't cache without a size":
+        store = Store()
+        assert store.command_spec.validation_cache is None
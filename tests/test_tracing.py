@@ -0,0 +1,193 @@
+# coding: spec
+
+from whirlwind.tracing import Tracer, JSONLinesExporter, trace, current_span, no_span
+from whirlwind.store import Store, pass_on_result
+from whirlwind.commander import Commander
+
+from delfick_project.option_merge import MergedOptionStringFormatter
+from delfick_project.norms import dictobj, sb
+from delfick_project.errors_pytest import assertRaises
+from unittest import mock
+import threading
+import asyncio
+import json
+
+store = Store(default_path="/v1", formatter=MergedOptionStringFormatter)
+
+
+@store.command("traced")
+class Traced(store.Command):
+    tracer = store.injected("tracer")
+    value = dictobj.Field(sb.integer_spec, wrapper=sb.required)
+
+    async def execute(self):
+        assert current_span.get().name == "whirlwind.execute"
+        return self.tracer, self.value
+
+
+class Collect:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    @property
+    def names(self):
+        return [span.name for span in self.spans]
+
+
+describe "trace":
+    it "does nothing without a tracer":
+        assert trace(None, "whirlwind.request") is no_span
+        with trace(None, "whirlwind.request") as span:
+            assert span is None
+            assert current_span.get() is None
+
+    it "makes children of the current span with the tracer of that span":
+        exporter = Collect()
+        tracer = Tracer(exporter)
+
+        with trace(tracer, "outer", one=1) as outer:
+            assert current_span.get() is outer
+            with trace(None, "inner") as inner:
+                assert current_span.get() is inner
+            assert current_span.get() is outer
+        assert current_span.get() is None
+
+        assert exporter.names == ["inner", "outer"]
+        assert outer.parent_id is None
+        assert inner.parent_id == outer.span_id
+        assert inner.trace_id == outer.trace_id
+        assert outer.attributes == {"one": 1}
+        assert outer.duration >= inner.duration >= 0
+
+    it "records errors and doesn't mind when the exporter fails":
+        exporter = mock.Mock(name="exporter", spec=["export"])
+        exporter.export.side_effect = ValueError("NOPE")
+        tracer = Tracer(exporter)
+
+        with assertRaises(TypeError, "bad"):
+            with tracer.span("failing") as span:
+                raise TypeError("bad")
+
+        assert span.error == "TypeError"
+        exporter.export.assert_called_once_with(span)
+
+    async it "is inherited by tasks":
+        tracer = Tracer(Collect())
+
+        async def child():
+            with trace(None, "child") as span:
+                return span
+
+        with tracer.span("parent") as parent:
+            span = await asyncio.get_event_loop().create_task(child())
+
+        assert span.parent_id == parent.span_id
+
+
+describe "Tracer":
+    it "needs an exporter":
+        with assertRaises(TypeError):
+            Tracer()
+
+    it "closes the exporter if it can be closed":
+        exporter = mock.Mock(name="exporter", spec=["export", "close"])
+        Tracer(exporter).close()
+        exporter.close.assert_called_once_with()
+
+        Tracer(mock.Mock(name="exporter", spec=["export"])).close()
+
+describe "JSONLinesExporter":
+    it "writes a line for each span from a thread", tmp_path:
+        path = tmp_path / "traces.jsonl"
+        exporter = JSONLinesExporter(str(path))
+        tracer = Tracer(exporter)
+
+        with tracer.span("one", thing=object()) as one:
+            with tracer.span("two") as two:
+                two.link(one)
+        assert exporter.thread.name == "whirlwind-traces"
+
+        tracer.close()
+        assert exporter.thread is None
+
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [line["name"] for line in lines] == ["two", "one"]
+        assert lines[0]["links"] == [{"trace_id": one.trace_id, "span_id": one.span_id}]
+        assert lines[0]["parent_id"] == one.span_id
+        assert lines[1]["attributes"]["thing"].startswith("<object object")
+
+    it "drops spans when the queue is full", tmp_path:
+        path = tmp_path / "traces.jsonl"
+        exporter = JSONLinesExporter(str(path), max_queue=1)
+        blocked = threading.Event()
+
+        def write_forever():
+            blocked.wait()
+            JSONLinesExporter.write_forever(exporter)
+
+        exporter.write_forever = write_forever
+        tracer = Tracer(exporter)
+
+        for name in ("one", "two", "three"):
+            with tracer.span(name):
+                pass
+
+        assert exporter.dropped == 2
+        blocked.set()
+        tracer.close()
+        assert [json.loads(line)["name"] for line in path.read_text().splitlines()] == ["one"]
+
+describe "Tracing commands":
+    async it "records validating and executing a command":
+        exporter = Collect()
+        tracer = Tracer(exporter)
+        commander = Commander(store, whirlwind_tracer=tracer)
+        assert commander.tracer is tracer
+
+        with tracer.span("whirlwind.message") as message:
+            got, value = await commander.executor(mock.Mock(name="progress_cb"), None).execute(
+                "/v1", {"command": "traced", "args": {"value": 20}}
+            )
+
+        assert got is tracer
+        assert value == 20
+
+        assert exporter.names == ["whirlwind.validate", "whirlwind.execute", "whirlwind.message"]
+        validate, execute, _ = exporter.spans
+        assert validate.parent_id == message.span_id
+        assert execute.parent_id == message.span_id
+        assert execute.attributes == {"path": "/v1", "command": "traced"}
+
+    async it "records validation errors":
+        exporter = Collect()
+        commander = Commander(store, whirlwind_tracer=Tracer(exporter))
+
+        with assertRaises(Exception):
+            await commander.executor(mock.Mock(name="progress_cb"), None).execute(
+                "/v1", {"command": "traced", "args": {}}
+            )
+
+        assert exporter.names == ["whirlwind.validate"]
+        assert exporter.spans[0].error is not None
+
+    async it "links children of interactive commands to where they came from":
+        exporter = Collect()
+        tracer = Tracer(exporter)
+
+        with tracer.span("whirlwind.message") as message:
+            with tracer.span("whirlwind.execute") as caused_by:
+                pass
+
+            fut = asyncio.Future()
+            command = mock.Mock(name="command", spec=["execute"])
+            command.execute = mock.AsyncMock(name="execute", return_value=True)
+            await pass_on_result(fut, command, (), log_exceptions=True, caused_by=caused_by)
+
+        assert await fut is True
+        child = exporter.spans[1]
+        assert child.name == "whirlwind.child"
+        assert child.parent_id == message.span_id
+        assert child.links == [{"trace_id": caused_by.trace_id, "span_id": caused_by.span_id}]
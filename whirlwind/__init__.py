@@ -1,11 +1,47 @@
-from whirlwind.commander import Commander, Command
-from whirlwind import request_handlers
 from whirlwind.version import VERSION
-from whirlwind.server import Server
-from whirlwind.store import Store
+
+import importlib as _importlib
 
 __doc__ = """
 A wrapper around the tornado web server.
 """
 
-__all__ = ["VERSION", "Commander", "Command", "Server", "Store", "request_handlers"]
+# The public names are only imported when they are first accessed so that
+# tools that only need the Store don't pay for importing tornado
+_lazy = {
+    "Commander": "whirlwind.commander",
+    "Command": "whirlwind.commander",
+    "SlotsCommand": "whirlwind.commander",
+    "Server": "whirlwind.server",
+    "Store": "whirlwind.store",
+    "request_handlers": "whirlwind.request_handlers",
+}
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module = _importlib.import_module(_lazy[name])
+    if module.__name__ == f"{__name__}.{name}":
+        value = module
+    else:
+        value = getattr(module, name)
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
+
+
+__all__ = [
+    "VERSION",
+    "Commander",
+    "Command",
+    "SlotsCommand",
+    "Server",
+    "Store",
+    "request_handlers",
+]
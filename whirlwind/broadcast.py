@@ -0,0 +1,155 @@
+"""
+Send the same message to many websocket connections.
+
+Connections subscribe to named topics and a publish to a topic is serialised
+once for all of its subscribers.
+
+.. code-block:: python
+
+    from whirlwind.broadcast import Topics
+
+    topics = Topics()
+    commander = Commander(store, topics=topics)
+
+    @store.command("watch")
+    class Watch(store.Command):
+        topics = store.injected("topics")
+        request_handler = store.injected("request_handler")
+
+        name = dictobj.Field(sb.string_spec, wrapper=sb.required)
+
+        async def execute(self):
+            self.topics.subscribe(self.request_handler, self.name)
+            return {"watching": self.name}
+
+    # And elsewhere
+    topics.publish("dashboard", {"cpu": 0.5})
+
+Subscribers receive ``{"reply": <message>, "message_id": "__topic__", "topic": <topic>}``
+"""
+
+from whirlwind.request_handlers.base import reprer as default_reprer
+from whirlwind.metrics import no_metrics
+
+from tornado.websocket import WebSocketClosedError
+from collections import defaultdict
+
+
+class Subscriber:
+    """
+    A connection and the number of frames we have written to it that haven't
+    been sent yet
+    """
+
+    def __init__(self, handler):
+        self.pending = 0
+        self.dropped = 0
+        self.handler = handler
+
+    def send(self, frame, binary, max_pending):
+        """Write this frame, returning False if the connection is too far behind"""
+        if self.pending >= max_pending:
+            self.dropped += 1
+            return False
+
+        self.pending += 1
+        self.handler.write_message(frame, binary=binary).add_done_callback(self.sent)
+        return True
+
+    def sent(self, res):
+        self.pending -= 1
+        if not res.cancelled():
+            res.exception()
+
+
+class Topics:
+    """
+    The subscribers for each topic
+
+    A connection that has ``max_pending`` frames that haven't been sent yet
+    misses the messages published until it catches up, so that a slow client
+    doesn't hold up the others.
+
+    The ``reprer`` is used to serialise anything that isn't JSON.
+    """
+
+    _merged_options_formattable = True
+
+    def __init__(self, *, max_pending=100, reprer=default_reprer, metrics=None):
+        self.reprer = reprer
+        self.max_pending = max_pending
+        self.metrics = no_metrics if metrics is None else metrics
+
+        self.topics = defaultdict(dict)
+        self.subscribers = {}
+
+    def subscribe(self, handler, topic):
+        """
+        Send the messages for this topic to this websocket handler until it
+        unsubscribes or its connection is finished
+        """
+        subscriber = self.subscribers.get(handler)
+        if subscriber is None:
+            subscriber = self.subscribers[handler] = Subscriber(handler)
+            handler.connection_future.add_done_callback(lambda res: self.unsubscribe(handler))
+
+        self.topics[topic][handler] = subscriber
+
+    def unsubscribe(self, handler, topic=None):
+        """Stop sending this topic, or all topics if topic is None, to this handler"""
+        names = list(self.topics) if topic is None else [topic]
+        for name in names:
+            subscribers = self.topics.get(name)
+            if subscribers is not None:
+                subscribers.pop(handler, None)
+                if not subscribers:
+                    del self.topics[name]
+
+        if not any(handler in subscribers for subscribers in self.topics.values()):
+            self.subscribers.pop(handler, None)
+
+    def publish(self, topic, msg):
+        """Send this message to the subscribers of this topic and return how many got it"""
+        subscribers = self.topics.get(topic)
+        if not subscribers:
+            return 0
+
+        if hasattr(msg, "as_dict"):
+            msg = msg.as_dict()
+        reply = {"reply": msg, "message_id": "__topic__", "topic": topic}
+
+        frames = {}
+        sent = 0
+        closed = []
+
+        for handler, subscriber in subscribers.items():
+            framing = handler.framing
+            frame = frames.get(framing.name)
+            if frame is None:
+                frame = framing.dumps(reply, self.reprer)
+                if isinstance(frame, str):
+                    # Tornado would encode a str for every connection
+                    frame = frame.encode()
+                frames[framing.name] = frame
+
+            try:
+                if subscriber.send(frame, framing.binary, self.max_pending):
+                    sent += 1
+                else:
+                    self.metrics.counter(
+                        "whirlwind_broadcast_dropped_total",
+                        "Broadcast messages not sent to a slow connection",
+                    ).inc()
+            except WebSocketClosedError:
+                closed.append(handler)
+
+        for handler in closed:
+            self.unsubscribe(handler)
+
+        self.metrics.counter(
+            "whirlwind_broadcast_messages_total", "Messages published to topics"
+        ).inc()
+        self.metrics.counter(
+            "whirlwind_broadcast_deliveries_total", "Broadcast messages written to connections"
+        ).inc(sent)
+        return sent
@@ -1,6 +1,149 @@
+from whirlwind.metrics import default_metrics, command_metrics
+from whirlwind.tracing import trace
+
+from delfick_project.norms.field_spec import FieldSpec
 from delfick_project.option_merge import MergedOptions
-from delfick_project.norms import dictobj, Meta
+from delfick_project.norms import sb, dictobj, Meta, BadSpecValue
+from contextlib import ExitStack
+import contextvars
 import asyncio
+import copy
+import types
+import math
+import sys
+
+# The loop time that the command currently being executed must finish by
+current_deadline = contextvars.ContextVar("whirlwind_deadline", default=None)
+
+
+class seconds_spec(sb.Spec):
+    """A finite number of seconds that is more than zero"""
+
+    def normalise_filled(self, meta, val):
+        val = sb.float_spec().normalise(meta, val)
+        if not math.isfinite(val) or val <= 0:
+            raise BadSpecValue(
+                "Expected a finite number of seconds more than zero", got=val, meta=meta
+            )
+        return val
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        super().__init__(f"Request took longer than {timeout:.3g} seconds")
+
+
+async def within_deadline(coro, deadline, timeout=None):
+    """
+    Await this coroutine and cancel it if it hasn't finished by the loop time
+    ``deadline``, raising DeadlineExceeded in its place
+
+    The error says ``timeout`` seconds, or how long was left until the deadline
+    if that isn't given.
+    """
+    loop = asyncio.get_event_loop()
+    if timeout is None:
+        timeout = deadline - loop.time()
+
+    expired = []
+
+    def expire():
+        expired.append(True)
+        task.cancel()
+
+    token = current_deadline.set(deadline)
+    try:
+        task = asyncio.ensure_future(coro)
+    finally:
+        current_deadline.reset(token)
+
+    handle = loop.call_at(deadline, expire)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if expired and task.cancelled():
+            raise DeadlineExceeded(timeout)
+        raise
+    finally:
+        handle.cancel()
+
+
+def is_stream(result):
+    """Return whether this result should be streamed rather than sent whole"""
+    return hasattr(result, "__aiter__") or isinstance(result, types.GeneratorType)
+
+
+async def close_stream(result):
+    if hasattr(result, "aclose"):
+        await result.aclose()
+    elif hasattr(result, "close"):
+        result.close()
+
+
+async def stream_items(result):
+    """Yield the items from this async iterator or generator and close it after"""
+    try:
+        if hasattr(result, "__aiter__"):
+            async for item in result:
+                yield item
+        else:
+            for item in result:
+                yield item
+    finally:
+        await close_stream(result)
+
+
+class Streaming:
+    """
+    What the executor returns for a command that streams its result.
+
+    Each item is made within the deadline and profile of the command, and the
+    metrics and span for the command aren't finished until the stream is
+    finished or closed.
+    """
+
+    def __init__(self, result, scope, deadline=None, timeout=None, profiling=None):
+        self.scope = scope
+        self.timeout = timeout
+        self.deadline = deadline
+        self.profiling = profiling
+        self.items = stream_items(result)
+        self.finished = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.finished:
+            raise StopAsyncIteration
+
+        try:
+            making = self.items.__anext__()
+            if self.profiling is not None:
+                making = self.profiling.run(making)
+            if self.deadline is not None:
+                making = within_deadline(making, self.deadline, self.timeout)
+            return await making
+        except StopAsyncIteration:
+            await self.aclose()
+            raise
+        except BaseException:
+            await self.finish(*sys.exc_info())
+            raise
+
+    async def aclose(self):
+        await self.finish(None, None, None)
+
+    async def finish(self, exc_typ, exc, tb):
+        if self.finished:
+            return
+        self.finished = True
+
+        try:
+            await self.items.aclose()
+        finally:
+            self.scope.__exit__(exc_typ, exc, tb)
 
 
 class Command(dictobj.Spec):
@@ -10,22 +153,166 @@ class Command(dictobj.Spec):
         raise NotImplementedError("Base command has no execute implementation")
 
 
+class SlotsCommandMeta(type):
+    """
+    Turns ``dictobj.Field`` attributes into a ``fields`` dictionary like
+    ``dictobj.Spec`` does, but also makes those fields the ``__slots__`` of the
+    class so instances don't need a dictionary.
+    """
+
+    def __new__(metaname, classname, baseclasses, attrs):
+        fields = {}
+        for kls in baseclasses:
+            fields.update(getattr(kls, "fields", None) or {})
+
+        declared = []
+        for name, options in list(attrs.items()):
+            if getattr(options, "is_dictobj_field", False):
+                del attrs[name]
+                declared.append(name)
+                if options.help:
+                    fields[name] = (options.help, options)
+                else:
+                    fields[name] = options
+
+        inherited = set()
+        for kls in baseclasses:
+            for k in kls.__mro__:
+                inherited.update(k.__dict__.get("__slots__", ()))
+
+        slots = attrs.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+
+        attrs["fields"] = fields
+        attrs["__slots__"] = tuple(slots) + tuple(n for n in declared if n not in inherited)
+        return super().__new__(metaname, classname, baseclasses, attrs)
+
+
+class SlotsCommand(metaclass=SlotsCommandMeta):
+    """
+    A lightweight alternative to ``Command``.
+
+    Fields are declared in the same way, but instances store them in
+    ``__slots__`` rather than being a dictionary. This means any other attribute
+    you want to set on the instance must be declared in ``__slots__``.
+    """
+
+    _merged_options_formattable = True
+
+    FieldSpec = classmethod(FieldSpec)
+
+    def __init__(self, **kwargs):
+        for name in self.fields:
+            if name not in kwargs:
+                raise TypeError(f"{self.__class__.__name__} missing keyword argument: {name}")
+            setattr(self, name, kwargs.pop(name))
+
+        if kwargs:
+            raise TypeError(
+                f"{self.__class__.__name__} got unexpected keyword arguments: {sorted(kwargs)}"
+            )
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.fields}
+
+    def __eq__(self, other):
+        if isinstance(other, SlotsCommand):
+            return type(other) is type(self) and other.as_dict() == self.as_dict()
+        elif isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.as_dict()}>"
+
+    async def execute(self):
+        raise NotImplementedError("Base command has no execute implementation")
+
+
 class Commander:
     """
     Entry point for creating an executor to execute commands with
+
+    Keyword arguments are options available to commands as
+    ``store.injected(name)``. The arguments that change what the commander does
+    start with ``whirlwind_`` so they don't take options from an application
+    that already uses these names.
+
+    If ``whirlwind_metrics`` is provided, it should be a
+    ``whirlwind.metrics.Metrics`` object and will be used to record what happens
+    to each command. Otherwise ``whirlwind.metrics.default_metrics`` is used,
+    which is the registry a ``Server`` uses when it isn't given one. Use
+    ``whirlwind.metrics.no_metrics`` to record nothing. It is also available to
+    commands as ``store.injected("metrics")``.
+
+    If ``whirlwind_profiler`` is provided, it should be a
+    ``whirlwind.profiler.CommandProfiler`` and will be used to profile the
+    commands it wants to profile. It is also available to commands as
+    ``store.injected("profiler")``.
+
+    If ``whirlwind_default_timeout`` is provided, it is the number of seconds a
+    command may take if it wasn't registered with a ``timeout`` of its own.
+
+    If ``whirlwind_router`` is provided, it should be a
+    ``whirlwind.routing.Router`` and will be used to send children of
+    interactive commands to the worker that started their parent.
+
+    If ``whirlwind_reply_sink`` is provided, it should be a
+    ``whirlwind.reply_sink.ReplySink`` and every reply and progress message is
+    added to it to be delivered in batches.
+
+    If ``whirlwind_tracer`` is provided, it should be a
+    ``whirlwind.tracing.Tracer`` and will be used to record spans for each
+    request. It is also available to commands as ``store.injected("tracer")``.
+
+    If an option is also called ``metrics``, ``profiler`` or ``tracer`` then
+    commands that inject that name get the option.
     """
 
     _merged_options_formattable = True
 
-    def __init__(self, store, **options):
+    def __init__(
+        self,
+        store,
+        *,
+        whirlwind_metrics=None,
+        whirlwind_profiler=None,
+        whirlwind_default_timeout=None,
+        whirlwind_router=None,
+        whirlwind_reply_sink=None,
+        whirlwind_tracer=None,
+        **options,
+    ):
         self.store = store
+        self.tracer = whirlwind_tracer
+        self.router = whirlwind_router
+        self.reply_sink = whirlwind_reply_sink
+        self.profiler = whirlwind_profiler
+        self.default_timeout = whirlwind_default_timeout
+        self.metrics = default_metrics if whirlwind_metrics is None else whirlwind_metrics
+        if self.reply_sink is not None and self.reply_sink.metrics is None:
+            self.reply_sink.metrics = self.metrics
+
+        provided = {"metrics": self.metrics}
+        if self.profiler is not None:
+            provided["profiler"] = self.profiler
+        if self.tracer is not None:
+            provided["tracer"] = self.tracer
+
+        provided = {name: val for name, val in provided.items() if name not in options}
+        provided.update({"commander": self, "store": store})
 
-        everything = MergedOptions.using(options, {"commander": self}, dont_prefix=[dictobj])
+        everything = MergedOptions.using(options, provided, dont_prefix=[dictobj])
 
         self.meta = Meta(everything, [])
 
     def process_reply(self, msg, exc_info):
         """Hook for every reply and progress message sent to the client"""
+        if self.reply_sink is not None:
+            self.reply_sink.add(msg, exc_info)
 
     def peek_valid_request(self, meta, command, path, body):
         """Hook for looking at every request"""
@@ -35,6 +322,14 @@ class Commander:
 
 
 class Executor:
+    """
+    Executes commands for a request handler
+
+    A handler that executes many messages, like a websocket connection, should
+    make one executor and use ``for_message`` to get a light executor for each
+    message.
+    """
+
     _merged_options_formattable = True
 
     def __init__(self, commander, progress_cb, request_handler, extra_options):
@@ -43,8 +338,26 @@ class Executor:
         self.extra_options = extra_options
         self.request_handler = request_handler
 
+    def for_message(self, progress_cb, **extra_options):
+        """
+        Return an executor for one message with its own progress_cb and options
+
+        This is a copy of this executor, so a subclass of ``Executor`` returned
+        by ``Commander.executor`` is also used for every message.
+        """
+        executor = copy.copy(self)
+        executor.progress_cb = progress_cb
+        executor.extra_options = extra_options
+        return executor
+
     async def execute(
-        self, path, body, extra_options=None, allow_ws_only=False, request_future=None
+        self,
+        path,
+        body,
+        extra_options=None,
+        allow_ws_only=False,
+        request_future=None,
+        timeout=None,
     ):
         """
         Responsible for creating a command and calling execute on it.
@@ -71,39 +384,140 @@ class Executor:
             one passed in or a new Future for this request.
 
             At the end of the execute, the request future is cancelled, unless it
-            was provided, in which case it is left alone.
+            was provided, in which case it is left alone. For a command that
+            streams its result, this is when the stream is finished.
 
         extra options
             Anything provided as extra_options to this function
+
+        The command is cancelled and ``DeadlineExceeded`` is raised if it takes
+        longer than the smallest of ``timeout``, the ``timeout`` the command was
+        registered with (or the ``default_timeout`` of the commander) and any
+        deadline of the command or interactive parent this is executed within.
+
+        If the command streams its result then a ``Streaming`` async iterator is
+        returned. Each item is made within the same deadline, and the metrics,
+        profile and span for the command are finished with the stream.
         """
         provided = request_future is not None
         request_future = request_future or asyncio.Future()
         request_future._merged_options_formattable = True
 
-        try:
-            everything = MergedOptions.using(
+        scope = ExitStack()
+        if not provided:
+            scope.callback(request_future.cancel)
+
+        with scope:
+            layers = [
                 self.commander.meta.everything,
                 {
                     "path": path,
-                    "store": self.commander.store,
                     "executor": self,
                     "progress_cb": self.progress_cb,
                     "allow_ws_only": allow_ws_only,
                     "request_future": request_future,
                     "request_handler": self.request_handler,
                 },
-                self.extra_options,
-                extra_options or {},
-                dont_prefix=[dictobj],
-            )
+            ]
+            if self.extra_options:
+                layers.append(self.extra_options)
+            if extra_options:
+                layers.append(extra_options)
+
+            everything = MergedOptions.using(*layers, dont_prefix=[dictobj])
 
             meta = Meta(everything, self.commander.meta.path).at("<input>")
-            execute = self.commander.store.command_spec.normalise(
-                meta, {"path": path, "body": body, "allow_ws_only": allow_ws_only}
+
+            router = self.commander.router
+            if router is not None:
+                message_id = everything.get("message_id")
+                owner = router.remote_owner(self.commander.store, message_id)
+                if owner is not None:
+                    return await router.forward(
+                        owner, path, body, message_id, self.progress_cb, allow_ws_only
+                    )
+
+            try:
+                with trace(self.commander.tracer, "whirlwind.validate", path=path):
+                    execute = self.commander.store.command_spec.normalise(
+                        meta, {"path": path, "body": body, "allow_ws_only": allow_ws_only}
+                    )
+            except Exception:
+                self.commander.metrics.counter(
+                    "whirlwind_invalid_requests_total", "Requests that couldn't become a command"
+                ).inc()
+                raise
+
+            command = execute.__whirlwind_command__
+            name = execute.__whirlwind_command_name__
+            self.commander.peek_valid_request(meta, command, path, body)
+
+            policy = getattr(command, "__whirlwind_progress__", None)
+            if policy is not None and hasattr(self.progress_cb, "use_policy"):
+                self.progress_cb.use_policy(policy)
+
+            deadline = self.deadline_for(command, timeout, execute.__whirlwind_parent_deadline__)
+            if execute.__whirlwind_existing__ is not None:
+                execute.__whirlwind_existing__["deadline"] = deadline or current_deadline.get()
+
+            claimed = None
+            if router is not None and execute.__whirlwind_existing__ is not None:
+                claimed = execute.__whirlwind_message_id__
+                router.claim(claimed)
+                scope.callback(router.release, claimed)
+
+            profiling = None
+            profiler = self.commander.profiler
+            if profiler is not None and profiler.wants(path, command):
+                profiling = profiler.profiling_for(path, name)
+                scope.callback(profiling.finish)
+                running = profiling.run(execute())
+            else:
+                running = execute()
+
+            limit = None
+            if deadline is not None:
+                limit = deadline - asyncio.get_event_loop().time()
+                running = within_deadline(running, deadline, limit)
+
+            scope.enter_context(
+                command_metrics(
+                    self.commander.metrics, path, name, child=execute.__whirlwind_child__
+                )
+            )
+            scope.enter_context(
+                trace(self.commander.tracer, "whirlwind.execute", path=path, command=name)
             )
 
-            self.commander.peek_valid_request(meta, execute.__whirlwind_command__, path, body)
-            return await execute()
-        finally:
-            if not provided:
-                request_future.cancel()
+            result = await running
+            if not is_stream(result):
+                return result
+
+            # The items are made after we return, so the stream finishes what we started
+            return Streaming(
+                result, scope.pop_all(), deadline=deadline, timeout=limit, profiling=profiling
+            )
+
+    def deadline_for(self, command, timeout, inherited=None):
+        """
+        Return the loop time this command must finish by, or None if there is no
+        deadline or the deadline we are already executing within is sooner
+        """
+        limit = getattr(command, "__whirlwind_timeout__", None)
+        if limit is None:
+            limit = self.commander.default_timeout
+        if timeout is not None:
+            limit = timeout if limit is None else min(limit, timeout)
+
+        deadline = None
+        if limit is not None:
+            deadline = asyncio.get_event_loop().time() + limit
+
+        if inherited is not None and (deadline is None or inherited < deadline):
+            deadline = inherited
+
+        current = current_deadline.get()
+        if deadline is not None and current is not None and current <= deadline:
+            return None
+
+        return deadline
@@ -0,0 +1,232 @@
+"""
+Normalise the args for a command with a function made for that command.
+
+``kls.FieldSpec(formatter=...).normalise(meta, args)`` makes a spec for every
+field of the command and then dispatches through those specs for every
+request. For commands registered with ``store.command(..., compiled=True)`` we
+instead make one function when the command is registered that checks simple
+fields with plain python:
+
+* Fields with a ``string_spec``, ``integer_spec``, ``float_spec``, ``boolean``
+  or ``any_spec``, including when they are ``required``, have a default or are
+  nullable
+* Fields from ``store.injected`` that find an object that isn't formatted any
+  further, like a function or an object that is ``_merged_options_formattable``
+
+Any other field is normalised with the spec delfick_project would have used for
+it. If a value isn't what the function expects, all of the args are normalised
+with the original FieldSpec instead, so that conversions and errors are exactly
+what they would have been.
+"""
+
+from delfick_project.option_merge import MergedOptionStringFormatter, MergedOptions
+from delfick_project.norms import sb, dictobj, Meta, BadSpec
+import types
+
+simple_specs = {
+    sb.any_spec: ["pass"],
+    sb.string_spec: ["if not isinstance(v, str): raise Fallback"],
+    sb.boolean: ["if type(v) is not bool: raise Fallback"],
+    sb.integer_spec: ["if type(v) is not int: raise Fallback"],
+    sb.float_spec: ["if type(v) is int: v = float(v)", "elif type(v) is not float: raise Fallback"],
+}
+
+# What happens to a field that isn't in the args
+empty_values = {
+    sb.any_spec: "pass",
+    sb.string_spec: "v = ''",
+    sb.boolean: "pass",
+    sb.integer_spec: "pass",
+    sb.float_spec: "pass",
+}
+
+passed_through = (
+    type(None),
+    types.FunctionType,
+    types.MethodType,
+    types.BuiltinFunctionType,
+    types.BuiltinMethodType,
+)
+
+# The formatter methods that decide what ``"{path}"`` formats into
+formatter_methods = (
+    "format",
+    "get_field",
+    "get_string",
+    "format_field",
+    "special_get_field",
+    "special_format_field",
+)
+
+
+class Fallback(Exception):
+    pass
+
+
+def is_passed_through(obj):
+    """
+    Return whether the formatter would give back this object as is
+
+    Objects are marked for this with ``_merged_options_formattable = True``,
+    which the formatter used by the FieldSpec also looks for. Anything else is
+    left to the FieldSpec.
+    """
+    return isinstance(obj, passed_through) or getattr(obj, "_merged_options_formattable", False)
+
+
+def plain_formatter(formatter):
+    if formatter is None or not isinstance(formatter, type):
+        return False
+    if not issubclass(formatter, MergedOptionStringFormatter):
+        return False
+    return all(
+        getattr(formatter, name) is getattr(MergedOptionStringFormatter, name)
+        for name in formatter_methods
+    )
+
+
+def spec_kls(spec):
+    if isinstance(spec, type):
+        return spec
+    if type(spec) in simple_specs and not spec.pargs and not spec.kwargs:
+        return type(spec)
+
+
+def field_for(options):
+    if type(options) in (tuple, list) and len(options) in (1, 2):
+        options = options[-1]
+    if isinstance(options, dictobj.Field):
+        return options
+
+
+class CompiledFieldSpec:
+    """
+    Used in place of ``kls.FieldSpec(formatter=formatter)`` and normalises with
+    a function made for this class
+    """
+
+    def __init__(self, kls, formatter=None):
+        self.kls = kls
+        self.formatter = formatter
+        self.field_spec = kls.FieldSpec(formatter=formatter)
+
+        self.fast = None
+        self.source = None
+        try:
+            self.spec = self.field_spec.make_spec(Meta.empty())
+        except BadSpec:
+            # Let the FieldSpec complain when we normalise
+            self.spec = None
+        else:
+            self.source, namespace = self.generate()
+            exec(compile(self.source, f"<compiled spec for {kls.__name__}>", "exec"), namespace)
+            self.fast = namespace["normalise"]
+
+    def normalise(self, meta, val):
+        if self.fast is not None:
+            try:
+                return self.fast(meta, val)
+            except (Fallback, BadSpec):
+                # The FieldSpec knows how to convert this or how to complain
+                pass
+        return self.field_spec.normalise(meta, val)
+
+    def empty_normalise(self, **kwargs):
+        return self.normalise(Meta.empty(), kwargs)
+
+    def generate(self):
+        namespace = {
+            "kls": self.kls,
+            "Fallback": Fallback,
+            "NotSpecified": sb.NotSpecified,
+            "MergedOptions": MergedOptions,
+            "is_passed_through": is_passed_through,
+        }
+
+        lines = [
+            "def normalise(meta, args):",
+            "    if args is NotSpecified:",
+            "        args = {}",
+            "    elif type(args) is not dict:",
+            "        raise Fallback",
+            "    everything = meta.everything",
+            "    result = {}",
+        ]
+
+        for i, name in enumerate(self.spec.expected):
+            field = field_for(self.kls.fields[name])
+            body = None
+            if field is not None:
+                if field.formatted:
+                    body = self.injected_field(i, name, field, namespace)
+                else:
+                    body = self.simple_field(i, field, namespace)
+
+            if body is None:
+                namespace[f"spec_{i}"] = self.spec.expected[name]
+                body = [f"v = spec_{i}.normalise(meta.at({name!r}), v)"]
+
+            lines.append(f"    v = args.get({name!r}, NotSpecified)")
+            lines.extend(f"    {line}" for line in body)
+            lines.append(f"    result[{name!r}] = v")
+
+        lines.append("    return kls(**result)")
+        return "\n".join(lines) + "\n", namespace
+
+    def simple_field(self, i, field, namespace):
+        spec = spec_kls(field.spec)
+        if spec not in simple_specs:
+            return None
+
+        if field.wrapper is sb.required:
+            empty = "raise Fallback"
+        elif field.wrapper is not sb.NotSpecified:
+            return None
+        elif field.default is not sb.NotSpecified:
+            namespace[f"default_{i}"] = field.default
+            empty = f"v = default_{i}"
+        elif field.nullable:
+            empty = "v = None"
+        else:
+            empty = empty_values[spec]
+
+        check = simple_specs[spec]
+        if field.nullable:
+            check = ["if v is not None:"] + [f"    {line}" for line in check]
+
+        return ["if v is NotSpecified:", f"    {empty}", "else:"] + [
+            f"    {line}" for line in check
+        ]
+
+    def injected_field(self, i, name, field, namespace):
+        path = getattr(field.spec, "injected_path", None)
+        if path is None or not plain_formatter(self.formatter):
+            return None
+
+        if field.wrapper is not sb.NotSpecified or field.default is not sb.NotSpecified:
+            return None
+        if field.nullable:
+            return None
+
+        if field.spec.injected_nullable and field.after_format is sb.NotSpecified:
+            missing = "v = None"
+        else:
+            missing = "raise Fallback"
+
+        lines = [
+            f"if {path!r} not in everything:",
+            f"    {missing}",
+            "else:",
+            f"    v = everything[{path!r}]",
+            "    if type(v) is MergedOptions or isinstance(v, dict) or not is_passed_through(v):",
+            "        raise Fallback",
+        ]
+
+        after_format = field.after_format
+        if after_format is not sb.NotSpecified:
+            if callable(after_format):
+                after_format = after_format()
+            namespace[f"after_format_{i}"] = after_format
+            lines.append(f"    v = after_format_{i}.normalise(meta.at({name!r}), v)")
+
+        return lines
@@ -0,0 +1,71 @@
+"""
+Keep track of the websocket connections open on a server.
+
+Every ``connection_future`` for a websocket is added to the ``Connections`` for
+the ``final_future`` of the server. Adding and removing a connection costs the
+same no matter how many connections there are, and the ``final_future`` has one
+callback that cancels all of them when the server is stopped.
+
+.. code-block:: python
+
+    from whirlwind.connections import Connections
+
+    connections = Connections.of(final_future)
+    connections.add(connection_future)
+    len(connections)
+"""
+
+import weakref
+
+
+class Connections:
+    """
+    The connection futures that are cancelled when the final_future is done
+
+    Use ``Connections.of(final_future)`` so that everything using the same
+    final_future shares one registry.
+    """
+
+    registries = weakref.WeakKeyDictionary()
+
+    def __init__(self, final_future):
+        self.futures = {}
+        self.final_future = weakref.ref(final_future)
+        final_future.add_done_callback(self.cancel_all)
+
+    @classmethod
+    def of(kls, final_future):
+        """Return the registry for this final_future, making it if we need to"""
+        connections = kls.registries.get(final_future)
+        if connections is None:
+            connections = kls.registries[final_future] = kls(final_future)
+        return connections
+
+    def __len__(self):
+        return len(self.futures)
+
+    def __contains__(self, connection_future):
+        return connection_future in self.futures
+
+    @property
+    def finished(self):
+        final_future = self.final_future()
+        return final_future is None or final_future.done()
+
+    def add(self, connection_future):
+        """Cancel this connection_future when the final_future is done"""
+        if self.finished:
+            connection_future.cancel()
+            return
+
+        self.futures[connection_future] = True
+        connection_future.add_done_callback(self.remove)
+
+    def remove(self, connection_future):
+        self.futures.pop(connection_future, None)
+
+    def cancel_all(self, res=None):
+        futures = list(self.futures)
+        self.futures.clear()
+        for connection_future in futures:
+            connection_future.cancel()
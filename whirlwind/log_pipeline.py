@@ -0,0 +1,239 @@
+"""
+Write logs from a thread so that logging errors doesn't hold up the event loop.
+
+A ``LogPipeline`` takes the handlers of a logger and puts a handler in their
+place that only adds records to a bounded queue. A thread takes records from
+that queue, formats them and gives them to the original handlers. The message
+and exception of a record are formatted into one string before it is queued so
+the queue doesn't hold onto tracebacks.
+
+.. code-block:: python
+
+    from whirlwind.log_pipeline import LogPipeline
+
+    server = MyServer(final_future, log_pipeline=LogPipeline())
+
+When the queue is full, records are dropped rather than blocking the loop. The
+same exception logged over and over from the same place is only written
+``max_repeats`` times every ``window`` seconds and the next one that is written
+says how many were left out.
+"""
+
+from whirlwind.metrics import no_metrics
+
+from logging.handlers import QueueHandler, QueueListener
+import logging
+import queue
+import time
+import copy
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Let through ``max_repeats`` of the same exception from the same place every
+    ``window`` seconds
+
+    The first record let through after some were left out is given back as a
+    copy that says how many, so the record of the caller isn't changed. Python
+    3.12 uses the record a filter gives back and ``DroppingQueueHandler`` does
+    the same on older versions.
+    """
+
+    def __init__(self, *, max_repeats=1, window=10, metrics=no_metrics):
+        super().__init__()
+        self.window = window
+        self.metrics = metrics
+        self.max_repeats = max_repeats
+
+        self.seen = {}
+        self.pruned = time.monotonic()
+
+    def key_for(self, record):
+        if not record.exc_info or record.exc_info[1] is None:
+            return None
+
+        _, exc, tb = record.exc_info
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+
+        where = None
+        if tb is not None:
+            where = (tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+
+        return (record.name, record.levelno, type(exc), str(exc), where)
+
+    def filter(self, record):
+        key = self.key_for(record)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        if now - self.pruned > self.window:
+            self.prune(now)
+
+        result = True
+        info = self.seen.get(key)
+        if info is None or now - info["start"] > self.window:
+            suppressed = info["suppressed"] if info else 0
+            info = self.seen[key] = {"start": now, "count": 0, "suppressed": 0}
+            if suppressed:
+                result = copy.copy(record)
+                result.whirlwind_left_out = suppressed
+
+        info["count"] += 1
+        if info["count"] > self.max_repeats:
+            info["suppressed"] += 1
+            self.metrics.counter(
+                "whirlwind_log_records_suppressed_total", "Repeated log records we didn't write"
+            ).inc()
+            return False
+
+        return result
+
+    def prune(self, now):
+        self.pruned = now
+        for key, info in list(self.seen.items()):
+            if now - info["start"] > self.window and not info["suppressed"]:
+                del self.seen[key]
+
+
+class DroppingQueueHandler(QueueHandler):
+    """A QueueHandler that drops records when the queue is full"""
+
+    def __init__(self, queue, metrics=no_metrics):
+        super().__init__(queue)
+        self.dropped = 0
+        self.metrics = metrics
+
+    def handle(self, record):
+        # Use the record a filter gives back, like logging does from python 3.12
+        for f in self.filters:
+            result = f.filter(record) if hasattr(f, "filter") else f(record)
+            if not result:
+                return False
+            if isinstance(result, logging.LogRecord):
+                record = result
+
+        self.acquire()
+        try:
+            self.emit(record)
+        finally:
+            self.release()
+        return record
+
+    def prepare(self, record):
+        # Like QueueHandler.prepare, the exception is formatted into the message
+        # so that the queue doesn't keep tracebacks and their frames alive
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        left_out = getattr(record, "whirlwind_left_out", 0)
+        if left_out:
+            record.msg = f"{record.msg} (the same error was left out {left_out} times)"
+
+        msg = self.format(record)
+        record.msg = msg
+        record.message = msg
+        record.exc_info = None
+        record.exc_text = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.metrics.counter(
+                "whirlwind_log_records_dropped_total", "Log records dropped by a full queue"
+            ).inc()
+
+
+class LogPipeline:
+    """
+    Move the handlers of a logger onto a thread
+
+    logger_name
+        The logger to take the handlers from. Defaults to the root logger
+
+    handlers
+        The handlers to give records to instead of the handlers on the logger.
+        When there are no handlers, records go to ``logging.lastResort`` like
+        they would without the pipeline
+
+    max_queue
+        The number of records that may be waiting to be written
+
+    max_repeats and window
+        Given to the ``RepeatFilter``. Set ``window`` to None to write every
+        repeated exception
+    """
+
+    def __init__(
+        self,
+        *,
+        logger_name="",
+        handlers=None,
+        max_queue=10000,
+        max_repeats=1,
+        window=10,
+        metrics=None,
+    ):
+        self.window = window
+        self.handlers = handlers
+        self.max_queue = max_queue
+        self.logger_name = logger_name
+        self.max_repeats = max_repeats
+        self.metrics = metrics
+
+        self.listener = None
+        self.queue_handler = None
+        self.original_handlers = None
+
+    @property
+    def dropped(self):
+        return 0 if self.queue_handler is None else self.queue_handler.dropped
+
+    def start(self):
+        if self.listener is not None:
+            return
+
+        metrics = no_metrics if self.metrics is None else self.metrics
+        logger = logging.getLogger(self.logger_name)
+
+        self.original_handlers = list(logger.handlers)
+        handlers = self.original_handlers if self.handlers is None else self.handlers
+        if not handlers and logging.lastResort is not None:
+            # Our queue handler stops logging from using lastResort itself
+            handlers = [logging.lastResort]
+
+        self.queue_handler = DroppingQueueHandler(queue.Queue(self.max_queue), metrics=metrics)
+        if self.window is not None:
+            self.queue_handler.addFilter(
+                RepeatFilter(max_repeats=self.max_repeats, window=self.window, metrics=metrics)
+            )
+
+        self.listener = QueueListener(
+            self.queue_handler.queue, *handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+        for handler in self.original_handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(self.queue_handler)
+
+    def stop(self):
+        """Write the records in the queue and give the logger its handlers back"""
+        if self.listener is None:
+            return
+
+        logger = logging.getLogger(self.logger_name)
+        logger.removeHandler(self.queue_handler)
+        for handler in self.original_handlers:
+            logger.addHandler(handler)
+
+        try:
+            self.listener.stop()
+        finally:
+            self.listener = None
@@ -0,0 +1,274 @@
+"""
+A small registry of counters, gauges and histograms that can be exposed in the
+Prometheus text format.
+
+.. code-block:: python
+
+    from whirlwind.metrics import Metrics
+
+    metrics = Metrics()
+
+    requests = metrics.counter("requests_total", "Requests we got", ("path",))
+    requests.inc(path="/v1")
+
+    print(metrics.exposition())
+"""
+
+import asyncio
+import bisect
+import math
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricMismatch(Exception):
+    def __init__(self, name, wanted, got):
+        self.name = name
+        self.got = got
+        self.wanted = wanted
+        super().__init__(f"Metric {name} is a {got}, not a {wanted}")
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    elif value == -math.inf:
+        return "-Inf"
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.labelnames = tuple(labelnames)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        """Yield ``(name, label_pairs, value)`` for each value of this metric"""
+        for key, value in sorted(self.values.items(), key=lambda kv: [str(k) for k in kv[0]]):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, pairs, value in self.samples():
+            lines.append(f"{name}{format_labels(pairs)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class HistogramValue:
+    __slots__ = ["buckets", "sum", "count"]
+
+    def __init__(self, size):
+        self.sum = 0
+        self.count = 0
+        self.buckets = [0] * size
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        current = self.values.get(key)
+        if current is None:
+            current = self.values[key] = HistogramValue(len(self.buckets) + 1)
+
+        current.buckets[bisect.bisect_left(self.buckets, value)] += 1
+        current.sum += value
+        current.count += 1
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels))
+
+    def samples(self):
+        for name, pairs, value in super().samples():
+            total = 0
+            for le, count in zip(self.buckets + (math.inf,), value.buckets):
+                total += count
+                yield f"{name}_bucket", pairs + [("le", format_value(float(le)))], total
+            yield f"{name}_sum", pairs, value.sum
+            yield f"{name}_count", pairs, value.count
+
+
+class Metrics:
+    """
+    A registry of metrics
+
+    Asking for a metric that already exists returns the existing metric, so
+    code can ask for what it needs at the point it records values.
+    """
+
+    _merged_options_formattable = True
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def register(self, kls, name, help, labelnames, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = kls(name, help, labelnames, **kwargs)
+        elif metric.kind != kls.kind:
+            raise MetricMismatch(name, kls.kind, metric.kind)
+        return metric
+
+    def exposition(self):
+        """Return all our metrics in the Prometheus text format"""
+        return "".join(f"{self.metrics[name].exposition()}\n" for name in sorted(self.metrics))
+
+
+class NoMetric:
+    def inc(self, amount=1, **labels):
+        pass
+
+    def dec(self, amount=1, **labels):
+        pass
+
+    def set(self, value, **labels):
+        pass
+
+    def observe(self, value, **labels):
+        pass
+
+    def get(self, **labels):
+        return None
+
+
+class NoMetrics(Metrics):
+    """A registry that throws away everything it is given"""
+
+    metric = NoMetric()
+
+    def register(self, kls, name, help, labelnames, **kwargs):
+        return self.metric
+
+    def exposition(self):
+        return ""
+
+
+no_metrics = NoMetrics()
+
+# The registry used by a Server and a Commander that aren't given one, so that
+# the metrics route of a server shows what its commands are doing
+default_metrics = Metrics()
+
+
+class command_metrics:
+    """
+    Record metrics around the execution of a single command
+
+    .. code-block:: python
+
+        with command_metrics(metrics, "/v1", "status", child=False):
+            await command.execute()
+    """
+
+    def __init__(self, metrics, path, command, *, child=False):
+        self.child = child
+        self.metrics = metrics
+        self.labels = {"path": path, "command": command}
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.metrics.gauge(
+            "whirlwind_commands_in_flight", "Commands currently executing", ("path", "command")
+        ).inc(**self.labels)
+
+        if self.child:
+            self.metrics.gauge(
+                "whirlwind_interactive_children",
+                "Children of interactive commands currently executing",
+                ("path", "command"),
+            ).inc(**self.labels)
+
+        return self
+
+    def __exit__(self, exc_typ, exc, tb):
+        took = time.monotonic() - self.start
+
+        if exc_typ is None:
+            outcome = "success"
+        elif issubclass(exc_typ, asyncio.CancelledError):
+            outcome = "cancelled"
+        elif issubclass(exc_typ, asyncio.TimeoutError):
+            outcome = "timeout"
+        else:
+            outcome = "error"
+
+        self.metrics.gauge(
+            "whirlwind_commands_in_flight", "Commands currently executing", ("path", "command")
+        ).dec(**self.labels)
+
+        if self.child:
+            self.metrics.gauge(
+                "whirlwind_interactive_children",
+                "Children of interactive commands currently executing",
+                ("path", "command"),
+            ).dec(**self.labels)
+
+        self.metrics.counter(
+            "whirlwind_commands_total", "Commands executed", ("path", "command", "outcome")
+        ).inc(outcome=outcome, **self.labels)
+
+        self.metrics.histogram(
+            "whirlwind_command_duration_seconds",
+            "How long commands took to execute",
+            ("path", "command"),
+        ).observe(took, **self.labels)
@@ -0,0 +1,157 @@
+from whirlwind.metrics import no_metrics
+from whirlwind.commander import Executor
+from whirlwind.store import create_task
+
+from collections import namedtuple
+import threading
+import logging
+import asyncio
+import time
+import sys
+
+log = logging.getLogger("whirlwind.monitor")
+
+
+class Culprit(namedtuple("Culprit", ["path", "command", "where"])):
+    """
+    What was running while the loop was blocked
+
+    path
+        The path given to the executor, if we could find it
+
+    command
+        The name of the command class, if a command was running
+
+    where
+        ``<filename>:<line> in <function>`` for the code that was running
+    """
+
+
+nobody = Culprit(None, None, None)
+
+
+def find_culprit(frame):
+    """Walk out from this frame to find the command being executed"""
+    if frame is None:
+        return nobody
+
+    code = frame.f_code
+    where = f"{code.co_filename}:{frame.f_lineno} in {code.co_name}"
+
+    command = None
+    while frame is not None:
+        code = frame.f_code
+
+        if code is Executor.execute.__code__:
+            path = frame.f_locals.get("path")
+            if command is None:
+                execute = frame.f_locals.get("execute")
+                if hasattr(execute, "__whirlwind_command__"):
+                    command = execute.__whirlwind_command__.__class__.__name__
+            return Culprit(path, command, where)
+
+        if command is None and code.co_name == "execute":
+            kls = type(frame.f_locals.get("self"))
+            if getattr(kls, "__whirlwind_command__", False):
+                command = kls.__name__
+
+        frame = frame.f_back
+
+    return Culprit(None, command, where)
+
+
+class LoopMonitor:
+    """
+    Measures how late the event loop is to run a callback every ``interval``
+    seconds.
+
+    If the loop is late by ``threshold`` seconds or more then we call ``report``
+    with the lag and a ``Culprit`` describing what was running. The culprit is
+    found by a thread that looks at the stack of the loop while it is blocked.
+
+    The lag is also recorded in the ``metrics``.
+    """
+
+    def __init__(self, *, interval=0.05, threshold=0.1, metrics=None, find_culprits=True):
+        self.interval = interval
+        self.threshold = threshold
+        self.find_culprits = find_culprits
+        self.metrics = no_metrics if metrics is None else metrics
+
+        self.task = None
+        self.thread = None
+        self.culprit = None
+
+    def start(self):
+        self.beat = time.monotonic()
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+
+        self.task = create_task(self.measure(), name="<loop_monitor>")
+
+        if self.find_culprits:
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(
+                target=self.watch, name="whirlwind-loop-monitor", daemon=True
+            )
+            self.thread.start()
+
+    async def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.wait([self.task])
+            self.task = None
+
+    async def measure(self):
+        while True:
+            start = self.loop.time()
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+            lag = max(0, self.loop.time() - start - self.interval)
+            culprit, self.culprit = self.culprit, None
+
+            self.metrics.gauge("whirlwind_loop_lag_seconds", "Latest event loop lag").set(lag)
+            self.metrics.histogram(
+                "whirlwind_loop_lag_distribution_seconds", "Event loop lag"
+            ).observe(lag)
+
+            if lag >= self.threshold:
+                culprit = culprit or nobody
+                self.metrics.counter(
+                    "whirlwind_loop_blocked_total",
+                    "Times the event loop was blocked",
+                    ("path", "command"),
+                ).inc(path=culprit.path or "", command=culprit.command or "")
+                self.metrics.histogram(
+                    "whirlwind_loop_blocked_seconds",
+                    "How long the event loop was blocked",
+                    ("path", "command"),
+                ).observe(lag, path=culprit.path or "", command=culprit.command or "")
+
+                try:
+                    self.report(lag, culprit)
+                except Exception as error:
+                    log.exception(error)
+
+    def watch(self):
+        while not self.stopped.wait(self.interval / 2):
+            behind = time.monotonic() - self.beat - self.interval
+            if behind >= self.threshold and self.culprit is None:
+                self.culprit = find_culprit(sys._current_frames().get(self.loop_thread))
+
+    def report(self, lag, culprit):
+        """Hook called when the loop was blocked for longer than the threshold"""
+        took = f"{lag * 1000:.0f}ms"
+        if culprit.command:
+            on = f" on {culprit.path}" if culprit.path else ""
+            log.warning(f"Command {culprit.command}{on} blocked the event loop for {took}")
+        elif culprit.where:
+            log.warning(f"The event loop was blocked for {took} at {culprit.where}")
+        else:
+            log.warning(f"The event loop was blocked for {took}")
@@ -0,0 +1,225 @@
+"""
+Profile individual commands as they are executed.
+
+.. code-block:: python
+
+    from whirlwind.profiler import CommandProfiler, add_profiles_command
+    from whirlwind.commander import Commander
+
+    profiler = CommandProfiler(sample_rate=0.01)
+    commander = Commander(store, whirlwind_profiler=profiler)
+
+    # Commands registered with profile=True are profiled every time
+    @store.command("expensive", profile=True)
+    class Expensive(store.Command):
+        ...
+
+    # And the profiles can be retrieved over a websocket
+    add_profiles_command(store)
+"""
+
+from delfick_project.norms import dictobj, sb
+import cProfile
+import random
+import pstats
+import io
+
+SORTS = ["calls", "cumulative", "filename", "ncalls", "pcalls", "line", "name", "time", "tottime"]
+
+
+class Profile:
+    """The combined stats for every time we profiled a command"""
+
+    def __init__(self, profile):
+        self.count = 1
+        self.stats = pstats.Stats(profile)
+
+    def add(self, profile):
+        self.count += 1
+        self.stats.add(profile)
+
+    def dump(self, sort="cumulative", limit=20):
+        buf = io.StringIO()
+        self.stats.stream = buf
+        self.stats.sort_stats(sort).print_stats(limit)
+        return buf.getvalue()
+
+
+class Profiling:
+    """
+    One profile for a command that may be made from many awaits, like each
+    item of a command that streams its result. The profile is recorded when
+    ``finish`` is called.
+    """
+
+    def __init__(self, profiler, key):
+        self.key = key
+        self.ran = False
+        self.profiler = profiler
+        self.profile = cProfile.Profile()
+
+    def run(self, coro):
+        return profiled(self.profiler, coro, self.key, profiling=self)
+
+    def finish(self):
+        if self.ran:
+            self.ran = False
+            self.profiler.record(self.key, self.profile)
+
+
+class profiled:
+    """
+    Await a coroutine, with the profile enabled only while that coroutine is
+    running so we don't include other tasks that run while it is waiting.
+    """
+
+    def __init__(self, profiler, coro, key, profiling=None):
+        self.key = key
+        self.coro = coro
+        self.profiler = profiler
+        self.profiling = profiling
+
+    def __await__(self):
+        if self.profiling is not None:
+            return (yield from self.run(self.profiling))
+
+        profiling = Profiling(self.profiler, self.key)
+        try:
+            return (yield from self.run(profiling))
+        finally:
+            profiling.finish()
+
+    def run(self, profiling):
+        profile = profiling.profile
+        ran = False
+
+        gen = self.coro.__await__()
+        send, message = gen.send, None
+
+        try:
+            while True:
+                enabled = self.profiler.enable(profile)
+                ran = ran or enabled
+                try:
+                    yielded = send(message)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    if enabled:
+                        self.profiler.disable(profile)
+
+                try:
+                    message = yield yielded
+                    send = gen.send
+                except GeneratorExit:
+                    gen.close()
+                    raise
+                except BaseException as error:
+                    send, message = gen.throw, error
+        finally:
+            profiling.ran = profiling.ran or ran
+
+
+class CommandProfiler:
+    """
+    Decides which commands to profile and holds onto the results.
+
+    Commands registered with ``store.command(..., profile=True)`` are always
+    profiled and other commands are profiled ``sample_rate`` of the time.
+
+    Only one profile may be collecting at a time, so a command executed by a
+    command that is being profiled is included in the profile of the outer
+    command.
+    """
+
+    _merged_options_formattable = True
+
+    def __init__(self, *, sample_rate=0, random=random.random):
+        self.random = random
+        self.profiles = {}
+        self.sample_rate = sample_rate
+
+        self.profiling = False
+
+    def wants(self, path, command):
+        if getattr(command, "__whirlwind_profile__", False):
+            return True
+        return self.sample_rate > 0 and self.random() < self.sample_rate
+
+    def profile(self, coro, path, command):
+        """Return an awaitable that profiles this coroutine"""
+        return profiled(self, coro, (path, command))
+
+    def profiling_for(self, path, command):
+        """Return a ``Profiling`` for profiling many awaits as one command"""
+        return Profiling(self, (path, command))
+
+    def enable(self, profile):
+        if self.profiling:
+            return False
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Something else is already profiling
+            return False
+
+        self.profiling = True
+        return True
+
+    def disable(self, profile):
+        profile.disable()
+        self.profiling = False
+
+    def record(self, key, profile):
+        existing = self.profiles.get(key)
+        if existing is None:
+            self.profiles[key] = Profile(profile)
+        else:
+            existing.add(profile)
+
+    def reset(self):
+        self.profiles = {}
+
+    def dump(self, *, sort="cumulative", limit=20):
+        """
+        Return a dictionary of ``{"<path> <command>": info}`` for our profiles
+        where info has the ``count`` of times the command was profiled, the
+        ``seconds`` spent in it and the printed ``stats``
+        """
+        result = {}
+        for (path, command), profile in sorted(self.profiles.items()):
+            result[f"{path} {command}"] = {
+                "count": profile.count,
+                "seconds": profile.stats.total_tt,
+                "stats": profile.dump(sort=sort, limit=limit),
+            }
+        return result
+
+
+def add_profiles_command(store, name="profiles", *, path=None):
+    """
+    Register a command that can only be used over a websocket and returns the
+    profiles from the ``CommandProfiler`` given to the Commander.
+    """
+
+    @store.command(name, path=path, ws_only=True)
+    class Profiles(store.Command):
+        """Return the profiles we have collected for our commands"""
+
+        profiler = store.injected("profiler", nullable=True)
+
+        sort = dictobj.Field(sb.string_choice_spec(SORTS), default="cumulative")
+        limit = dictobj.Field(sb.integer_spec, default=20)
+        reset = dictobj.Field(sb.boolean, default=False)
+
+        async def execute(self):
+            if self.profiler is None:
+                return {"profiles": {}}
+
+            profiles = self.profiler.dump(sort=self.sort, limit=self.limit)
+            if self.reset:
+                self.profiler.reset()
+            return {"profiles": profiles}
+
+    return Profiles
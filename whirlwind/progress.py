@@ -0,0 +1,153 @@
+"""
+Policies for how progress messages are sent over a websocket.
+
+A policy makes a sender for each request. The handler calls ``add`` on the
+sender for each progress message and ``close`` before the final reply is sent
+so that nothing is left behind.
+
+.. code-block:: python
+
+    from whirlwind.progress import Coalesce
+
+    @store.command("download", progress=Coalesce(0.1))
+    class Download(store.Command):
+        ...
+"""
+
+import asyncio
+
+
+class Sender:
+    """Sends every message straight away"""
+
+    def __init__(self, send):
+        self.send = send
+        self.closed = False
+
+    def add(self, message):
+        self.send(message)
+
+    def close(self):
+        self.closed = True
+
+
+class TimedSender(Sender):
+    """Base for senders that hold onto messages until a timer fires"""
+
+    def __init__(self, send, interval):
+        super().__init__(send)
+        self.handle = None
+        self.interval = interval
+
+    def schedule(self):
+        if self.handle is None:
+            self.handle = asyncio.get_event_loop().call_later(self.interval, self.fire)
+
+    def fire(self):
+        self.handle = None
+        self.flush()
+
+    def flush(self):
+        raise NotImplementedError()
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.flush()
+        super().close()
+
+
+class CoalescingSender(TimedSender):
+    def __init__(self, send, interval):
+        super().__init__(send, interval)
+        self.last = None
+        self.pending = None
+
+    def add(self, message):
+        if self.closed:
+            self.send(message)
+            return
+
+        loop = asyncio.get_event_loop()
+        if self.handle is None and (self.last is None or loop.time() - self.last >= self.interval):
+            self.last = loop.time()
+            self.send(message)
+            return
+
+        self.pending = (message,)
+        self.schedule()
+
+    def flush(self):
+        if self.pending is not None:
+            message, self.pending = self.pending[0], None
+            self.last = asyncio.get_event_loop().time()
+            self.send(message)
+
+
+class BatchingSender(TimedSender):
+    def __init__(self, send, size, interval):
+        super().__init__(send, interval)
+        self.size = size
+        self.pending = []
+
+    def add(self, message):
+        if self.closed:
+            self.send({"batch": [message]})
+            return
+
+        self.pending.append(message)
+        if len(self.pending) >= self.size:
+            self.flush()
+        else:
+            self.schedule()
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if self.pending:
+            batch, self.pending = self.pending, []
+            self.send({"batch": batch})
+
+
+class Immediate:
+    """Send every progress message as its own reply"""
+
+    def sender(self, send):
+        return Sender(send)
+
+
+class Coalesce:
+    """
+    Send at most one progress message every ``interval`` seconds.
+
+    Messages that come in before we can send again replace each other so that
+    only the latest is sent.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def sender(self, send):
+        return CoalescingSender(send, self.interval)
+
+
+class Batch:
+    """
+    Send progress messages in groups of up to ``size`` messages, waiting at most
+    ``interval`` seconds before sending a smaller group.
+
+    Each group is sent as one reply of ``{"batch": [<message>, ...]}``
+    """
+
+    def __init__(self, size=10, interval=0.1):
+        self.size = size
+        self.interval = interval
+
+    def sender(self, send):
+        return BatchingSender(send, self.size, self.interval)
+
+
+immediate = Immediate()
@@ -0,0 +1,137 @@
+"""
+Give every reply and progress message to something slow, like an audit log,
+without waiting for it for each message.
+
+.. code-block:: python
+
+    from whirlwind.reply_sink import ReplySink
+
+    class Audit(ReplySink):
+        async def deliver(self, batch):
+            await audit_store.save([msg for msg, exc_info in batch])
+
+    sink = Audit(batch_size=100, interval=0.5, max_buffer=10000)
+    commander = Commander(store, whirlwind_reply_sink=sink)
+
+    # And when the server is finished
+    await sink.finish()
+
+Messages are kept in a buffer and given to ``deliver`` in batches of up to
+``batch_size`` messages, at least every ``interval`` seconds. Messages that
+don't fit in the buffer are dropped.
+"""
+
+from whirlwind.metrics import no_metrics
+from whirlwind.store import create_task
+
+from collections import deque
+import logging
+import asyncio
+
+log = logging.getLogger("whirlwind.reply_sink")
+
+
+class ReplySink:
+    """
+    Buffers ``(msg, exc_info)`` for each reply and gives them to ``deliver``
+    in batches
+
+    batch_size
+        The most messages given to ``deliver`` at once. A full batch is
+        delivered straight away
+
+    interval
+        The most seconds a message waits before it is delivered
+
+    max_buffer
+        The most messages we keep before we drop new ones
+    """
+
+    def __init__(self, *, batch_size=100, interval=1, max_buffer=10000, metrics=None):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.metrics = metrics
+
+        self.task = None
+        self.buffer = deque()
+        self.dropped = 0
+        self.finished = False
+        self.wakeup = None
+
+    async def deliver(self, batch):
+        """Hook that receives a list of ``(msg, exc_info)``"""
+        raise NotImplementedError()
+
+    def count(self, name, help, amount=1):
+        metrics = no_metrics if self.metrics is None else self.metrics
+        metrics.counter(name, help).inc(amount)
+
+    def add(self, msg, exc_info=None):
+        """Remember this message without waiting for it to be delivered"""
+        if self.finished or len(self.buffer) >= self.max_buffer:
+            self.dropped += 1
+            self.count(
+                "whirlwind_reply_sink_dropped_total", "Replies dropped because the buffer was full"
+            )
+            return False
+
+        self.buffer.append((msg, exc_info))
+        self.start()
+
+        if len(self.buffer) >= self.batch_size and not self.wakeup.done():
+            self.wakeup.set_result(True)
+        return True
+
+    def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Future()
+            self.task = create_task(self.deliver_batches(), name="<reply_sink>")
+
+    async def finish(self):
+        """Deliver what we have and stop"""
+        self.finished = True
+        if self.task is None:
+            return
+
+        if not self.wakeup.done():
+            self.wakeup.set_result(True)
+        await asyncio.wait([self.task])
+
+    async def deliver_batches(self):
+        while True:
+            if len(self.buffer) < self.batch_size and not self.finished:
+                await asyncio.wait([self.wakeup], timeout=self.interval)
+
+            if self.wakeup.done() and not self.finished:
+                self.wakeup = asyncio.Future()
+
+            while self.buffer:
+                batch = [
+                    self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))
+                ]
+                await self.deliver_batch(batch)
+                if not self.finished and len(self.buffer) < self.batch_size:
+                    break
+
+            if self.finished and not self.buffer:
+                return
+
+    async def deliver_batch(self, batch):
+        try:
+            await self.deliver(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            log.exception(error)
+            self.count(
+                "whirlwind_reply_sink_failed_total",
+                "Replies in batches that failed to deliver",
+                len(batch),
+            )
+        else:
+            self.count(
+                "whirlwind_reply_sink_delivered_total", "Replies delivered in batches", len(batch)
+            )
+        finally:
+            self.count("whirlwind_reply_sink_batches_total", "Batches of replies given to the sink")
@@ -1,12 +1,31 @@
-from whirlwind.request_handlers.base import Finished, MessageFromExc, Simple, SimpleWebSocketBase
-from whirlwind.request_handlers.command import ProgressMessageMaker, CommandHandler, WSHandler
+from whirlwind.request_handlers.base import (
+    Finished,
+    MessageFromExc,
+    Simple,
+    SimpleWebSocketBase,
+    JSONFraming,
+    MsgpackFraming,
+    CBORFraming,
+    MetricsHandler,
+)
+from whirlwind.request_handlers.command import (
+    ProgressMessageMaker,
+    CommandHandler,
+    LimitedCommandHandler,
+    WSHandler,
+)
 
 __all__ = [
     "Finished",
     "MessageFromExc",
     "Simple",
     "SimpleWebSocketBase",
+    "JSONFraming",
+    "MsgpackFraming",
+    "CBORFraming",
+    "MetricsHandler",
     "ProgressMessageMaker",
     "CommandHandler",
+    "LimitedCommandHandler",
     "WSHandler",
 ]
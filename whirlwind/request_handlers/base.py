@@ -1,6 +1,19 @@
+from whirlwind.commander import (
+    DeadlineExceeded,
+    within_deadline,
+    is_stream,
+    stream_items,
+    close_stream,
+    seconds_spec,
+)
+from whirlwind.connections import Connections
+from whirlwind.metrics import no_metrics
+from whirlwind.progress import immediate
+from whirlwind.tracing import trace
 from whirlwind.store import create_task
 
 from delfick_project.norms import sb, dictobj, Meta
+from tornado.iostream import StreamClosedError
 from tornado.web import RequestHandler, HTTPError
 from tornado import websocket
 import binascii
@@ -8,6 +21,7 @@ import logging
 import asyncio
 import json
 import uuid
+import sys
 
 log = logging.getLogger("whirlwind.request_handlers.base")
 
@@ -27,6 +41,116 @@ def reprer(o):
     return repr(o)
 
 
+class JSONFraming:
+    """
+    Turns websocket messages into text frames of JSON and back again
+    """
+
+    name = "json"
+    binary = False
+    subprotocol = None
+    available = True
+
+    def recognises(self, data):
+        return True
+
+    def dumps(self, msg, reprer):
+        return json.dumps(msg, default=reprer).replace("</", "<\\/")
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def normalise(self, msg, reprer):
+        return json.loads(json.dumps(msg, default=reprer, indent="    "))
+
+
+class MsgpackFraming:
+    """
+    Turns websocket messages into binary frames of MessagePack and back again
+
+    This requires the ``msgpack`` package and is used when the client asks for
+    the ``whirlwind.msgpack`` subprotocol or if the first binary frame from the
+    client is a MessagePack map.
+
+    ``bytes`` are sent as they are rather than being hexlified.
+    """
+
+    name = "msgpack"
+    binary = True
+    subprotocol = "whirlwind.msgpack"
+
+    @property
+    def msgpack(self):
+        return __import__("msgpack")
+
+    @property
+    def available(self):
+        try:
+            self.msgpack
+        except ImportError:
+            return False
+        return True
+
+    def recognises(self, data):
+        # The envelope is always a map, which is fixmap, map16 or map32
+        return bool(data) and (0x80 <= data[0] <= 0x8F or data[0] in (0xDE, 0xDF))
+
+    def dumps(self, msg, reprer):
+        return self.msgpack.packb(msg, default=reprer)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+    def normalise(self, msg, reprer):
+        return self.loads(self.dumps(msg, reprer))
+
+
+class CBORFraming:
+    """
+    Turns websocket messages into binary frames of CBOR and back again
+
+    This requires the ``cbor2`` package and is used when the client asks for
+    the ``whirlwind.cbor`` subprotocol or if the first binary frame from the
+    client is a CBOR map.
+
+    ``bytes`` are sent as they are rather than being hexlified.
+    """
+
+    name = "cbor"
+    binary = True
+    subprotocol = "whirlwind.cbor"
+
+    @property
+    def cbor2(self):
+        return __import__("cbor2")
+
+    @property
+    def available(self):
+        try:
+            self.cbor2
+        except ImportError:
+            return False
+        return True
+
+    def recognises(self, data):
+        # The envelope is always a map, optionally with the self describe tag
+        return bool(data) and (
+            0xA0 <= data[0] <= 0xBB or data[0] == 0xBF or data[:3] == b"\xd9\xd9\xf7"
+        )
+
+    def dumps(self, msg, reprer):
+        return self.cbor2.dumps(msg, default=lambda encoder, o: encoder.encode(reprer(o)))
+
+    def loads(self, data):
+        return self.cbor2.loads(data)
+
+    def normalise(self, msg, reprer):
+        return self.loads(self.dumps(msg, reprer))
+
+
+json_framing = JSONFraming()
+
+
 class MessageFromExc:
     def __init__(self, *, log_exceptions=True, see_exception=None):
         self.see_exception = see_exception
@@ -48,6 +172,12 @@ class MessageFromExc:
                 "error": "Request was cancelled",
                 "error_code": "RequestCancelled",
             }
+        elif isinstance(exc, DeadlineExceeded):
+            return {
+                "status": 500,
+                "error": str(exc),
+                "error_code": "RequestCancelled",
+            }
         else:
             if self.see_exception is None and self.log_exceptions:
                 log.error(exc, exc_info=(exc_type, exc, tb))
@@ -60,17 +190,30 @@ class MessageFromExc:
 
 
 class AsyncCatcher(object):
-    def __init__(self, request, info, final=None):
+    def __init__(self, request, info, final=None, span=None):
         self.info = info
+        self.span = span
         self.final = final
         self.request = request
 
     async def __aenter__(self):
-        pass
+        if self.span is not None:
+            self.span.__enter__()
 
     async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self.finish(exc_type, exc, tb)
+        finally:
+            if self.span is not None:
+                self.span.__exit__(exc_type, exc, tb)
+
+    async def finish(self, exc_type, exc, tb):
         if exc is None:
-            self.complete(self.info.get("result"), status=200)
+            result = self.info.get("result")
+            if self.final is None and is_stream(result):
+                await self.request.send_stream(result)
+            else:
+                self.complete(result, status=200)
             return
 
         msg = self.request.message_from_exc(exc_type, exc, tb)
@@ -96,7 +239,10 @@ class AsyncCatcher(object):
 
     def complete(self, msg, status=sb.NotSpecified, exc_info=None):
         if type(msg) is dict:
-            result = json.loads(json.dumps(msg, default=self.request.reprer, indent="    "))
+            if hasattr(self.request, "framing"):
+                result = self.request.framing.normalise(msg, self.request.reprer)
+            else:
+                result = json.loads(json.dumps(msg, default=self.request.reprer, indent="    "))
         else:
             result = msg
 
@@ -111,6 +257,9 @@ class RequestsMixin:
 
     _merged_options_formattable = True
 
+    # The number of bytes of a streamed response to collect before sending them
+    stream_chunk_size = 64 * 1024
+
     def hook(self, func, *args, **kwargs):
         if hasattr(self, func):
             return getattr(self, func)(*args, **kwargs)
@@ -149,8 +298,56 @@ class RequestsMixin:
     def message_from_exc(self, value):
         self._message_from_exc = value
 
-    def async_catcher(self, info, final=None):
-        return AsyncCatcher(self, info, final=final)
+    @property
+    def metrics(self):
+        if not hasattr(self, "_metrics"):
+            self._metrics = getattr(getattr(self, "commander", None), "metrics", no_metrics)
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, value):
+        self._metrics = value
+
+    def record_reply(self, transport, msg, serialised, exc_info=None):
+        """Record the size of a reply and any error it represents"""
+        metrics = self.metrics
+        metrics.counter(
+            "whirlwind_reply_bytes_total", "Bytes of serialised replies", ("transport",)
+        ).inc(len(serialised), transport=transport)
+
+        if exc_info and exc_info[1] is not None:
+            error_code = None
+            if type(msg) is dict:
+                error_code = msg.get("error_code")
+            if error_code is None:
+                error_code = exc_info[0].__name__
+
+            status = 500
+            if type(msg) is dict and "status" in msg:
+                status = msg["status"]
+            elif hasattr(exc_info[1], "status"):
+                status = exc_info[1].status
+
+            metrics.counter(
+                "whirlwind_errors_total", "Errors sent to clients", ("error_code", "status")
+            ).inc(error_code=error_code, status=status)
+
+    def record_progress(self, transport):
+        self.metrics.counter(
+            "whirlwind_progress_messages_total", "Progress messages", ("transport",)
+        ).inc(transport=transport)
+
+    tracer = None
+
+    def async_catcher(self, info, final=None, span=None):
+        return AsyncCatcher(self, info, final=final, span=span)
+
+    def trace(self, name, **attributes):
+        """Return a ``whirlwind.tracing`` span from our tracer or the current span"""
+        return trace(self.tracer, name, **attributes)
+
+    def request_span(self):
+        return self.trace("whirlwind.request", method=self.request.method, path=self.request.path)
 
     def body_as_json(self, body=None):
         """
@@ -228,14 +425,91 @@ class RequestsMixin:
 
         if type(msg) in (dict, list):
             self.set_header("Content-Type", "application/json; charset=UTF-8")
-            self.write(json.dumps(msg, default=self.reprer, sort_keys=True, indent="    "))
-        elif msg.lstrip().startswith("<html>") or msg.lstrip().startswith("<!DOCTYPE html>"):
-            self.write(msg)
+            with self.trace("whirlwind.serialise"):
+                serialised = json.dumps(msg, default=self.reprer, sort_keys=True, indent="    ")
         else:
-            self.set_header("Content-Type", "text/plain; charset=UTF-8")
-            self.write(msg)
+            serialised = msg
+            if not (
+                msg.lstrip().startswith("<html>") or msg.lstrip().startswith("<!DOCTYPE html>")
+            ):
+                self.set_header("Content-Type", "text/plain; charset=UTF-8")
+
+        self.record_reply("http", msg, serialised, exc_info=exc_info)
+        self.write(serialised)
         self.finish()
 
+    async def send_stream(self, items):
+        """
+        Send each item from this async iterator or generator as it is made.
+
+        The response is a JSON list unless the request ``Accept`` header asks
+        for ``application/x-ndjson``, in which case each item is a line of JSON.
+
+        Items are written to the connection whenever we have
+        ``stream_chunk_size`` bytes of them.
+
+        If the iterator raises an exception then the message for that exception
+        is sent as the last item.
+        """
+        ndjson = "application/x-ndjson" in self.request.headers.get("Accept", "")
+
+        self.set_status(200)
+        if ndjson:
+            self.set_header("Content-Type", "application/x-ndjson; charset=UTF-8")
+        else:
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.write("[")
+
+        buffered = 0
+        separator = ""
+
+        def write(msg, exc_info=None):
+            nonlocal buffered, separator
+
+            if hasattr(msg, "as_dict"):
+                msg = msg.as_dict()
+            self.hook("process_reply", msg, exc_info=exc_info)
+
+            with self.trace("whirlwind.serialise"):
+                serialised = json.dumps(msg, default=self.reprer, sort_keys=True)
+            self.record_reply("http", msg, serialised, exc_info=exc_info)
+
+            if ndjson:
+                self.write(serialised + "\n")
+            else:
+                self.write(separator + serialised)
+                separator = ","
+
+            buffered += len(serialised) + 1
+
+        cancelled = None
+        stream = stream_items(items)
+        try:
+            try:
+                async for item in stream:
+                    write(item)
+                    if buffered >= self.stream_chunk_size:
+                        buffered = 0
+                        await self.flush()
+            except StreamClosedError:
+                return
+            except (Exception, asyncio.CancelledError) as error:
+                exc_info = sys.exc_info()
+                write(self.message_from_exc(*exc_info), exc_info=exc_info)
+                if isinstance(error, asyncio.CancelledError):
+                    cancelled = error
+
+            if not ndjson:
+                self.write("]")
+            self.finish()
+        finally:
+            await stream.aclose()
+            await close_stream(items)
+
+        if cancelled is not None:
+            # The response is finished but we still stop when we're told to
+            raise cancelled
+
 
 class Simple(RequestsMixin, RequestHandler):
     """
@@ -266,7 +540,7 @@ class Simple(RequestsMixin, RequestHandler):
             raise HTTPError(405)
 
         info = {"result": None}
-        async with self.async_catcher(info):
+        async with self.async_catcher(info, span=self.request_span()):
             info["result"] = await self.do_get(*args, **kwargs)
 
     async def put(self, *args, **kwargs):
@@ -274,7 +548,7 @@ class Simple(RequestsMixin, RequestHandler):
             raise HTTPError(405)
 
         info = {"result": None}
-        async with self.async_catcher(info):
+        async with self.async_catcher(info, span=self.request_span()):
             info["result"] = await self.do_put(*args, **kwargs)
 
     async def post(self, *args, **kwargs):
@@ -282,7 +556,7 @@ class Simple(RequestsMixin, RequestHandler):
             raise HTTPError(405)
 
         info = {"result": None}
-        async with self.async_catcher(info):
+        async with self.async_catcher(info, span=self.request_span()):
             info["result"] = await self.do_post(*args, **kwargs)
 
     async def patch(self, *args, **kwargs):
@@ -290,7 +564,7 @@ class Simple(RequestsMixin, RequestHandler):
             raise HTTPError(405)
 
         info = {"result": None}
-        async with self.async_catcher(info):
+        async with self.async_catcher(info, span=self.request_span()):
             info["result"] = await self.do_patch(*args, **kwargs)
 
     async def delete(self, *args, **kwargs):
@@ -298,15 +572,30 @@ class Simple(RequestsMixin, RequestHandler):
             raise HTTPError(405)
 
         info = {"result": None}
-        async with self.async_catcher(info):
+        async with self.async_catcher(info, span=self.request_span()):
             info["result"] = await self.do_delete(*args, **kwargs)
 
 
+class MetricsHandler(RequestHandler):
+    """
+    Serves the metrics in a ``whirlwind.metrics.Metrics`` in the Prometheus
+    text format
+    """
+
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(self.metrics.exposition())
+
+
 json_spec = sb.match_spec(
     (bool, sb.any_spec()),
     (int, sb.any_spec()),
     (float, sb.any_spec()),
     (str, sb.any_spec()),
+    (bytes, sb.any_spec()),
     (list, lambda: sb.listof(json_spec)),
     (type(None), sb.any_spec()),
     fallback=lambda: sb.dictof(sb.string_spec(), json_spec),
@@ -327,15 +616,57 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
 
     It treats path of ``__tick__`` as special and respond with ``{"reply": {"ok": "thankyou"}, "message_id": "__tick__"}``
 
+    Messages may also have a ``timeout`` of how many seconds the request may
+    take before it is cancelled and a ``RequestCancelled`` error is sent back.
+
     It relies on the client side closing the connection when it's finished.
+
+    Messages are JSON text frames by default. A client may instead ask for one
+    of the ``framings`` as a websocket subprotocol, or send a binary frame as its
+    first message, and then replies are sent as binary frames in that format.
+
+    Progress messages are sent as they are made unless a ``progress_policy``
+    from ``whirlwind.progress`` is given to the handler.
+
+    If the handler is given ``sessions`` from ``whirlwind.sessions`` then
+    clients may reconnect and carry on with the commands they started.
+
+    If the application has a ``websocket_ping_interval`` setting then tornado
+    pings the client and closes the connection when a ping isn't answered
+    within ``websocket_ping_timeout`` seconds. When that connection closes we
+    count it as evicted.
     """
 
     log_exceptions = True
 
-    def initialize(self, final_future, server_time, wsconnections):
+    framing = json_framing
+    framings = (MsgpackFraming(), CBORFraming())
+
+    progress_policy = immediate
+
+    session = None
+    sessions = None
+
+    connection_lost = False
+
+    def initialize(
+        self,
+        final_future,
+        server_time,
+        wsconnections,
+        metrics=None,
+        progress_policy=None,
+        sessions=None,
+    ):
         self.server_time = server_time
         self.final_future = final_future
         self.wsconnections = wsconnections
+        if metrics is not None:
+            self.metrics = metrics
+        if progress_policy is not None:
+            self.progress_policy = progress_policy
+        if sessions is not None:
+            self.sessions = sessions
 
     class WSMessage(dictobj.Spec):
         path = dictobj.Field(sb.string_spec, wrapper=sb.required)
@@ -345,26 +676,90 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
         body = dictobj.Field(json_spec, wrapper=sb.required)
 
     message_spec = WSMessage.FieldSpec()
+    timeout_spec = sb.or_spec(sb.none_spec(), seconds_spec())
 
     class Closing(object):
         pass
 
+    def select_subprotocol(self, subprotocols):
+        for framing in self.framings:
+            if framing.subprotocol in subprotocols and framing.available:
+                self.framing = framing
+                return framing.subprotocol
+
+    def framing_for(self, message):
+        """
+        Return the framing to decode this message with
+
+        Text frames are always JSON. If the connection hasn't chosen a binary
+        framing yet then the first binary frame decides what it will be.
+        """
+        if not isinstance(message, bytes):
+            return json_framing
+
+        if not self.framing.binary:
+            for framing in self.framings:
+                if framing.available and framing.recognises(message):
+                    self.framing = framing
+                    break
+
+        return self.framing
+
     def open(self):
         self.key = str(uuid.uuid1())
+        self.metrics.gauge("whirlwind_websocket_connections", "Open websocket connections").inc()
+
+        self.last_pong = asyncio.get_event_loop().time()
+
+        if self.sessions is not None and self.resume_session():
+            return
+
         self.connection_future = asyncio.Future()
-        if self.final_future.done():
-            self.connection_future.cancel()
+        Connections.of(self.final_future).add(self.connection_future)
+        if self.connection_future.done():
             return
 
-        canceller = lambda res: self.connection_future.cancel()
-        self.final_future.add_done_callback(canceller)
-        self.connection_future.add_done_callback(
-            lambda res: self.final_future.remove_done_callback(canceller)
-        )
+        if self.server_time is not None:
+            self.reply(self.server_time, message_id="__server_time__")
+
+        if self.sessions is not None:
+            self.session = self.sessions.start(self, self.connection_future)
+            self.reply({"session": self.session.token, "resumed": False}, message_id="__session__")
+
+        self.hook("websocket_opened")
+
+    def resume_session(self):
+        """
+        Attach to the session asked for by the client and send the replies it
+        missed. Return whether there was a session to resume.
+        """
+        token = self.get_query_argument("session", None)
+        self.session = self.sessions.resume(token, self)
+        if self.session is None:
+            return False
+
+        try:
+            ack = int(self.get_query_argument("ack", "0"))
+        except ValueError:
+            ack = 0
+
+        self.connection_future = self.session.connection_future
+        self.session.ack(ack)
 
         if self.server_time is not None:
             self.reply(self.server_time, message_id="__server_time__")
+
+        resumed = {
+            "session": self.session.token,
+            "resumed": True,
+            "missed": self.session.missed(ack),
+        }
+        self.reply(resumed, message_id="__session__")
+        for reply in self.session.since(ack):
+            self.write_reply(reply)
+
         self.hook("websocket_opened")
+        return True
 
     def reply(self, msg, message_id=None, exc_info=None):
         if msg is None:
@@ -374,20 +769,70 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
         if hasattr(msg, "as_dict"):
             msg = msg.as_dict()
         reply = {"reply": msg, "message_id": message_id}
-        reply = json.dumps(reply, default=self.reprer).replace("</", "<\\/")
 
-        if message_id not in ("__tick__", "__server_time__"):
-            self.hook("process_reply", msg, exc_info=exc_info)
+        if message_id in ("__tick__", "__server_time__", "__session__"):
+            self.write_reply(reply)
+            return
 
-        if self.ws_connection:
-            self.write_message(reply)
+        # Replies for a session go to whichever connection it has now
+        handler = self
+        if self.session is not None:
+            reply = self.session.add(reply)
+            handler = self.session.handler or self
+
+        serialised = handler.write_reply(reply)
+        self.record_reply("websocket", msg, serialised, exc_info=exc_info)
+        self.hook("process_reply", msg, exc_info=exc_info)
+
+    def write_reply(self, reply):
+        """Serialise this reply and send it if the connection is open"""
+        with self.trace("whirlwind.serialise"):
+            serialised = self.framing.dumps(reply, self.reprer)
+        if self.ws_connection and (self.session is None or self.session.handler is self):
+            self.write_message(serialised, binary=self.framing.binary)
+        return serialised
+
+    def ping_timed_out(self):
+        """
+        Return whether tornado closed this connection because the client
+        stopped answering pings
+
+        Tornado pings every ``ping_interval`` seconds and closes the connection
+        when a ping isn't answered within ``ping_timeout`` seconds, so by then it
+        has been more than ``ping_interval`` seconds since the last pong.
+        """
+        if not self.ping_interval:
+            return False
+
+        timeout = self.ping_interval if self.ping_timeout is None else self.ping_timeout
+        if timeout <= 0:
+            return False
+
+        since = asyncio.get_event_loop().time() - self.last_pong
+        return since > self.ping_interval + timeout / 2
+
+    def evict(self):
+        """Record that this connection was closed for not answering pings"""
+        self.metrics.counter(
+            "whirlwind_websocket_evictions_total", "Websockets closed for not answering pings"
+        ).inc()
+        self.hook("websocket_evicted")
+
+    def on_pong(self, data):
+        self.last_pong = asyncio.get_event_loop().time()
 
     def on_message(self, message):
         self.hook("websocket_message", message)
+        framing = self.framing_for(message)
         try:
-            parsed = json.loads(message)
+            parsed = framing.loads(message)
         except (TypeError, ValueError) as error:
-            self.reply({"error": "Message wasn't valid json\t{0}".format(str(error))})
+            self.reply({"error": "Message wasn't valid {0}\t{1}".format(framing.name, str(error))})
+            return
+
+        if self.session is not None and type(parsed) is dict and parsed.get("path") == "__ack__":
+            if isinstance(parsed.get("seq"), int):
+                self.session.ack(parsed["seq"])
             return
 
         if type(parsed) is dict and "path" in parsed and parsed["path"] == "__tick__":
@@ -396,6 +841,7 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
 
         try:
             msg = self.message_spec.normalise(Meta.empty(), parsed)
+            timeout = self.timeout_spec.normalise(Meta.empty().at("timeout"), parsed.get("timeout"))
         except Exception as error:
             self.hook("websocket_invalid_message", error, parsed)
 
@@ -415,9 +861,20 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
                 self.reply({"ok": "thankyou"}, message_id=message_id)
                 return
 
+            def send_progress(m):
+                self.record_progress("websocket")
+                self.reply(m, message_id=message_id)
+
+            sender = self.progress_policy_for(path, body, message_id).sender(send_progress)
+            chosen = False
+
             def on_processed(final, exc_info=None):
+                sender.close()
+
                 if final is self.Closing:
                     self.reply({"closing": "goodbye"}, message_id=message_id)
+                    if self.session is not None:
+                        self.sessions.end(self.session)
                     self.close()
                 else:
                     self.reply(final, message_id=message_id, exc_info=exc_info)
@@ -432,9 +889,19 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
 
                 def progress_cb(progress, **kwargs):
                     for m in self.transform_progress(msg, progress, **kwargs):
-                        self.reply(m, message_id=message_id)
+                        sender.add(m)
+
+                def use_policy(policy):
+                    nonlocal sender, chosen
+                    if not chosen:
+                        chosen = True
+                        sender.close()
+                        sender = policy.sender(send_progress)
 
-                async with self.async_catcher(info, on_processed):
+                # Lets the executor use the progress policy of the command
+                progress_cb.use_policy = use_policy
+
+                async def process():
                     result = await self.process_message(
                         path, body, message_id, message_key, progress_cb
                     )
@@ -442,15 +909,41 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
                     if isinstance(result, asyncio.Future) or hasattr(result, "__await__"):
                         result = await result
 
-                    info["result"] = result
+                    if not is_stream(result):
+                        return result
+
+                    # Each item is a reply and the final reply is done
+                    sender.close()
+                    stream = stream_items(result)
+                    try:
+                        async for item in stream:
+                            self.reply(item, message_id=message_id)
+                    finally:
+                        await stream.aclose()
+
+                span = self.trace("whirlwind.message", path=path, message_id=message_id)
+                async with self.async_catcher(info, on_processed, span=span):
+                    processing = process()
+
+                    if timeout is not None:
+                        deadline = asyncio.get_event_loop().time() + timeout
+                        processing = within_deadline(processing, deadline)
+
+                    info["result"] = await processing
 
             def done(res):
+                in_flight.dec()
                 if message_key in self.wsconnections:
                     del self.wsconnections[message_key]
 
                 if not res.cancelled():
                     self.handle_request_done_exception(res.exception())
 
+            in_flight = self.metrics.gauge(
+                "whirlwind_websocket_messages_in_flight", "Websocket messages being processed"
+            )
+            in_flight.inc()
+
             t = create_task(doit(), name=f"<process_command: {body}>")
             t.add_done_callback(done)
             self.wsconnections[message_key] = t
@@ -503,6 +996,14 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
         if error and self.log_exceptions:
             log.exception(error, exc_info=(type(error), error, error.__traceback__))
 
+    def progress_policy_for(self, path, body, message_id):
+        """
+        Hook returning the policy from ``whirlwind.progress`` used to send the
+        progress messages for this request. By default this is the
+        ``progress_policy`` of the handler.
+        """
+        return self.progress_policy
+
     def transform_progress(self, body, progress, **kwargs):
         """
         Hook for transforming progress messages. This must be a generator that yields 0 or more messages
@@ -544,4 +1045,18 @@ class SimpleWebSocketBase(RequestsMixin, websocket.WebSocketHandler):
 
     def on_close(self):
         """Hook for when a websocket connection closes"""
-        self.connection_future.cancel()
+        if not self.connection_lost and self.ping_timed_out():
+            self.evict()
+        self.lose_connection()
+
+    def lose_connection(self):
+        """Stop the commands for this connection, or detach it from its session"""
+        if self.connection_lost:
+            return
+        self.connection_lost = True
+
+        self.metrics.gauge("whirlwind_websocket_connections", "Open websocket connections").dec()
+        if self.session is not None and not self.connection_future.done():
+            self.sessions.detach(self.session, self)
+        else:
+            self.connection_future.cancel()
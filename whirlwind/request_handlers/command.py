@@ -1,6 +1,10 @@
 from whirlwind.request_handlers.base import Simple, SimpleWebSocketBase, Finished
+from whirlwind.commander import seconds_spec
 from whirlwind.store import NoSuchPath
 
+from delfick_project.norms import Meta, BadSpecValue
+from tornado.web import stream_request_body
+from tornado import httputil
 import logging
 import inspect
 
@@ -62,10 +66,18 @@ class ProcessReplyMixin:
 
 
 class CommandHandler(Simple, ProcessReplyMixin):
+    """
+    Executes the command in the body of a PUT request
+
+    The ``X-Whirlwind-Timeout`` header may be used to say how many seconds the
+    command may take before it is cancelled.
+    """
+
     progress_maker = ProgressMessageMaker
 
     def initialize(self, commander):
         self.commander = commander
+        self.tracer = commander.tracer
 
     async def do_put(self):
         j = self.body_as_json()
@@ -73,14 +85,28 @@ class CommandHandler(Simple, ProcessReplyMixin):
         def progress_cb(message, stack_extra=0, **kwargs):
             maker = self.progress_maker(1 + stack_extra)
             info = maker(j, message, **kwargs)
+            self.record_progress("http")
             self.process_reply(info)
 
         path = self.request.path
         while path and path.endswith("/"):
             path = path[:-1]
 
+        kwargs = {}
+        timeout = self.request.headers.get("X-Whirlwind-Timeout")
+        if timeout is not None:
+            try:
+                kwargs["timeout"] = seconds_spec().normalise(
+                    Meta.empty().at("X-Whirlwind-Timeout"), timeout
+                )
+            except BadSpecValue:
+                raise Finished(
+                    status=400,
+                    error="X-Whirlwind-Timeout must be a finite number of seconds more than zero",
+                )
+
         try:
-            return await self.commander.executor(progress_cb, self).execute(path, j)
+            return await self.commander.executor(progress_cb, self).execute(path, j, **kwargs)
         except NoSuchPath as error:
             raise Finished(
                 status=404,
@@ -90,12 +116,109 @@ class CommandHandler(Simple, ProcessReplyMixin):
             )
 
 
+@stream_request_body
+class LimitedCommandHandler(CommandHandler):
+    """
+    A ``CommandHandler`` that refuses bodies larger than ``max_body_size`` bytes
+
+    The body is streamed to this handler and ``data_received`` counts the bytes
+    as they arrive. Once there are too many it replies with a 413, which makes
+    tornado close the connection rather than read the rest of the body.
+
+    ``prepare`` also refuses a body with a ``Content-Length`` that is too large
+    before any of it is read. A subclass that overrides ``prepare`` without
+    calling it still has its bodies limited by ``data_received``.
+
+    The chunks of the body are joined into ``self.request.body`` and a
+    multipart form is parsed into ``self.request.files`` before the method for
+    the verb is called, like tornado does for other handlers.
+    """
+
+    max_body_size = None
+
+    def initialize(self, commander, max_body_size=None):
+        super().initialize(commander)
+        self.chunks = []
+        self.received = 0
+        if max_body_size is not None:
+            self.max_body_size = max_body_size
+
+    def prepare(self):
+        if self.max_body_size is None:
+            return
+
+        length = self.request.headers.get("Content-Length")
+        if length is not None and length.isdigit() and int(length) > self.max_body_size:
+            self.too_large()
+            return
+
+        # So that tornado also stops a chunked body that is too big
+        self.request.connection.set_max_body_size(self.max_body_size)
+
+    def too_large(self):
+        self.chunks = []
+        self.send_msg(
+            {"status": 413, "error": "Body is too large", "max_body_size": self.max_body_size}
+        )
+
+    def data_received(self, chunk):
+        if self._finished:
+            return
+
+        self.received += len(chunk)
+        if self.max_body_size is not None and self.received > self.max_body_size:
+            self.too_large()
+            return
+
+        self.chunks.append(chunk)
+
+    def received_body(self):
+        """
+        Put the chunks we received into ``self.request`` like tornado would have
+
+        Return False if we already replied because the body was too large
+        """
+        if self._finished:
+            return False
+
+        request = self.request
+        request.body, self.chunks = b"".join(self.chunks), []
+        httputil.parse_body_arguments(
+            request.headers.get("Content-Type", ""),
+            request.body,
+            request.body_arguments,
+            request.files,
+            request.headers,
+        )
+        for name, values in request.body_arguments.items():
+            request.arguments.setdefault(name, []).extend(values)
+        return True
+
+    async def put(self, *args, **kwargs):
+        if self.received_body():
+            await super().put(*args, **kwargs)
+
+    async def post(self, *args, **kwargs):
+        if self.received_body():
+            await super().post(*args, **kwargs)
+
+    async def patch(self, *args, **kwargs):
+        if self.received_body():
+            await super().patch(*args, **kwargs)
+
+    async def delete(self, *args, **kwargs):
+        if self.received_body():
+            await super().delete(*args, **kwargs)
+
+
 class WSHandler(SimpleWebSocketBase, ProcessReplyMixin):
     progress_maker = ProgressMessageMaker
 
-    def initialize(self, final_future, server_time, wsconnections, commander):
+    def initialize(self, final_future, server_time, wsconnections, commander, **kwargs):
         self.commander = commander
-        super().initialize(final_future, server_time, wsconnections)
+        self.tracer = commander.tracer
+        self.executor = commander.executor(None, self)
+        super().initialize(final_future, server_time, wsconnections, **kwargs)
 
     def transform_progress(self, body, progress, stack_extra=0, **kwargs):
         maker = self.progress_maker(2 + stack_extra)
@@ -103,8 +226,8 @@ class WSHandler(SimpleWebSocketBase, ProcessReplyMixin):
 
     async def process_message(self, path, body, message_id, message_key, progress_cb):
         try:
-            executor = self.commander.executor(
-                progress_cb, self, message_key=message_key, message_id=message_id
+            executor = self.executor.for_message(
+                progress_cb, message_key=message_key, message_id=message_id
             )
             return await executor.execute(
                 path, body, allow_ws_only=True, request_future=self.connection_future
@@ -0,0 +1,328 @@
+"""
+Route children of interactive commands to the worker that owns their parent.
+
+Interactive commands live in the process that started them. When several
+workers serve the same clients, a child message may arrive at a worker that
+doesn't have the parent. A ``Router`` records which worker owns each parent in
+a shared registry of routes and forwards children to that worker over a unix
+socket.
+
+.. code-block:: python
+
+    from whirlwind.routing import Router, FileRoutes
+
+    router = Router(FileRoutes("/tmp/whirlwind-routes"), "/tmp/whirlwind-worker-1.sock")
+    commander = Commander(store, whirlwind_router=router)
+
+    await router.start(commander)
+    try:
+        ...
+    finally:
+        await router.finish()
+"""
+
+from whirlwind.request_handlers.base import MessageFromExc, Finished
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import asyncio
+import logging
+import json
+import os
+
+log = logging.getLogger("whirlwind.routing")
+
+
+def route_key(parent):
+    """The string used to identify the parent message id in a registry"""
+    return json.dumps(list(parent))
+
+
+class MemoryRoutes:
+    """
+    Routes that only live in this process
+
+    This is useful for tests and for sharing between routers in one process.
+    """
+
+    def __init__(self):
+        self.owners = {}
+
+    async def start(self):
+        pass
+
+    async def finish(self):
+        pass
+
+    def claim(self, parent, worker):
+        self.owners[route_key(parent)] = worker
+
+    def owner(self, parent):
+        return self.owners.get(route_key(parent))
+
+    def release(self, parent, worker):
+        key = route_key(parent)
+        if self.owners.get(key) == worker:
+            del self.owners[key]
+
+
+class FileRoutes:
+    """
+    Routes stored as files in a directory so all the workers on one machine can
+    see them
+
+    Each route is a file named after a hash of the parent message id that
+    contains the address of the worker that owns it.
+
+    Lookups only use a copy of the routes in memory. Files are written and read
+    in a thread and the copy is refreshed from the directory every
+    ``refresh_every`` seconds between ``start`` and ``finish``. Routes claimed
+    by this process are seen straight away and routes claimed by other workers
+    are seen after the next refresh.
+    """
+
+    def __init__(self, directory, refresh_every=0.5):
+        self.directory = directory
+        self.refresh_every = refresh_every
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.mine = {}
+        self.owners = {}
+        self.refresher = None
+        self.io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whirlwind-routes")
+
+    async def start(self):
+        await self.refresh()
+        if self.refresher is None:
+            self.refresher = asyncio.get_event_loop().create_task(self.refresh_forever())
+
+    async def finish(self):
+        if self.refresher is not None:
+            self.refresher.cancel()
+            await asyncio.wait([self.refresher])
+            self.refresher = None
+
+        # Make sure our routes are written before we stop
+        await asyncio.wrap_future(self.io.submit(lambda: None))
+
+    async def refresh(self):
+        """Replace our copy of the routes with what is in the directory"""
+        self.owners = await asyncio.wrap_future(self.io.submit(self.read))
+
+    async def refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_every)
+            try:
+                await self.refresh()
+            except Exception as error:
+                log.exception(error)
+
+    def name(self, parent):
+        return hashlib.sha1(route_key(parent).encode()).hexdigest()
+
+    def claim(self, parent, worker):
+        name = self.name(parent)
+        self.mine[name] = worker
+        self.in_thread(self.write, name, worker)
+
+    def owner(self, parent):
+        name = self.name(parent)
+        if name in self.mine:
+            return self.mine[name]
+        return self.owners.get(name)
+
+    def release(self, parent, worker):
+        name = self.name(parent)
+        if self.mine.get(name) == worker:
+            del self.mine[name]
+        if self.owners.get(name) == worker:
+            del self.owners[name]
+        self.in_thread(self.remove, name, worker)
+
+    def in_thread(self, func, *args):
+        def done(fut):
+            if not fut.cancelled() and fut.exception() is not None:
+                log.error("Failed to update routes", exc_info=fut.exception())
+
+        self.io.submit(func, *args).add_done_callback(done)
+
+    def read(self):
+        owners = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as fle:
+                    owners[name] = fle.read()
+            except (FileNotFoundError, IsADirectoryError):
+                pass
+        return owners
+
+    def write(self, name, worker):
+        location = os.path.join(self.directory, name)
+        tmp = f"{location}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fle:
+            fle.write(worker)
+        os.replace(tmp, location)
+
+    def remove(self, name, worker):
+        location = os.path.join(self.directory, name)
+        try:
+            with open(location) as fle:
+                if fle.read() != worker:
+                    return
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+
+class ForwardedRequest:
+    """Used as the request_handler for children forwarded from another worker"""
+
+    _merged_options_formattable = True
+
+    def __init__(self, origin):
+        self.origin = origin
+
+
+class Router:
+    """
+    Records the interactive commands started by this worker in ``routes`` and
+    forwards children to the worker that owns their parent.
+
+    ``address`` is the path of the unix socket this worker listens on for
+    children forwarded by other workers.
+    """
+
+    message_from_exc = MessageFromExc(log_exceptions=False)
+
+    def __init__(self, routes, address):
+        self.routes = routes
+        self.address = address
+        self.server = None
+
+    async def start(self, commander):
+        self.commander = commander
+        await self.routes.start()
+        self.server = await asyncio.start_unix_server(self.handle, path=self.address)
+
+    async def finish(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        await self.routes.finish()
+
+    def claim(self, parent):
+        self.routes.claim(parent, self.address)
+
+    def release(self, parent):
+        self.routes.release(parent, self.address)
+
+    def remote_owner(self, store, message_id):
+        """
+        Return the address of the worker that owns the parent of this message
+        if that isn't us
+        """
+        if not isinstance(message_id, (list, tuple)) or len(message_id) < 2:
+            return None
+
+        parent = tuple(message_id[:-1])
+        if parent in store.command_spec.existing_commands:
+            return None
+
+        owner = self.routes.owner(parent)
+        if owner is None or owner == self.address:
+            return None
+        return owner
+
+    async def forward(self, owner, path, body, message_id, progress_cb, allow_ws_only=False):
+        """Execute this child on the worker that owns the parent"""
+        request = {
+            "path": path,
+            "body": body,
+            "message_id": list(message_id),
+            "allow_ws_only": allow_ws_only,
+        }
+
+        reader, writer = await asyncio.open_unix_connection(owner)
+        try:
+            writer.write(self.dumps(request))
+            await writer.drain()
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise Finished(
+                        status=502, error="Lost connection to the worker with the parent command"
+                    )
+
+                msg = json.loads(line)
+                if "progress" in msg:
+                    if progress_cb is not None:
+                        message, kwargs = msg["progress"]
+                        progress_cb(message, **kwargs)
+                elif "error" in msg:
+                    raise Finished(**msg["error"])
+                else:
+                    return msg["reply"]
+        finally:
+            writer.close()
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+
+            def progress_cb(message, **kwargs):
+                writer.write(self.dumps({"progress": [message, kwargs]}))
+
+            executor = self.commander.executor(
+                progress_cb, ForwardedRequest(request), message_id=tuple(request["message_id"])
+            )
+
+            # The worker that forwarded this child closes the connection if its
+            # requester goes away, and then we cancel the child
+            loop = asyncio.get_event_loop()
+            execute = loop.create_task(
+                executor.execute(
+                    request["path"], request["body"], allow_ws_only=request["allow_ws_only"]
+                )
+            )
+            disconnected = loop.create_task(self.wait_for_close(reader))
+
+            try:
+                await asyncio.wait([execute, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                disconnected.cancel()
+                if not execute.done():
+                    execute.cancel()
+                    await asyncio.wait([execute])
+
+            if execute.cancelled():
+                return
+
+            error = execute.exception()
+            if error is not None:
+                msg = {"error": self.message_from_exc(type(error), error, error.__traceback__)}
+            else:
+                msg = {"reply": execute.result()}
+
+            writer.write(self.dumps(msg))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as error:
+            log.exception(error)
+        finally:
+            writer.close()
+
+    async def wait_for_close(self, reader):
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+
+    def dumps(self, msg):
+        return json.dumps(msg, default=repr).encode() + b"\n"
@@ -1,5 +1,10 @@
+from whirlwind.request_handlers.base import MetricsHandler
+from whirlwind.connections import Connections
+from whirlwind.metrics import default_metrics, no_metrics
+
 from tornado.httpserver import HTTPServer
 import tornado.web
+import asyncio
 import logging
 
 log = logging.getLogger("whirlwind.server")
@@ -9,16 +14,191 @@ class ForcedQuit(Exception):
     pass
 
 
+class ConnectionPolicy:
+    """
+    Limits on the connections made to the server
+
+    max_connections
+        The number of connections we serve at once. New connections past this
+        are sent a 503 and closed straight away
+
+    idle_connection_timeout
+        Seconds a kept alive connection may wait for its next request
+
+    header_timeout
+        Seconds a client has to send the headers of a request. This defaults to
+        the ``idle_connection_timeout``
+
+    body_timeout
+        Seconds a client has to send the body of a request
+
+    max_buffer_size
+        Bytes we may buffer for a connection
+
+    max_body_size
+        Bytes a request body may be
+
+    chunk_size
+        Bytes we read from a connection at a time
+
+    Anything that isn't specified uses the default from tornado.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_connections=None,
+        idle_connection_timeout=None,
+        header_timeout=None,
+        body_timeout=None,
+        max_buffer_size=None,
+        max_body_size=None,
+        chunk_size=None,
+    ):
+        self.chunk_size = chunk_size
+        self.body_timeout = body_timeout
+        self.max_body_size = max_body_size
+        self.header_timeout = header_timeout
+        self.max_buffer_size = max_buffer_size
+        self.max_connections = max_connections
+        self.idle_connection_timeout = idle_connection_timeout
+
+    def http_server_kwargs(self):
+        """The options given to a ``LimitedHTTPServer``"""
+        kwargs = {
+            "chunk_size": self.chunk_size,
+            "body_timeout": self.body_timeout,
+            "max_body_size": self.max_body_size,
+            "header_timeout": self.header_timeout,
+            "max_buffer_size": self.max_buffer_size,
+            "max_connections": self.max_connections,
+            "idle_connection_timeout": self.idle_connection_timeout,
+        }
+        return {k: v for k, v in kwargs.items() if v is not None}
+
+
+class LimitedHTTPServer(HTTPServer):
+    """
+    A HTTPServer that refuses connections when it already has
+    ``max_connections`` and lets the ``header_timeout`` be different to the
+    ``idle_connection_timeout``
+
+    Websocket connections stop counting towards ``max_connections`` once they
+    have been upgraded.
+    """
+
+    refused = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+    def initialize(
+        self,
+        request_callback,
+        *,
+        max_connections=None,
+        header_timeout=None,
+        metrics=no_metrics,
+        **kwargs,
+    ):
+        super().initialize(request_callback, **kwargs)
+        if header_timeout is not None:
+            self.conn_params.header_timeout = header_timeout
+
+        self.metrics = metrics
+        self.connections = 0
+        self.max_connections = max_connections
+
+    def handle_stream(self, stream, address):
+        if self.max_connections is not None and self.connections >= self.max_connections:
+            self.metrics.counter(
+                "whirlwind_http_connections_refused_total",
+                "Connections refused because we had too many",
+            ).inc()
+            self.refuse(stream)
+            return
+
+        self.connections += 1
+        self.metrics.gauge("whirlwind_http_connections", "Open HTTP connections").inc()
+        super().handle_stream(stream, address)
+
+    def on_close(self, server_conn):
+        self.connections -= 1
+        self.metrics.gauge("whirlwind_http_connections", "Open HTTP connections").dec()
+        super().on_close(server_conn)
+
+    def refuse(self, stream):
+        def close(res):
+            if not res.cancelled():
+                res.exception()
+            stream.close()
+
+        try:
+            stream.write(self.refused).add_done_callback(close)
+        except Exception:
+            stream.close()
+
+
 class Server(object):
-    def __init__(self, final_future, *, server_end_future=None):
+    """
+    If ``connection_policy`` is given, it is a ``ConnectionPolicy`` with the
+    limits for the http server
+
+    If ``websocket_ping_interval`` is given, websocket clients are pinged every
+    that many seconds and connections that don't answer within
+    ``websocket_ping_timeout`` seconds are closed and their commands cancelled.
+
+    The websocket connections are kept in ``self.connections``, a
+    ``whirlwind.connections.Connections`` that cancels all of them when the
+    ``final_future`` is done.
+
+    If ``log_pipeline`` is given, it is a ``whirlwind.log_pipeline.LogPipeline``
+    that writes logs from a thread while we serve.
+
+    If ``tracer`` is given, it is the ``whirlwind.tracing.Tracer`` given to the
+    ``Commander`` and it is closed after ``cleanup`` so that its exporter can
+    finish writing spans.
+    """
+
+    def __init__(
+        self,
+        final_future,
+        *,
+        server_end_future=None,
+        metrics=None,
+        connection_policy=None,
+        websocket_ping_interval=None,
+        websocket_ping_timeout=None,
+        log_pipeline=None,
+        tracer=None,
+    ):
         self.final_future = final_future
         if server_end_future is None:
             server_end_future = final_future
         self.server_end_future = server_end_future
+        self.connection_policy = connection_policy
+        self.websocket_ping_interval = websocket_ping_interval
+        self.websocket_ping_timeout = websocket_ping_timeout
+        self.metrics = default_metrics if metrics is None else metrics
+        self.connections = Connections.of(final_future)
+
+        self.tracer = tracer
+        self.log_pipeline = log_pipeline
+        if log_pipeline is not None and log_pipeline.metrics is None:
+            log_pipeline.metrics = self.metrics
 
     async def serve(self, host, port, *args, **kwargs):
         self.port = port
         self.host = host
+
+        if self.log_pipeline is not None:
+            self.log_pipeline.start()
+
+        try:
+            await self.run_server(*args, **kwargs)
+        finally:
+            if self.log_pipeline is not None:
+                self.log_pipeline.stop()
+
+    async def run_server(self, *args, **kwargs):
+        """Set up the http server and serve until we are told to stop"""
         self.server_kwargs = await self.setup(*args, **kwargs)
         if self.server_kwargs is None:
             self.server_kwargs = {}
@@ -28,6 +208,11 @@ class Server(object):
         self.announce_start()
 
         self.http_server.listen(self.port, self.host)
+
+        self.loop_monitor = self.make_loop_monitor()
+        if self.loop_monitor is not None:
+            self.loop_monitor.start()
+
         try:
             await self.wait_for_end()
         except ForcedQuit:
@@ -36,7 +221,16 @@ class Server(object):
             try:
                 self.http_server.stop()
             finally:
-                await self.cleanup()
+                try:
+                    await self.cleanup()
+                finally:
+                    try:
+                        if self.tracer is not None:
+                            # Wait for the exporter without blocking the loop
+                            await asyncio.get_event_loop().run_in_executor(None, self.tracer.close)
+                    finally:
+                        if self.loop_monitor is not None:
+                            await self.loop_monitor.stop()
 
     async def wait_for_end(self):
         """Hook that will end when we need to stop the server"""
@@ -48,11 +242,30 @@ class Server(object):
 
         We expect it at least has ``listen(port, host)`` and ``stop()``
         """
-        return HTTPServer(self.make_application(routes, server_kwargs))
+        application = self.make_application(routes, server_kwargs)
+        if self.connection_policy is None:
+            return HTTPServer(application)
+
+        return LimitedHTTPServer(
+            application, metrics=self.metrics, **self.connection_policy.http_server_kwargs()
+        )
 
     def make_application(self, routes, server_kwargs):
         """The WSGI application we are starting"""
-        return tornado.web.Application(routes, **server_kwargs)
+        settings = {}
+        if self.websocket_ping_interval is not None:
+            settings["websocket_ping_interval"] = self.websocket_ping_interval
+        if self.websocket_ping_timeout is not None:
+            settings["websocket_ping_timeout"] = self.websocket_ping_timeout
+        settings.update(server_kwargs)
+
+        return tornado.web.Application(routes, **settings)
+
+    def make_loop_monitor(self):
+        """
+        Hook to return a ``whirlwind.monitor.LoopMonitor`` that watches the
+        event loop while we serve. By default we don't monitor the loop.
+        """
 
     def announce_start(self):
         """Called after the server has been created and just before it is started"""
@@ -72,5 +285,12 @@ class Server(object):
         """
         raise NotImplementedError()
 
+    def metrics_route(self, path="/metrics"):
+        """
+        Helper for tornado_routes that returns a route serving ``self.metrics``
+        in the Prometheus text format
+        """
+        return (path, MetricsHandler, {"metrics": self.metrics})
+
     async def cleanup(self):
         """Called after the server has stopped"""
@@ -0,0 +1,124 @@
+"""
+Let websocket clients reconnect without losing the commands they started.
+
+When a websocket handler is given ``Sessions`` then every connection belongs to
+a session. The first message on a new connection is::
+
+    {"reply": {"session": <token>, "resumed": false}, "message_id": "__session__"}
+
+and every reply after that has a ``seq`` number. If the connection drops then
+the commands it started keep running for ``grace`` seconds and their replies
+are kept in a buffer of the latest ``buffer_size`` replies.
+
+The client resumes the session by connecting with ``?session=<token>&ack=<seq>``
+where ``seq`` is the last reply it received. The server replies with::
+
+    {"reply": {"session": <token>, "resumed": true, "missed": <count>}, "message_id": "__session__"}
+
+and sends every buffered reply after ``seq``. ``missed`` is the number of
+replies that were dropped from the buffer before they could be sent.
+
+Clients may also send ``{"path": "__ack__", "seq": <seq>}`` so that the server
+can forget the replies they already have.
+"""
+
+from collections import deque
+import secrets
+import asyncio
+
+
+class Session:
+    """The replies for one session and the connection it is attached to"""
+
+    def __init__(self, token, connection_future, buffer_size):
+        self.token = token
+        self.connection_future = connection_future
+
+        self.seq = 0
+        self.acked = 0
+        self.buffer = deque(maxlen=buffer_size)
+
+        self.handler = None
+        self.expiry = None
+
+    def add(self, reply):
+        """Give this reply the next sequence number and remember it"""
+        self.seq += 1
+        reply["seq"] = self.seq
+        self.buffer.append(reply)
+        return reply
+
+    def ack(self, seq):
+        """Forget the replies up to and including this sequence number"""
+        self.acked = max(self.acked, min(seq, self.seq))
+        while self.buffer and self.buffer[0]["seq"] <= self.acked:
+            self.buffer.popleft()
+
+    def since(self, seq):
+        """Return the replies we have after this sequence number"""
+        return [reply for reply in self.buffer if reply["seq"] > seq]
+
+    def missed(self, seq):
+        """Return how many replies after this sequence number we no longer have"""
+        oldest = self.buffer[0]["seq"] if self.buffer else self.seq + 1
+        return max(0, oldest - seq - 1)
+
+
+class Sessions:
+    """
+    The sessions for a websocket handler
+
+    grace
+        The number of seconds to keep the commands for a session running after
+        its connection is lost
+
+    buffer_size
+        The number of replies to keep for each session
+    """
+
+    def __init__(self, *, grace=30, buffer_size=1000):
+        self.grace = grace
+        self.buffer_size = buffer_size
+        self.sessions = {}
+
+    def start(self, handler, connection_future):
+        token = secrets.token_urlsafe(24)
+        session = Session(token, connection_future, self.buffer_size)
+        session.handler = handler
+
+        self.sessions[token] = session
+        connection_future.add_done_callback(lambda res: self.forget(session))
+        return session
+
+    def resume(self, token, handler):
+        """Attach this handler to the session with this token, if we have it"""
+        session = self.sessions.get(token) if token else None
+        if session is None or session.connection_future.done():
+            return None
+
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+
+        session.handler = handler
+        return session
+
+    def detach(self, session, handler):
+        """The connection for this handler is gone, so start the grace period"""
+        if session.handler is not handler:
+            return
+
+        session.handler = None
+        session.expiry = asyncio.get_event_loop().call_later(self.grace, self.end, session)
+
+    def end(self, session):
+        """Stop the commands for this session"""
+        session.connection_future.cancel()
+        self.forget(session)
+
+    def forget(self, session):
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+        if self.sessions.get(session.token) is session:
+            del self.sessions[session.token]
@@ -1,12 +1,17 @@
-from whirlwind.commander import Command
+from whirlwind.commander import Command, SlotsCommand, seconds_spec
+from whirlwind.compiled_spec import CompiledFieldSpec
+from whirlwind.tracing import trace, current_span
 
 from delfick_project.norms import dictobj, sb, BadSpecValue, Meta
 from delfick_project.option_merge import NoFormat, MergedOptions
-from collections import defaultdict
+from delfick_project.errors import ProgrammerError
+from collections import defaultdict, OrderedDict
 from textwrap import dedent
 import logging
 import asyncio
 import inspect
+import json
+import copy
 import sys
 
 
@@ -66,12 +71,24 @@ def retrieve_exception(result):
 
 
 def is_interactive(obj):
-    return (
-        obj and hasattr(obj, "execute") and "messages" in inspect.signature(obj.execute).parameters
-    )
+    """
+    Return whether this command class or instance takes in ``messages``
+
+    Classes registered with ``store.command`` remember this answer as
+    ``__whirlwind_interactive__`` so we only inspect the signature once.
+    """
+    if not obj:
+        return False
 
+    kls = obj if isinstance(obj, type) else type(obj)
+    interactive = kls.__dict__.get("__whirlwind_interactive__")
+    if interactive is not None:
+        return interactive
 
-async def pass_on_result(fut, command, execute, *, log_exceptions):
+    return hasattr(obj, "execute") and "messages" in inspect.signature(obj.execute).parameters
+
+
+async def pass_on_result(fut, command, execute, *, log_exceptions, caused_by=None):
     if execute:
         coro = execute()
     else:
@@ -93,9 +110,13 @@ async def pass_on_result(fut, command, execute, *, log_exceptions):
         else:
             fut.set_result(result.result())
 
-    task = create_task(coro, name=f"<pass_on_result: {command.__class__.__name__}>")
-    task.add_done_callback(transfer)
-    return await fut
+    with trace(None, "whirlwind.child", command=command.__class__.__name__) as span:
+        if span is not None:
+            span.link(caused_by)
+
+        task = create_task(coro, name=f"<pass_on_result: {command.__class__.__name__}>")
+        task.add_done_callback(transfer)
+        return await fut
 
 
 class NoSuchPath(Exception):
@@ -126,6 +147,32 @@ class NonInteractiveParent(Exception):
         super().__init__(self, f"Store commands can only specify an interactive parent: {s}")
 
 
+class NonInteractiveShareable(Exception):
+    def __init__(self, wanted):
+        self.wanted = wanted
+
+        s = repr(self.wanted)
+        if hasattr(self.wanted, "__name__"):
+            s = self.wanted.__name__
+
+        super().__init__(self, f"Only interactive commands can be shareable: {s}")
+
+
+class ShareableWithRequestValues(Exception):
+    def __init__(self, wanted, injected):
+        self.wanted = wanted
+        self.injected = injected
+
+        s = repr(self.wanted)
+        if hasattr(self.wanted, "__name__"):
+            s = self.wanted.__name__
+
+        super().__init__(
+            self,
+            f"Shareable commands can't inject values from one request: {s} ({', '.join(injected)})",
+        )
+
+
 class ProcessItem:
     def __init__(self, fut, command, execute, messages):
         self.fut = fut
@@ -134,10 +181,17 @@ class ProcessItem:
         self.messages = messages
         self.interactive = is_interactive(self.command)
 
+        # The span for the message this child came from
+        self.caused_by = current_span.get()
+
     def process(self):
         try:
             coro = pass_on_result(
-                self.fut, self.command, self.execute, log_exceptions=self.interactive
+                self.fut,
+                self.command,
+                self.execute,
+                log_exceptions=self.interactive,
+                caused_by=self.caused_by,
             )
         except:
             self.fut.set_exception(sys.exc_info()[1])
@@ -208,6 +262,169 @@ class MessageHolder:
                 return nxt
 
 
+# Values that belong to the request that started a command. A shared command is
+# run by the first request that starts it, so other requests wouldn't see theirs
+PER_REQUEST_VALUES = ("executor", "message_id", "request_future", "request_handler")
+
+
+def injected_paths(kls):
+    """Return the paths of the values injected into the fields of this command"""
+    paths = []
+    for options in getattr(kls, "fields", {}).values():
+        if type(options) in (tuple, list) and len(options) in (1, 2):
+            options = options[-1]
+        if isinstance(options, dictobj.Field):
+            path = getattr(options.spec, "injected_path", None)
+            if path is not None:
+                paths.append(path)
+    return paths
+
+
+def has_formatted_fields(kls):
+    """Return whether any field of this command is formatted or injected"""
+    for options in getattr(kls, "fields", {}).values():
+        if type(options) in (tuple, list) and len(options) in (1, 2):
+            options = options[-1]
+        if not isinstance(options, dictobj.Field) or options.formatted:
+            return True
+    return False
+
+
+def is_immutable(val):
+    """Return whether val is a plain value that can't be changed"""
+    if type(val) in (tuple, frozenset):
+        return all(is_immutable(v) for v in val)
+    return type(val) in (str, bytes, int, float, bool, type(None))
+
+
+class ValidationCache:
+    """
+    The most recently used ``size`` normalised args for commands without
+    formatted or injected fields
+
+    Keys are the path, name of the command and the args as canonical JSON.
+
+    Args that are only plain immutable values are kept as they are. Any other
+    args are deep copied when they are cached and every time they are used, and
+    aren't cached if they can't be deep copied.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.snapshots = OrderedDict()
+
+    def key_for(self, path, name, args):
+        try:
+            return (path, name, json.dumps(args, sort_keys=True, separators=(",", ":")))
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, key):
+        found = self.snapshots.get(key)
+        if found is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.snapshots.move_to_end(key)
+
+        snapshot, mutable = found
+        if mutable:
+            return copy.deepcopy(snapshot)
+        return dict(snapshot)
+
+    def set(self, key, command):
+        snapshot = {name: getattr(command, name) for name in command.fields}
+
+        mutable = not all(is_immutable(val) for val in snapshot.values())
+        if mutable:
+            try:
+                snapshot = copy.deepcopy(snapshot)
+            except Exception:
+                # We can't give each command its own copy of these
+                return
+
+        self.snapshots[key] = (snapshot, mutable)
+        self.snapshots.move_to_end(key)
+        while len(self.snapshots) > self.size:
+            self.snapshots.popitem(last=False)
+
+
+class SharedProgress:
+    """
+    A progress_cb that gives each message to the progress_cb of every request
+    watching a shared command
+    """
+
+    _merged_options_formattable = True
+
+    def __init__(self):
+        self.callbacks = []
+
+    def add(self, progress_cb):
+        if progress_cb is not None:
+            self.callbacks.append(progress_cb)
+
+    def remove(self, progress_cb):
+        if progress_cb in self.callbacks:
+            self.callbacks.remove(progress_cb)
+
+    def __call__(self, message, **kwargs):
+        for progress_cb in list(self.callbacks):
+            progress_cb(message, **kwargs)
+
+
+class SharedCommand:
+    """
+    An interactive command that is run once for every request that starts it
+    with the same args.
+
+    The command is cancelled when the last of those requests is finished.
+    """
+
+    def __init__(self, key, existing, progress, on_finish):
+        self.key = key
+        self.progress = progress
+        self.existing = existing
+        self.on_finish = on_finish
+
+        self.task = None
+        self.subscribers = 0
+        self.final_future = asyncio.Future()
+
+    async def watch(self, request_future, progress_cb, start):
+        """Wait for the result of the command until this request is finished"""
+        self.subscribers += 1
+        self.progress.add(progress_cb)
+
+        if self.task is None:
+            command = self.existing["command"]
+            self.task = create_task(
+                start(self.final_future),
+                name=f"<execute shared: {command.__class__.__name__}>",
+            )
+            self.task.add_done_callback(lambda res: self.on_finish(self))
+
+        try:
+            waiting = [self.task]
+            if request_future is not None:
+                waiting.append(request_future)
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if not self.task.done():
+                raise asyncio.CancelledError()
+            return await self.task
+        finally:
+            self.subscribers -= 1
+            self.progress.remove(progress_cb)
+            if self.subscribers == 0:
+                self.final_future.cancel()
+                self.task.cancel()
+                self.on_finish(self)
+
+
 class command_spec(sb.Spec):
     """
     Knows how to turn ``{"path": <string>, "body": {"command": <string>, "args": <dict>}}``
@@ -216,11 +433,29 @@ class command_spec(sb.Spec):
     It uses the FieldSpec in self.paths to normalise the args into the Command instance.
     """
 
-    def setup(self, paths):
+    def setup(self, paths, validation_cache=None):
         self.paths = paths
+        self.validation_cache = validation_cache
+        self.shared = {}
         self.existing_commands = {}
 
-    def make_command(self, meta, val, existing):
+    def is_shareable(self, val, existing):
+        """Return whether val is for a command that may be shared between requests"""
+        if existing or not isinstance(val, dict) or not isinstance(val.get("body"), dict):
+            return False
+
+        info = self.paths.get(val.get("path"), {}).get(val["body"].get("command"))
+        return bool(info and getattr(info["kls"], "__whirlwind_shareable__", False))
+
+    def share_key(self, val, name):
+        args = val["body"].get("args") or {}
+        return json.dumps([val["path"], name, args], sort_keys=True, default=repr)
+
+    def forget_shared(self, shared):
+        if self.shared.get(shared.key) is shared:
+            del self.shared[shared.key]
+
+    def make_command(self, meta, val, existing, extra_context=None):
         v = sb.set_options(
             path=sb.required(sb.string_spec()), allow_ws_only=sb.defaulted(sb.boolean(), False)
         ).normalise(meta, val)
@@ -243,7 +478,7 @@ class command_spec(sb.Spec):
         if existing:
             name = val["body"]["command"] = f"{existing['path']}:{name}"
 
-        extra_context = {}
+        extra_context = dict(extra_context or {})
         if existing:
             extra_context["_parent_command"] = existing["command"]
 
@@ -263,7 +498,7 @@ class command_spec(sb.Spec):
                 meta=meta.at("command"),
             )
 
-        command = available_commands[name]["spec"].normalise(meta.at("args"), args)
+        command = self.normalise_args(meta.at("args"), path, name, available_commands[name], args)
 
         if not allow_ws_only and command.__whirlwind_ws_only__:
             raise BadSpecValue(
@@ -275,6 +510,23 @@ class command_spec(sb.Spec):
 
         return command, name
 
+    def normalise_args(self, meta, path, name, info, args):
+        cache = self.validation_cache
+        if cache is None or not getattr(info["kls"], "__whirlwind_cacheable__", False):
+            return info["spec"].normalise(meta, args)
+
+        key = cache.key_for(path, name, args)
+        if key is None:
+            return info["spec"].normalise(meta, args)
+
+        snapshot = cache.get(key)
+        if snapshot is not None:
+            return info["kls"](**snapshot)
+
+        command = info["spec"].normalise(meta, args)
+        cache.set(key, command)
+        return command
+
     def available(self, available_commands, *, allow_ws_only):
         available = []
         for name, info in available_commands.items():
@@ -298,11 +550,31 @@ class command_spec(sb.Spec):
 
     def normalise_filled(self, meta, val):
         parent_existing, message_id_tuple = self.find_command(meta.everything.get("message_id"))
-        command, path = self.make_command(meta, val, parent_existing)
 
+        progress = None
+        extra_context = None
+        request_future = meta.everything.get("request_future")
+        progress_cb = meta.everything.get("progress_cb")
+
+        if self.is_shareable(val, parent_existing):
+            progress = SharedProgress()
+            extra_context = {"progress_cb": progress}
+
+        command, path = self.make_command(meta, val, parent_existing, extra_context)
+
+        shared = None
         existing = None
         if command and is_interactive(command):
             existing = {"command": command, "messages": None, "path": path}
+
+            if progress is not None:
+                key = self.share_key(val, path)
+                shared = self.shared.get(key)
+                if shared is None:
+                    shared = SharedCommand(key, existing, progress, self.forget_shared)
+                    self.shared[key] = shared
+                existing = shared.existing
+
             self.existing_commands[message_id_tuple] = existing
 
         async def execute():
@@ -312,10 +584,21 @@ class command_spec(sb.Spec):
                 return await fut
 
             try:
-                if not existing:
-                    return await command.execute()
+                if shared is not None:
+                    return await shared.watch(
+                        request_future,
+                        progress_cb,
+                        lambda final_future: self.execute_interactive(
+                            final_future, None, shared.existing, shared.existing["command"]
+                        ),
+                    )
+                elif not existing:
+                    result = command.execute()
+                    if inspect.isasyncgen(result):
+                        # Commands may be async generators that are streamed
+                        return result
+                    return await result
                 else:
-                    request_future = meta.everything.get("request_future")
                     return await self.execute_interactive(
                         request_future, parent_existing, existing, command
                     )
@@ -324,6 +607,13 @@ class command_spec(sb.Spec):
                     del self.existing_commands[message_id_tuple]
 
         execute.__whirlwind_command__ = command
+        execute.__whirlwind_command_name__ = path
+        execute.__whirlwind_child__ = bool(parent_existing)
+        execute.__whirlwind_existing__ = existing
+        execute.__whirlwind_message_id__ = message_id_tuple
+        execute.__whirlwind_parent_deadline__ = (
+            parent_existing.get("deadline") if parent_existing else None
+        )
         return execute
 
     async def execute_interactive(self, request_future, parent_existing, existing, command):
@@ -364,24 +654,40 @@ class command_spec(sb.Spec):
 
 class Store:
     Command = Command
+    SlotsCommand = SlotsCommand
 
     _merged_options_formattable = True
 
-    def __init__(self, prefix=None, default_path="/v1", formatter=None):
+    def __init__(self, prefix=None, default_path="/v1", formatter=None, validation_cache_size=None):
         self.prefix = self.normalise_prefix(prefix)
         self.formatter = formatter
         self.default_path = default_path
+        self.validation_cache_size = validation_cache_size
         self.paths = defaultdict(dict)
-        self.command_spec = command_spec(self.paths)
+        self.kls_names = defaultdict(dict)
+
+        validation_cache = None
+        if validation_cache_size:
+            validation_cache = ValidationCache(validation_cache_size)
+        self.command_spec = command_spec(self.paths, validation_cache)
 
     def clone(self):
-        new_store = Store(self.prefix, self.default_path, self.formatter)
+        new_store = Store(
+            self.prefix,
+            self.default_path,
+            self.formatter,
+            validation_cache_size=self.validation_cache_size,
+        )
+        # The index of class names is left for find_name to fill as it's used
         for path, commands in self.paths.items():
-            new_store.paths[path].update(dict(commands))
+            new_store.paths[path] = dict(commands)
         return new_store
 
     def injected(self, path, format_into=sb.NotSpecified, nullable=False):
         class find_value(sb.Spec):
+            injected_path = path
+            injected_nullable = nullable
+
             def normalise(s, meta, val):
                 if nullable and path not in meta.everything:
                     return NoFormat(None)
@@ -416,42 +722,100 @@ class Store:
 
     def merge(self, other, prefix=None):
         new_prefix = self.normalise_prefix(prefix, trailing_slash=False)
+
+        def rename(name):
+            slash = ""
+            if not new_prefix.endswith("/") and not name.startswith("/"):
+                slash = "/"
+            return f"{new_prefix}{slash}{name}"
+
         for path, commands in other.paths.items():
-            for name, options in commands.items():
-                slash = ""
-                if not new_prefix.endswith("/") and not name.startswith("/"):
-                    slash = "/"
-                self.paths[path][f"{new_prefix}{slash}{name}"] = options
+            self.paths[path].update({rename(name): options for name, options in commands.items()})
 
-    def command(self, name, *, path=None, parent=None):
+    def find_name(self, path, kls):
+        """
+        Return the name ``kls`` is registered as under this path, or None if it
+        isn't registered.
+        """
+        commands = self.paths.get(path, {})
+        names = self.kls_names[path]
+
+        name = names.get(kls)
+        if name is not None:
+            options = commands.get(name)
+            if options is not None and options["kls"] is kls:
+                return name
+
+        for name, options in commands.items():
+            if options["kls"] is kls:
+                names[kls] = name
+                return name
+
+    def command(
+        self,
+        name,
+        *,
+        path=None,
+        parent=None,
+        ws_only=False,
+        profile=False,
+        timeout=None,
+        progress=None,
+        shareable=False,
+        compiled=False,
+    ):
         path = self.normalise_path(path)
 
+        if timeout is not None:
+            try:
+                timeout = seconds_spec().normalise(Meta.empty().at("timeout"), timeout)
+            except BadSpecValue as error:
+                raise ProgrammerError(
+                    f"The timeout for the {name} command must be a finite number of"
+                    f" seconds more than zero, got {timeout!r}"
+                ) from error
+
         def decorator(kls):
             if "__whirlwind_command__" in kls.__dict__:
                 raise CantReuseCommands(kls)
 
+            interactive = is_interactive(kls)
+            if shareable and not interactive:
+                # Only interactive commands send their progress to the subscribers
+                raise NonInteractiveShareable(kls)
+
+            if shareable:
+                injected = [i for i in injected_paths(kls) if i in PER_REQUEST_VALUES]
+                if injected:
+                    raise ShareableWithRequestValues(kls, sorted(injected))
+
             kls.__whirlwind_command__ = True
-            kls.__whirlwind_ws_only__ = is_interactive(kls) or parent
+            kls.__whirlwind_interactive__ = interactive
+            kls.__whirlwind_ws_only__ = interactive or parent or ws_only
+            kls.__whirlwind_profile__ = profile
+            kls.__whirlwind_timeout__ = timeout
+            kls.__whirlwind_progress__ = progress
+            kls.__whirlwind_shareable__ = shareable
+            kls.__whirlwind_cacheable__ = not has_formatted_fields(kls)
 
             n = name
-            spec = kls.FieldSpec(formatter=self.formatter)
+            if compiled:
+                spec = CompiledFieldSpec(kls, formatter=self.formatter)
+            else:
+                spec = kls.FieldSpec(formatter=self.formatter)
 
             if parent and not is_interactive(parent):
                 raise NonInteractiveParent(parent)
             elif parent:
-                found = False
-                for p, o in self.paths[path].items():
-                    if o["kls"] is parent:
-                        n = f"{p}:{name}"
-                        found = True
-                        break
-
-                if not found:
+                p = self.find_name(path, parent)
+                if p is None:
                     raise NoSuchParent(parent)
+                n = f"{p}:{name}"
             else:
                 n = f"{self.prefix}{n}"
 
             self.paths[path][n] = {"kls": kls, "spec": spec}
+            self.kls_names[path][kls] = n
             return kls
 
         return decorator
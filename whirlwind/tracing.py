@@ -0,0 +1,219 @@
+"""
+Record how long each part of a request takes.
+
+Give a ``Tracer`` to the ``Commander`` and every request or websocket message
+gets a trace. The current span is kept in a contextvar so that tasks made while
+handling the request, like the children of an interactive command, are part of
+the same trace.
+
+.. code-block:: python
+
+    from whirlwind.tracing import Tracer, JSONLinesExporter
+
+    tracer = Tracer(JSONLinesExporter("/var/log/myapp/traces.jsonl"))
+    commander = Commander(store, whirlwind_tracer=tracer)
+
+    await MyServer(final_future, tracer=tracer).serve(...)
+
+The spans we make are:
+
+whirlwind.request
+    A HTTP request to a handler
+
+whirlwind.message
+    A message on a websocket
+
+whirlwind.validate
+    Turning the body of a request into a command
+
+whirlwind.execute
+    Executing the command
+
+whirlwind.child
+    A child command executed by an interactive parent. This is part of the trace
+    for the parent and is linked to the span of the message the child came from
+
+whirlwind.serialise
+    Turning a reply or progress message into what is sent to the client
+
+Each span that finishes is given to the ``export(span)`` method of the
+exporter. ``tracer.close()`` calls the ``close()`` method of the exporter if it
+has one, which the ``Server`` does when it stops if it was given the tracer.
+"""
+
+from contextlib import nullcontext
+import contextvars
+import threading
+import logging
+import queue
+import random
+import json
+import time
+
+log = logging.getLogger("whirlwind.tracing")
+
+# The span for what we are currently doing
+current_span = contextvars.ContextVar("whirlwind_span", default=None)
+
+no_span = nullcontext()
+
+
+def new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def trace(tracer, name, **attributes):
+    """
+    Return a span for this name, from ``tracer`` or the tracer of the current
+    span. If there is no tracer then a context manager that does nothing is returned
+    """
+    if tracer is None:
+        parent = current_span.get()
+        if parent is None:
+            return no_span
+        tracer = parent.tracer
+    return tracer.span(name, **attributes)
+
+
+class Span:
+    """One part of a trace. This is a context manager that makes it the current span"""
+
+    def __init__(self, tracer, name, parent, attributes):
+        self.name = name
+        self.tracer = tracer
+        self.attributes = attributes
+
+        self.links = []
+        self.error = None
+        self.start = None
+        self.duration = None
+        self.token = None
+
+        self.span_id = new_id(64)
+        if parent is None:
+            self.parent_id = None
+            self.trace_id = new_id(128)
+        else:
+            self.parent_id = parent.span_id
+            self.trace_id = parent.trace_id
+
+    def link(self, span):
+        """Say that this span was caused by another span, perhaps from another trace"""
+        if span is not None:
+            self.links.append({"trace_id": span.trace_id, "span_id": span.span_id})
+
+    def __enter__(self):
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_typ, exc, tb):
+        self.duration = time.perf_counter() - self.started
+        if exc_typ is not None:
+            self.error = exc_typ.__name__
+
+        try:
+            current_span.reset(self.token)
+        except ValueError:
+            # We finished in a different context than we started in
+            pass
+
+        self.tracer.export(self)
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "links": self.links,
+            "attributes": self.attributes,
+        }
+
+
+class JSONLinesExporter:
+    """
+    Append each span to the file at ``path`` as a line of JSON
+
+    Spans are put on a queue of up to ``max_queue`` spans and a thread writes
+    them to the file in batches, so the event loop doesn't wait for the file.
+    Spans that don't fit on the queue are dropped and counted in ``dropped``.
+    ``close`` waits for the thread to write what is left.
+    """
+
+    def __init__(self, path, max_queue=10000):
+        self.path = path
+        self.dropped = 0
+        self.thread = None
+        self.queue = queue.Queue(max_queue)
+
+    def export(self, span):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.write_forever, name="whirlwind-traces", daemon=True
+            )
+            self.thread.start()
+
+        try:
+            self.queue.put_nowait(span.as_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def write_forever(self):
+        try:
+            with open(self.path, "a") as fle:
+                while True:
+                    batch = [self.queue.get()]
+                    while True:
+                        try:
+                            batch.append(self.queue.get_nowait())
+                        except queue.Empty:
+                            break
+
+                    finished = any(span is None for span in batch)
+                    lines = [json.dumps(span, default=repr) + "\n" for span in batch if span]
+                    fle.writelines(lines)
+                    fle.flush()
+
+                    if finished:
+                        return
+        except Exception as error:
+            log.exception(error)
+
+    def close(self):
+        if self.thread is not None:
+            if self.thread.is_alive():
+                self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class Tracer:
+    """
+    Makes spans and gives the finished ones to ``exporter.export(span)``
+    """
+
+    _merged_options_formattable = True
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    def span(self, name, **attributes):
+        """Return a span that is a child of the current span"""
+        return Span(self, name, current_span.get(), attributes)
+
+    def export(self, span):
+        try:
+            self.exporter.export(span)
+        except Exception as error:
+            log.exception(error)
+
+    def close(self):
+        """Let the exporter finish writing spans"""
+        close = getattr(self.exporter, "close", None)
+        if close is not None:
+            close()